@@ -1,14 +1,47 @@
+import os
+import asyncio
 import logging
+import tempfile
+from datetime import date, datetime, timedelta
 from aiogram import types, F
+from aiogram.filters import CommandObject
 from aiogram.fsm.context import FSMContext
 
-from database import Database
+from database import db
 from keyboards import *
+from catalog import catalog
+from edit_coalescer import quantity_edits
+from photo_cache import photo_cache
+from broadcast import broadcaster
+from image_utils import ImageQueueFullError
+from photo_ingest import ingest_photo, PhotoIngestError
+from forecast import FORECAST_HORIZON_DAYS, MAX_HORIZON_DAYS, get_restock_plan
+from product_import import (MAX_REPORTED_ERRORS, ProductImportError, apply_bulk_update, import_products,
+                            read_bulk_update_document)
 from states import AdminStates
 
 logger = logging.getLogger(__name__)
 
-db = Database()
+# Лимит Telegram на длину сообщения (4096) с запасом
+MESSAGE_LIMIT = 4000
+# Отчёт: сколько товаров в топе и до какой длины периода показывать разбивку по дням
+REPORT_TOP_PRODUCTS = 10
+REPORT_MAX_DAILY_ROWS = 14
+REPORT_MAX_DAYS = 3660
+# Сколько товаров показывать в плане закупки
+FORECAST_TOP_PRODUCTS = 30
+REPORT_USAGE = (
+    "Использование:\n"
+    "/report - за сегодня\n"
+    "/report 7 - за последние 7 дней\n"
+    "/report 2024-10-01 - за день\n"
+    "/report 2024-10-01 2024-10-31 - за период"
+)
+
+
+def _money(value: float) -> str:
+    """Сумма с разделителями тысяч: 12345.6 -> 12 346"""
+    return f"{value:,.0f}".replace(",", " ")
 
 
 class AdminHandlers:
@@ -42,18 +75,258 @@ class AdminHandlers:
         await state.set_state(AdminStates.adding_product_name)
 
     async def show_all_products(self, message: types.Message):
-        products = db.get_all_products()
-        text = "📋 Все товары:\n\n"
+        # На один товар больше, чтобы знать, есть ли следующая страница
+        products = await db.get_all_products(limit=ADMIN_PRODUCTS_PAGE_SIZE + 1)
+        if not products:
+            await message.answer("📋 Товаров пока нет")
+            return
+
+        text, markup = self._format_products_page(
+            products[:ADMIN_PRODUCTS_PAGE_SIZE],
+            has_prev=False,
+            has_next=len(products) > ADMIN_PRODUCTS_PAGE_SIZE
+        )
+        await message.answer(text, reply_markup=markup)
+
+    async def products_page(self, callback: types.CallbackQuery, state: FSMContext):
+        direction, cursor = callback.data.replace("admin_products_", "").split("_")
 
+        if direction == "next":
+            products = await db.get_all_products(after_id=int(cursor), limit=ADMIN_PRODUCTS_PAGE_SIZE + 1)
+            page = products[:ADMIN_PRODUCTS_PAGE_SIZE]
+            has_prev, has_next = True, len(products) > ADMIN_PRODUCTS_PAGE_SIZE
+        else:
+            products = await db.get_all_products(before_id=int(cursor), limit=ADMIN_PRODUCTS_PAGE_SIZE + 1)
+            page = products[-ADMIN_PRODUCTS_PAGE_SIZE:]
+            has_prev, has_next = len(products) > ADMIN_PRODUCTS_PAGE_SIZE, True
+
+        if not page:
+            await callback.answer("Больше товаров нет")
+            return
+
+        text, markup = self._format_products_page(page, has_prev, has_next)
+        await callback.message.edit_text(text, reply_markup=markup)
+        await callback.answer()
+
+    def _format_products_page(self, products, has_prev: bool, has_next: bool):
+        """Текст страницы не длиннее MESSAGE_LIMIT и кнопки листания"""
+        parts = ["📋 Все товары:\n\n"]
+        length = len(parts[0])
+        shown = 0
         for product in products:
-            text += f"ID: {product['id']}\n"
-            text += f"Название: {product['name']}\n"
-            text += f"Цена: {product['price']}сум/{product['unit']}\n"
-            text += f"Количество: {product['quantity']}\n"
-            text += f"Категория: {product['category']}\n"
-            text += "─" * 20 + "\n"
+            entry = (
+                f"ID: {product['id']}\n"
+                f"Название: {product['name']}\n"
+                f"Цена: {product['price']}сум/{product['unit']}\n"
+                f"Количество: {product['quantity']}\n"
+                f"Категория: {product['category']}\n"
+                + "─" * 20 + "\n"
+            )
+            if shown and length + len(entry) > MESSAGE_LIMIT:
+                # Не поместившиеся товары уходят на следующую страницу
+                has_next = True
+                break
+            parts.append(entry)
+            length += len(entry)
+            shown += 1
+
+        markup = get_admin_products_keyboard(
+            prev_before_id=products[0]["id"] if has_prev else None,
+            next_after_id=products[shown - 1]["id"] if has_next else None
+        )
+        return "".join(parts), markup
+
+    async def export_products(self, message: types.Message):
+        await message.answer("⏳ Готовим файл с товарами...")
 
-        await message.answer(text)
+        # Файл пишется на диск пачками и отправляется потоком с диска
+        fd, path = tempfile.mkstemp(suffix=".csv")
+        os.close(fd)
+        try:
+            count = await db.export_products_csv(path)
+            await message.answer_document(
+                types.FSInputFile(path, filename=f"products_{datetime.now():%Y%m%d_%H%M}.csv"),
+                caption=f"📤 Выгружено товаров: {count}"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка экспорта товаров: {e}")
+            await message.answer("❌ Не удалось выгрузить товары")
+        finally:
+            os.remove(path)
+
+    async def start_import(self, message: types.Message, state: FSMContext):
+        await message.answer(
+            "📥 Отправьте файл с товарами: CSV, XLSX или ZIP (таблица и фото)\n\n"
+            "Колонки как в выгрузке: id;name;price;quantity;unit;category\n"
+            "• без id товар ищется по названию, не найден - добавляется\n"
+            "• category - название категории без эмодзи\n"
+            "• необязательная колонка image - ссылка на фото или имя файла в архиве\n\n"
+            "Для отмены отправьте любое сообщение",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        await state.set_state(AdminStates.importing_products)
+
+    async def process_import_file(self, message: types.Message, state: FSMContext):
+        await state.set_state(AdminStates.admin_menu)
+        await message.answer("⏳ Импортируем товары...")
+        try:
+            report = await import_products(self.bot, message.document)
+        except ProductImportError as e:
+            await message.answer(f"❌ {e}", reply_markup=get_admin_keyboard())
+            return
+        except Exception as e:
+            logger.error(f"Ошибка импорта товаров: {e}")
+            await message.answer("❌ Не удалось импортировать товары", reply_markup=get_admin_keyboard())
+            return
+
+        await message.answer(report.format()[:MESSAGE_LIMIT], reply_markup=get_admin_keyboard())
+
+    async def cancel_import(self, message: types.Message, state: FSMContext):
+        await message.answer("Импорт отменён", reply_markup=get_admin_keyboard())
+        await state.set_state(AdminStates.admin_menu)
+
+    async def start_bulk_update(self, message: types.Message, state: FSMContext):
+        await message.answer(
+            "💲 Отправьте список изменений сообщением или файлом CSV/TXT:\n\n"
+            "id;цена;количество - пустое поле оставляет значение без изменений\n"
+            "12;15000;30\n"
+            "15;;0\n\n"
+            "Категория и процент - изменить все цены категории:\n"
+            "Фрукты +10%\n"
+            "Овощи -5%\n\n"
+            "Все изменения применяются разом, цены из списка - после процентов.",
+            reply_markup=get_back_keyboard()
+        )
+        await state.set_state(AdminStates.bulk_updating)
+
+    async def process_bulk_update(self, message: types.Message, state: FSMContext):
+        try:
+            if message.document:
+                text = await read_bulk_update_document(self.bot, message.document)
+            else:
+                text = message.text or ""
+            result = await apply_bulk_update(text)
+        except ProductImportError as e:
+            await message.answer(f"❌ {e}")
+            return
+        except Exception as e:
+            logger.error(f"Ошибка массового изменения товаров: {e}")
+            await message.answer("❌ Не удалось применить изменения", reply_markup=get_admin_keyboard())
+            await state.set_state(AdminStates.admin_menu)
+            return
+
+        if not (result["adjusted"] or result["changed"]) and result["errors"]:
+            # Ничего не применено - даём исправить список
+            await message.answer(self._format_bulk_update(result) + "\n\nИсправьте список и отправьте снова")
+            return
+
+        await message.answer(self._format_bulk_update(result), reply_markup=get_admin_keyboard())
+        await state.set_state(AdminStates.admin_menu)
+
+    def _format_bulk_update(self, result) -> str:
+        lines = [f"✏️ Изменено товаров по списку: {result['changed']}"]
+        if result["categories"]:
+            lines.append(f"💲 Цены изменены в категориях: {result['categories']} (товаров: {result['adjusted']})")
+        lines.append(f"❌ Строк с ошибками: {len(result['errors'])}")
+        if result["errors"]:
+            lines.append("")
+            lines.extend(f"Строка {row}: {text}" for row, text in result["errors"][:MAX_REPORTED_ERRORS])
+            if len(result["errors"]) > MAX_REPORTED_ERRORS:
+                lines.append(f"... и ещё {len(result['errors']) - MAX_REPORTED_ERRORS}")
+        return "\n".join(lines)[:MESSAGE_LIMIT]
+
+    async def cancel_bulk_update(self, message: types.Message, state: FSMContext):
+        await message.answer("Изменения отменены", reply_markup=get_admin_keyboard())
+        await state.set_state(AdminStates.admin_menu)
+
+    async def show_report(self, message: types.Message, command: CommandObject = None):
+        period = self._parse_report_period(command.args if command else None)
+        if period is None:
+            await message.answer(REPORT_USAGE)
+            return
+
+        date_from, date_to = period
+        report = await db.get_sales_report(date_from.isoformat(), date_to.isoformat(), REPORT_TOP_PRODUCTS)
+        await message.answer(self._format_report(date_from, date_to, report))
+
+    def _parse_report_period(self, args):
+        """(начало, конец) периода отчёта или None при неверных аргументах"""
+        today = date.today()
+        parts = (args or "").split()
+        try:
+            if not parts:
+                return today, today
+            if len(parts) == 1 and parts[0].isdigit():
+                days = int(parts[0])
+                if not 1 <= days <= REPORT_MAX_DAYS:
+                    return None
+                return today - timedelta(days=days - 1), today
+            if len(parts) <= 2:
+                date_from = date.fromisoformat(parts[0])
+                date_to = date.fromisoformat(parts[-1])
+                return (date_from, date_to) if date_from <= date_to else (date_to, date_from)
+        except ValueError:
+            pass
+        return None
+
+    def _format_report(self, date_from, date_to, report) -> str:
+        title = str(date_from) if date_from == date_to else f"{date_from} — {date_to}"
+        lines = [
+            f"📊 Отчёт за {title}",
+            "",
+            f"🧾 Заказов: {report['orders']}",
+            f"⚖️ Продано: {report['quantity']} кг",
+            f"💰 Выручка: {_money(report['revenue'])} сум",
+            "",
+            self._format_edit_stats(),
+        ]
+        if not report["orders"]:
+            return "\n".join(lines)
+
+        if date_from != date_to and len(report["days"]) <= REPORT_MAX_DAILY_ROWS:
+            lines += ["", "📅 По дням:"]
+            lines += [f"{day['day']}: {day['orders']} зак., {day['quantity']} кг, {_money(day['revenue'])} сум"
+                      for day in report["days"]]
+
+        lines += ["", "📂 По категориям:"]
+        lines += [f"{category['name']}: {category['quantity']} кг, {_money(category['revenue'])} сум"
+                  for category in report["categories"]]
+
+        lines += ["", f"🏆 Топ-{REPORT_TOP_PRODUCTS} товаров:"]
+        lines += [f"{index}. {product['name']}: {product['quantity']} кг, {_money(product['revenue'])} сум"
+                  for index, product in enumerate(report["products"], 1)]
+        return "\n".join(lines)[:MESSAGE_LIMIT]
+
+    @staticmethod
+    def _format_edit_stats() -> str:
+        stats = quantity_edits.stats()
+        return (f"⌨️ Правки клавиатур (этот процесс): запрошено {stats['requested']}, "
+                f"отправлено {stats['sent']}, сэкономлено {stats['saved']}")
+
+    async def show_forecast(self, message: types.Message, command: CommandObject = None):
+        args = (command.args or "").strip() if command else ""
+        if args and not (args.isdigit() and 1 <= int(args) <= MAX_HORIZON_DAYS):
+            await message.answer(f"Использование: /forecast [дней, 1-{MAX_HORIZON_DAYS}], "
+                                 f"по умолчанию {FORECAST_HORIZON_DAYS}")
+            return
+
+        horizon = int(args) if args else FORECAST_HORIZON_DAYS
+        plan = await get_restock_plan(horizon)
+        if not plan:
+            await message.answer(f"📦 Остатков хватит на {horizon} дн., докупать ничего не нужно")
+            return
+
+        lines = [f"📦 Закупка на {horizon} дн. (товаров: {len(plan)})", ""]
+        for item in plan[:FORECAST_TOP_PRODUCTS]:
+            days_left = f"{item['days_left']:.0f} дн." if item["days_left"] != float("inf") else "—"
+            lines.append(
+                f"• {item['name']}: заказать {item['restock']} {item['unit']}\n"
+                f"  остаток {item['quantity']} (на {days_left}), продажи ~{item['daily']:.1f}/день, "
+                f"спрос {item['forecast']:.0f}"
+            )
+        if len(plan) > FORECAST_TOP_PRODUCTS:
+            lines.append(f"\n... и ещё {len(plan) - FORECAST_TOP_PRODUCTS}")
+        await message.answer("\n".join(lines)[:MESSAGE_LIMIT])
 
     async def exit_admin(self, message: types.Message, state: FSMContext):
         await message.answer(
@@ -88,7 +361,7 @@ class AdminHandlers:
 
     async def process_product_category(self, message: types.Message, state: FSMContext):
         category_name_with_emoji = message.text
-        categories = db.get_categories()
+        categories = catalog.get_categories()
 
         # Находим ID категории по имени с эмодзи
         category_id = None
@@ -111,55 +384,46 @@ class AdminHandlers:
     async def skip_photo(self, message: types.Message, state: FSMContext):
         await self.add_product_to_db(message, state, None)
 
-    async def process_product_photo(self, message: types.Message, state: FSMContext):
+    async def _ingest_photo(self, message: types.Message):
+        """Скачивает и обрабатывает фото товара; при ошибке отвечает админу и возвращает None"""
         try:
-            # Получаем файл с наилучшим качеством
-            photo = message.photo[-1] if message.photo else None
-            
-            if not photo:
-                await message.answer("❌ Пожалуйста, отправьте изображение")
-                return
-                
-            file = await self.bot.get_file(photo.file_id)
-            
-            # Проверяем тип файла
-            file_extension = file.file_path.split('.')[-1].lower()
-            if file_extension not in ['jpg', 'jpeg', 'png', 'webp', 'gif']:
-                await message.answer(
-                    "❌ Поддерживаются только изображения в формате JPG, PNG, WEBP или GIF"
-                )
-                return
-                
-            # Скачиваем файл
-            photo_bytes = await self.bot.download_file(file.file_path)
-            
-            # Обрабатываем изображение
-            from image_utils import process_image
-            processed_image = process_image(
-                photo_bytes.read(),
-                max_size=(1200, 1200),
-                quality=85
-            )
-            
-            await self.add_product_to_db(message, state, processed_image)
-            
+            return await ingest_photo(self.bot, message.photo)
+        except PhotoIngestError as e:
+            await message.answer(f"❌ {e}")
+        except ImageQueueFullError:
+            await message.answer("⏳ Сейчас обрабатывается много изображений. Отправьте фото ещё раз через минуту.")
+        except asyncio.TimeoutError:
+            await message.answer("❌ Изображение обрабатывалось слишком долго. Попробуйте отправить фото меньшего размера.")
         except Exception as e:
             print(f"Ошибка при обработке фото: {e}")
             await message.answer(
                 "❌ Произошла ошибка при обработке изображения. "
                 "Попробуйте отправить другое изображение."
             )
+        return None
+
+    async def process_product_photo(self, message: types.Message, state: FSMContext):
+        if not message.photo:
+            await message.answer("❌ Пожалуйста, отправьте изображение")
+            return
+
+        image_variants = await self._ingest_photo(message)
+        if image_variants is None:
+            return
+
+        await self.add_product_to_db(message, state, image_variants)
 
-    async def add_product_to_db(self, message: types.Message, state: FSMContext, image_data):
+    async def add_product_to_db(self, message: types.Message, state: FSMContext, image_variants):
         data = await state.get_data()
 
-        product_id = db.add_product(
+        product_id = await db.add_product(
             data["new_product_name"],
             data["new_product_price"],
             data["new_product_quantity"],
             data["new_product_category"],
-            image_data
+            image_variants=image_variants
         )
+        await catalog.refresh_product(product_id)
 
         await message.answer(
             f"✅ Товар успешно добавлен!\n\n"
@@ -178,7 +442,7 @@ class AdminHandlers:
     async def process_edit_product(self, message: types.Message, state: FSMContext):
         try:
             product_id = int(message.text)
-            product = db.get_product(product_id)
+            product = await db.get_product(product_id)
 
             if not product:
                 await message.answer("❌ Товар с таким ID не найден!")
@@ -206,13 +470,14 @@ class AdminHandlers:
     async def process_delete_product(self, message: types.Message, state: FSMContext):
         try:
             product_id = int(message.text)
-            product = db.get_product(product_id)
+            product = await db.get_product(product_id)
 
             if not product:
                 await message.answer("❌ Товар с таким ID не найден!")
                 return
 
-            success = db.delete_product(product_id)
+            success = await db.delete_product(product_id)
+            catalog.remove_product(product_id)
 
             if success:
                 await message.answer(
@@ -238,7 +503,7 @@ class AdminHandlers:
     async def process_edit_product(self, message: types.Message, state: FSMContext):
         try:
             product_id = int(message.text)
-            product = db.get_product(product_id)
+            product = await db.get_product(product_id)
 
             if not product:
                 await message.answer("❌ Товар с таким ID не найден!")
@@ -268,7 +533,7 @@ class AdminHandlers:
     async def process_edit_field_selection(self, message: types.Message, state: FSMContext):
         data = await state.get_data()
         product_id = data.get("editing_product_id")
-        product = db.get_product(product_id)
+        product = await db.get_product(product_id)
 
         if not product:
             await message.answer("❌ Товар не найден!")
@@ -312,7 +577,7 @@ class AdminHandlers:
         product_id = data.get("editing_product_id")
 
         new_name = message.text
-        self.update_product_field(product_id, "name", new_name)
+        await self.update_product_field(product_id, "name", new_name)
 
         await message.answer(
             f"✅ Название товара обновлено на: {new_name}",
@@ -326,7 +591,7 @@ class AdminHandlers:
             data = await state.get_data()
             product_id = data.get("editing_product_id")
 
-            self.update_product_field(product_id, "price", new_price)
+            await self.update_product_field(product_id, "price", new_price)
 
             await message.answer(
                 f"✅ Цена товара обновлена на: {new_price}сум",
@@ -342,7 +607,7 @@ class AdminHandlers:
             data = await state.get_data()
             product_id = data.get("editing_product_id")
 
-            self.update_product_field(product_id, "quantity", new_quantity)
+            await self.update_product_field(product_id, "quantity", new_quantity)
 
             await message.answer(
                 f"✅ Количество товара обновлено на: {new_quantity}",
@@ -354,7 +619,7 @@ class AdminHandlers:
 
     async def process_edit_product_category(self, message: types.Message, state: FSMContext):
         category_name_with_emoji = message.text
-        categories = db.get_categories()
+        categories = catalog.get_categories()
 
         # Находим ID категории по имени с эмодзи
         category_id = None
@@ -370,7 +635,7 @@ class AdminHandlers:
         data = await state.get_data()
         product_id = data.get("editing_product_id")
 
-        self.update_product_field(product_id, "category_id", category_id)
+        await self.update_product_field(product_id, "category_id", category_id)
 
         await message.answer(
             f"✅ Категория товара обновлена на: {category_name_with_emoji}",
@@ -381,21 +646,24 @@ class AdminHandlers:
     async def process_edit_product_photo(self, message: types.Message, state: FSMContext):
         data = await state.get_data()
         product_id = data.get("editing_product_id")
+        product = await db.get_product(product_id)
+        old_image_ref = product["image_ref"] if product else None
 
         if message.text == "пропустить":
             # Удаляем фото
-            self.update_product_field(product_id, "image", None)
+            await db.set_product_image(product_id, None)
+            await catalog.refresh_product(product_id)
             await message.answer(
                 "✅ Фото товара удалено",
                 reply_markup=get_admin_keyboard()
             )
         elif message.photo:
-            # Получаем самое большое изображение
-            photo = message.photo[-1]
-            file = await self.bot.get_file(photo.file_id)
-            photo_bytes = await self.bot.download_file(file.file_path)
+            image_variants = await self._ingest_photo(message)
+            if image_variants is None:
+                return
 
-            self.update_product_field(product_id, "image", photo_bytes.read())
+            await db.set_product_images(product_id, image_variants)
+            await catalog.refresh_product(product_id)
             await message.answer(
                 "✅ Фото товара обновлено",
                 reply_markup=get_admin_keyboard()
@@ -404,19 +672,48 @@ class AdminHandlers:
             await message.answer("❌ Отправьте фото или нажмите 'пропустить'")
             return
 
+        # Старый file_id больше не соответствует фото товара
+        await photo_cache.invalidate(old_image_ref)
         await state.set_state(AdminStates.admin_menu)
 
-    def update_product_field(self, product_id: int, field: str, value):
-        """Обновляет конкретное поле товара в базе данных"""
-        conn = db.get_connection()
-        cursor = conn.cursor()
+    # ===== РАССЫЛКА =====
+    async def start_broadcast(self, message: types.Message, state: FSMContext):
+        await message.answer(
+            "📢 Введите текст рассылки для всех пользователей:",
+            reply_markup=types.ReplyKeyboardRemove()
+        )
+        await state.set_state(AdminStates.broadcast_text)
 
-        if value is None:
-            cursor.execute(f'UPDATE products SET {field} = NULL WHERE id = ?', (product_id,))
-        else:
-            cursor.execute(f'UPDATE products SET {field} = ? WHERE id = ?', (value, product_id))
+    async def process_broadcast_text(self, message: types.Message, state: FSMContext):
+        if not message.text:
+            await message.answer("❌ Отправьте текст сообщения")
+            return
 
-        conn.commit()
-        conn.close()
+        await state.update_data(broadcast_text=message.text)
+        await message.answer(
+            f"Предпросмотр рассылки:\n\n{message.text}",
+            reply_markup=get_broadcast_confirm_keyboard()
+        )
+        await state.set_state(AdminStates.broadcast_confirm)
+
+    async def confirm_broadcast(self, callback: types.CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        broadcast_id = await broadcaster.start(self.bot, data["broadcast_text"], callback.message.chat.id)
+
+        await callback.message.edit_text(
+            f"🚀 Рассылка #{broadcast_id} запущена. По завершении придёт отчёт."
+        )
+        await callback.message.answer("Админ-меню", reply_markup=get_admin_keyboard())
+        await state.set_state(AdminStates.admin_menu)
+
+    async def cancel_broadcast(self, callback: types.CallbackQuery, state: FSMContext):
+        await callback.message.edit_text("❌ Рассылка отменена")
+        await callback.message.answer("Админ-меню", reply_markup=get_admin_keyboard())
+        await state.set_state(AdminStates.admin_menu)
+
+    async def update_product_field(self, product_id: int, field: str, value):
+        """Обновляет конкретное поле товара в базе данных"""
+        await db.update_product_field(product_id, field, value)
+        await catalog.refresh_product(product_id)
 
     # ... остальные методы без изменений ...
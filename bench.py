@@ -0,0 +1,339 @@
+"""
+Замеры производительности на временной базе: python bench.py <замер> [параметры].
+
+Модули бота импортируются внутри замеров, после перехода во временный
+каталог: database при импорте создаёт общий экземпляр db (shop_bot.db
+и images/ в текущем каталоге), и рабочие файлы не должны пострадать.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from typing import Dict, List, Tuple
+
+
+def _percentiles(delays: List[float]) -> Dict:
+    delays = sorted(delays)
+    return {
+        "p50_ms": round(delays[len(delays) // 2] * 1000, 2),
+        "p99_ms": round(delays[int(len(delays) * 0.99)] * 1000, 2),
+        "max_ms": round(delays[-1] * 1000, 2),
+    }
+
+
+# ===== ОБРАБОТЧИКИ: Database В EVENT LOOP ПРОТИВ AsyncDatabase =====
+async def benchmark_handler_latency(users: int = 200, rounds: int = 10, use_async: bool = True,
+                                    products: int = 50000, think: float = 0.5) -> Dict:
+    """
+    Задержка обработчиков покупателей: users пользователей одновременно
+    смотрят корзину, кладут в неё товар и оформляют заказы, пока админ
+    раз в секунду выгружает каталог из products товаров в CSV.
+    Без use_async обработчики вызывают Database прямо из event loop (как до
+    AsyncDatabase), с use_async - ждут AsyncDatabase. Задержка считается
+    от момента, когда обновление «пришло», до ответа, поэтому включает
+    ожидание event loop, занятого чужими запросами.
+    """
+    from database import AsyncDatabase
+
+    with tempfile.TemporaryDirectory() as root:
+        database = AsyncDatabase(os.path.join(root, "benchmark.db"), images_dir=os.path.join(root, "images"))
+        sync = database.sync
+        with sync.connection() as conn:
+            category_id = conn.execute("SELECT MIN(id) FROM categories").fetchone()[0]
+            conn.executemany(
+                "INSERT INTO products (name, price, quantity, unit, category_id) VALUES (?, 100, ?, 'кг', ?)",
+                [(f"Товар {index}", 10 ** 9, category_id) for index in range(products)])
+            conn.executemany(
+                "INSERT INTO users (user_id, name, phone, registered_at) VALUES (?, 'Покупатель', '+70000000000', '')",
+                [(user_id,) for user_id in range(1, users + 1)])
+
+        async def call(name: str, *args):
+            if use_async:
+                return await getattr(database, name)(*args)
+            return getattr(sync, name)(*args)
+
+        delays = []
+        running = True
+
+        async def customer(user_id: int):
+            for step in range(rounds):
+                arrived = time.perf_counter() + random.uniform(0, think)
+                await asyncio.sleep(max(0.0, arrived - time.perf_counter()))
+                await call("get_user", user_id)
+                if step % 3 == 0:
+                    await call("add_to_cart", user_id, random.randint(1, products), random.randint(1, 5))
+                cart = await call("get_user_cart", user_id)
+                if step % 5 == 4 and cart:
+                    total = sum(item["price"] * item["quantity"] for item in cart)
+                    await call("create_order", user_id, total, "01.01", "10:00-12:00", "Адрес", cart)
+                # Ответ в Telegram
+                await asyncio.sleep(0)
+                delays.append(time.perf_counter() - arrived)
+
+        async def admin():
+            while running:
+                await call("export_products_csv", os.path.join(root, "export.csv"))
+                await asyncio.sleep(1)
+
+        admin_task = asyncio.create_task(admin())
+        started = time.perf_counter()
+        await asyncio.gather(*(customer(user_id) for user_id in range(1, users + 1)))
+        elapsed = time.perf_counter() - started
+        running = False
+        await admin_task
+        database.close()
+
+    return {
+        "mode": "async" if use_async else "sync",
+        "users": users,
+        "updates": len(delays),
+        "total_s": round(elapsed, 2),
+        **_percentiles(delays),
+    }
+
+
+
+# ===== ЗАПРОСЫ ГОРЯЧИХ ПУТЕЙ С ИНДЕКСАМИ И БЕЗ =====
+# Запросы и индексы миграции _migration_hot_path_indexes, которые их обслуживают
+_BENCHMARK_QUERIES = {
+    "products_by_category": "SELECT id, name, price FROM products WHERE category_id = ? AND id > 0 ORDER BY id LIMIT 10",
+    "cart_holds_by_product": "SELECT SUM(quantity) FROM carts WHERE product_id = ?",
+    "items_by_order": "SELECT product_id, quantity, price FROM order_items WHERE order_id = ?",
+    "orders_by_user": "SELECT id, total_amount FROM orders WHERE user_id = ? ORDER BY created_at DESC LIMIT 10",
+    "orders_by_status": "SELECT id FROM orders WHERE status = 'pending' ORDER BY created_at LIMIT 10",
+    "orders_by_date": "SELECT COUNT(*) FROM orders WHERE created_at >= ?",
+}
+_BENCHMARK_INDEXES = ("idx_products_category", "idx_carts_product", "idx_order_items_order",
+                      "idx_orders_user", "idx_orders_status", "idx_orders_created")
+
+
+def benchmark_query_times(rows: int, repeats: int = 200) -> Dict:
+    """
+    Время запросов горячих путей при rows заказов и позиций заказов
+    (товаров и позиций корзин - в 10 раз меньше), с индексами миграции
+    и без них. Возвращает {запрос: {"indexed_ms": .., "scan_ms": ..}}
+    """
+    from database import Database
+
+    users = max(rows // 20, 1)
+    products = max(rows // 10, 1)
+    categories = 20
+    statuses = ("pending",) + ("delivered",) * 99
+
+    def params(name: str) -> tuple:
+        if name == "products_by_category":
+            return (random.randint(1, categories),)
+        if name == "cart_holds_by_product":
+            return (random.randint(1, products),)
+        if name == "items_by_order":
+            return (random.randint(1, rows),)
+        if name == "orders_by_user":
+            return (random.randint(1, users),)
+        if name == "orders_by_status":
+            return ()
+        return ("2025-12-31",)
+
+    def measure(conn) -> Dict[str, float]:
+        result = {}
+        for name, sql in _BENCHMARK_QUERIES.items():
+            started = time.perf_counter()
+            for _ in range(repeats):
+                conn.execute(sql, params(name)).fetchall()
+            result[name] = (time.perf_counter() - started) / repeats * 1000
+        return result
+
+    with tempfile.TemporaryDirectory() as root:
+        database = Database(os.path.join(root, "benchmark.db"), pool_size=1, images_dir=os.path.join(root, "images"))
+        with database.connection() as conn:
+            conn.executemany("INSERT OR IGNORE INTO categories (id, name, emoji) VALUES (?, ?, '')",
+                             [(index, f"Категория {index}") for index in range(1, categories + 1)])
+            conn.executemany(
+                "INSERT INTO products (id, name, price, quantity, unit, category_id) VALUES (?, ?, 100, 1000, 'кг', ?)",
+                ((index, f"Товар {index}", random.randint(1, categories)) for index in range(1, products + 1)))
+            conn.executemany(
+                "INSERT OR IGNORE INTO carts (user_id, product_id, quantity) VALUES (?, ?, 1)",
+                ((random.randint(1, users), random.randint(1, products)) for _ in range(products)))
+            conn.executemany(
+                "INSERT INTO orders (id, user_id, total_amount, delivery_date, delivery_time, delivery_address,"
+                " status, created_at) VALUES (?, ?, 100, '01.01', '10:00-12:00', 'Адрес', ?, ?)",
+                ((index, random.randint(1, users), random.choice(statuses),
+                  f"2025-{index * 12 // (rows + 1) + 1:02d}-{random.randint(1, 28):02d}T12:00:00")
+                 for index in range(1, rows + 1)))
+            conn.executemany(
+                "INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, 1, 100)",
+                ((random.randint(1, rows), random.randint(1, products)) for _ in range(rows)))
+            conn.execute("ANALYZE")
+
+        with database.connection() as conn:
+            indexed = measure(conn)
+            for index in _BENCHMARK_INDEXES:
+                conn.execute(f"DROP INDEX {index}")
+            conn.execute("ANALYZE")
+            scan = measure(conn)
+        database.close()
+
+    return {name: {"indexed_ms": round(indexed[name], 3), "scan_ms": round(scan[name], 3)}
+            for name in _BENCHMARK_QUERIES}
+
+
+
+# ===== ОДНОВРЕМЕННЫЕ ЗАКАЗЫ ОДНОГО ТОВАРА =====
+async def benchmark_checkout_contention(customers: int = 500, stock: int = 100, quantity: int = 1) -> Dict:
+    """
+    Распродажа: customers покупателей одновременно оформляют заказ
+    (как confirm_order: корзина -> create_order) на один товар с остатком stock.
+    Заказов должно пройти ровно stock // quantity, остаток - не уйти в минус
+    """
+    from database import AsyncDatabase, InsufficientStockError
+
+    with tempfile.TemporaryDirectory() as root:
+        database = AsyncDatabase(os.path.join(root, "benchmark.db"), images_dir=os.path.join(root, "images"))
+        with database.sync.connection() as conn:
+            category_id = conn.execute("SELECT MIN(id) FROM categories").fetchone()[0]
+            product_id = conn.execute(
+                "INSERT INTO products (name, price, quantity, unit, category_id) VALUES ('Клубника', 500, ?, 'кг', ?)",
+                (stock, category_id)).lastrowid
+            conn.executemany("INSERT INTO carts (user_id, product_id, quantity) VALUES (?, ?, ?)",
+                             [(user_id, product_id, quantity) for user_id in range(1, customers + 1)])
+
+        delays = []
+        outcomes = {"ordered": 0, "insufficient": 0}
+
+        async def confirm_order(user_id: int):
+            started = time.perf_counter()
+            cart = await database.get_user_cart(user_id)
+            total = sum(item["price"] * item["quantity"] for item in cart)
+            try:
+                await database.create_order(user_id, total, "01.01", "10:00-12:00", "Адрес", cart)
+                outcomes["ordered"] += 1
+            except InsufficientStockError:
+                outcomes["insufficient"] += 1
+            delays.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(confirm_order(user_id) for user_id in range(1, customers + 1)))
+        elapsed = time.perf_counter() - started
+        left = (await database.get_product(product_id))["quantity"]
+        database.close()
+
+    return {
+        "customers": customers,
+        **outcomes,
+        "stock_left": left,
+        "oversold": outcomes["ordered"] * quantity > stock,
+        "total_s": round(elapsed, 3),
+        **_percentiles(delays),
+    }
+
+
+
+# ===== ЗАГРУЗКА ФОТО: ОБРАБОТКА В EVENT LOOP ПРОТИВ ПУЛА ПРОЦЕССОВ =====
+async def benchmark_upload_latency(uploads: int = 4, size: Tuple[int, int] = (4000, 3000),
+                                   use_pool: bool = True, tick: float = 0.005) -> Dict:
+    """
+    Задержка обработки обновлений покупателей, пока несколько админов
+    одновременно загружают большие фото. Покупателей имитирует задача,
+    которая каждые tick секунд просыпается и замеряет опоздание event loop.
+    """
+    import io
+    from PIL import Image
+    from image_utils import process_image, process_image_async
+
+    source = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3))
+    buffer = io.BytesIO()
+    source.save(buffer, format="JPEG", quality=95)
+    photo = buffer.getvalue()
+
+    delays = []
+    running = True
+
+    async def customer():
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(tick)
+            delays.append(time.perf_counter() - started - tick)
+
+    async def admin():
+        if use_pool:
+            await process_image_async(photo)
+        else:
+            process_image(photo)
+
+    if use_pool:
+        # Процессы пула запускаются заранее, как после первой загрузки в работающем боте
+        await process_image_async(photo)
+
+    customer_task = asyncio.create_task(customer())
+    await asyncio.sleep(tick * 4)
+    started = time.perf_counter()
+    await asyncio.gather(*(admin() for _ in range(uploads)))
+    elapsed = time.perf_counter() - started
+    running = False
+    await customer_task
+
+    delays.sort()
+    return {
+        "mode": "pool" if use_pool else "inline",
+        "uploads": uploads,
+        "photo_kb": len(photo) // 1024,
+        "total_s": round(elapsed, 2),
+        "p50_ms": round(delays[len(delays) // 2] * 1000, 1),
+        "p99_ms": round(delays[int(len(delays) * 0.99)] * 1000, 1),
+        "max_ms": round(delays[-1] * 1000, 1),
+    }
+
+
+
+async def _benchmark_uploads(uploads: int):
+    from image_utils import shutdown_image_pool
+
+    print(await benchmark_upload_latency(uploads, use_pool=False))
+    print(await benchmark_upload_latency(uploads, use_pool=True))
+    shutdown_image_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности бота на временной базе")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    handlers = benchmarks.add_parser("handlers", help="задержка обработчиков: Database в event loop и AsyncDatabase")
+    handlers.add_argument("--users", type=int, default=200)
+    handlers.add_argument("--rounds", type=int, default=10)
+    handlers.add_argument("--products", type=int, default=50000)
+
+    queries = benchmarks.add_parser("queries", help="время запросов горячих путей с индексами и без")
+    queries.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+
+    checkout = benchmarks.add_parser("checkout", help="одновременные заказы одного товара")
+    checkout.add_argument("--customers", type=int, default=500)
+    checkout.add_argument("--stock", type=int, default=100)
+
+    uploads = benchmarks.add_parser("uploads", help="задержка покупателей при загрузке больших фото админами")
+    uploads.add_argument("--uploads", type=int, default=4)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            if args.benchmark == "handlers":
+                for use_async in (False, True):
+                    print(asyncio.run(benchmark_handler_latency(args.users, args.rounds, use_async, args.products)))
+            elif args.benchmark == "queries":
+                for rows in args.rows:
+                    print(rows, benchmark_query_times(rows))
+            elif args.benchmark == "checkout":
+                print(asyncio.run(benchmark_checkout_contention(args.customers, args.stock)))
+            elif args.benchmark == "uploads":
+                asyncio.run(_benchmark_uploads(args.uploads))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import time
+import asyncio
+import logging
+from typing import Dict, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from database import AsyncDatabase, db
+
+logger = logging.getLogger(__name__)
+
+# Telegram разрешает около 30 сообщений в секунду на бота; рассылке отдаём
+# меньше, чтобы ответы покупателям не упирались в общий лимит
+BROADCAST_RATE = 20
+# Не чаще одного сообщения в секунду в один чат (повторные попытки,
+# одновременные рассылки одному пользователю)
+PER_CHAT_INTERVAL = 1.0
+MAX_ATTEMPTS = 3
+# Сколько раз ждать флуд-контроль ради одного получателя, прежде чем признать отправку неудачной
+MAX_FLOOD_RETRIES = 5
+# Сколько чатов помнить для PER_CHAT_INTERVAL, прежде чем выбросить давно отправленные
+LAST_SENT_LIMIT = 10000
+
+
+class TokenBucket:
+    """Ограничитель скорости: в среднем rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу на seconds (ответ Telegram retry_after)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения всем зарегистрированным пользователям.
+    Получатели читаются из базы пачками, отправку выполняют несколько
+    воркеров через общий TokenBucket, результаты сохраняются пачками,
+    так что после перезапуска рассылка продолжается с неотправленных.
+    """
+
+    def __init__(self, db: AsyncDatabase, rate: float = BROADCAST_RATE, workers: int = 4,
+                 batch_size: int = 200, flush_interval: float = 1.0):
+        self.db = db
+        self.bucket = TokenBucket(rate, capacity=workers)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._tasks: Set[asyncio.Task] = set()
+        # user_id -> время последней отправки в этот чат (time.monotonic)
+        self._last_sent: Dict[int, float] = {}
+
+    async def start(self, bot: Bot, text: str, admin_chat_id: int) -> int:
+        broadcast_id = await self.db.create_broadcast(text, admin_chat_id)
+        self._spawn(bot, {"id": broadcast_id, "text": text, "admin_chat_id": admin_chat_id})
+        return broadcast_id
+
+    async def resume(self, bot: Bot):
+        """Продолжает рассылки, прерванные перезапуском бота"""
+        for broadcast in await self.db.get_running_broadcasts():
+            logger.info(f"Продолжаем рассылку #{broadcast['id']}")
+            self._spawn(bot, broadcast)
+
+    def _spawn(self, bot: Bot, broadcast: Dict):
+        task = asyncio.create_task(self._run(bot, broadcast))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, bot: Bot, broadcast: Dict):
+        broadcast_id = broadcast["id"]
+        recipients = asyncio.Queue(maxsize=self.batch_size)
+        results = []
+        done = asyncio.Event()
+
+        async def flush():
+            nonlocal results
+            if results:
+                chunk, results = results, []
+                await self.db.save_broadcast_results(broadcast_id, chunk)
+
+        async def producer():
+            after_user_id = 0
+            while True:
+                batch = await self.db.get_broadcast_recipients(broadcast_id, after_user_id, self.batch_size)
+                if not batch:
+                    break
+                for recipient in batch:
+                    await recipients.put(recipient)
+                after_user_id = batch[-1]["user_id"]
+            for _ in range(self.workers):
+                await recipients.put(None)
+
+        async def worker():
+            while True:
+                recipient = await recipients.get()
+                if recipient is None:
+                    return
+                status, attempts = await self._deliver(bot, recipient["user_id"], broadcast["text"],
+                                                       recipient["attempts"])
+                results.append((recipient["user_id"], status, attempts))
+                if len(results) >= self.batch_size:
+                    await flush()
+
+        async def saver():
+            while not done.is_set():
+                try:
+                    await asyncio.wait_for(done.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                await flush()
+
+        saver_task = asyncio.create_task(saver())
+        try:
+            await asyncio.gather(producer(), *(worker() for _ in range(self.workers)))
+        finally:
+            done.set()
+            await saver_task
+
+        stats = await self.db.finish_broadcast(broadcast_id)
+        logger.info(f"Рассылка #{broadcast_id} завершена: {stats}")
+
+        if broadcast.get("admin_chat_id"):
+            try:
+                await bot.send_message(
+                    broadcast["admin_chat_id"],
+                    f"📢 Рассылка #{broadcast_id} завершена\n\n"
+                    f"✅ Доставлено: {stats.get('sent', 0)}\n"
+                    f"🚫 Заблокировали бота: {stats.get('blocked', 0)}\n"
+                    f"❌ Ошибки: {stats.get('failed', 0)}"
+                )
+            except Exception as e:
+                logger.error(f"Не удалось отправить итог рассылки: {e}")
+
+    async def _wait_chat(self, user_id: int):
+        """Выдерживает PER_CHAT_INTERVAL с прошлой отправки в этот чат"""
+        now = time.monotonic()
+        last = self._last_sent.get(user_id)
+        if last is not None and now - last < PER_CHAT_INTERVAL:
+            await asyncio.sleep(last + PER_CHAT_INTERVAL - now)
+        if len(self._last_sent) >= LAST_SENT_LIMIT:
+            expired = time.monotonic() - PER_CHAT_INTERVAL
+            self._last_sent = {chat: sent for chat, sent in self._last_sent.items() if sent > expired}
+        self._last_sent[user_id] = time.monotonic()
+
+    async def _deliver(self, bot: Bot, user_id: int, text: str, attempts: int):
+        """
+        Отправляет сообщение одному получателю, возвращает (статус, число попыток).
+        Ответ флуд-контроля попыткой не считается: сообщение не отклонено,
+        Telegram лишь просит подождать. Но ждать ради одного получателя
+        можно не больше MAX_FLOOD_RETRIES раз, дальше он помечается failed
+        """
+        flood_retries = 0
+        while attempts < MAX_ATTEMPTS:
+            await self.bucket.acquire()
+            await self._wait_chat(user_id)
+            try:
+                await bot.send_message(user_id, text)
+                return "sent", attempts + 1
+            except TelegramRetryAfter as e:
+                # Флуд-контроль действует на весь бот - останавливаем всех воркеров
+                self.bucket.pause(e.retry_after)
+                flood_retries += 1
+                if flood_retries > MAX_FLOOD_RETRIES:
+                    logger.warning(f"Рассылка: пользователь {user_id} пропущен после {flood_retries} "
+                                   f"ответов флуд-контроля")
+                    return "failed", attempts + 1
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked", attempts + 1
+            except TelegramBadRequest as e:
+                logger.warning(f"Рассылка: пользователь {user_id} недоступен: {e}")
+                return "failed", attempts + 1
+            except Exception as e:
+                attempts += 1
+                logger.warning(f"Рассылка: ошибка отправки пользователю {user_id}: {e}")
+                await asyncio.sleep(PER_CHAT_INTERVAL * attempts)
+        return "failed", attempts
+
+
+broadcaster = Broadcaster(db)
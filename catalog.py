@@ -0,0 +1,246 @@
+import re
+import asyncio
+import bisect
+import heapq
+import logging
+from typing import List, Dict, Optional, Set, Tuple
+
+from database import AsyncDatabase, db
+
+logger = logging.getLogger(__name__)
+
+# Поля товара, от которых зависят клавиатуры и результаты поиска (остаток - нет)
+_VISIBLE_FIELDS = ("name", "price", "unit", "category_id", "image_ref")
+
+
+def _prefix_range(items: List[Tuple[str, int]], prefix: str) -> Tuple[int, int]:
+    """Границы пар, строка которых начинается с prefix, в отсортированном списке"""
+    low = bisect.bisect_left(items, (prefix,))
+    high = bisect.bisect_left(items, (prefix[:-1] + chr(ord(prefix[-1]) + 1),), low)
+    return low, high
+
+
+def normalize_name(text: str) -> str:
+    """Текст для поиска: нижний регистр, ё = е, одиночные пробелы"""
+    return " ".join(text.lower().replace("ё", "е").split())
+
+
+def normalize_words(text: str) -> Set[str]:
+    """Слова текста для поиска"""
+    return set(re.findall(r"\w+", normalize_name(text)))
+
+
+# Сколько пар сортировать одним вызовом: sorted() держит GIL до конца, и на
+# сотнях тысяч пар цикл событий в основном потоке стоит сотни миллисекунд
+_SORT_CHUNK = 20000
+
+
+def _sorted_pairs(pairs: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    """Сортирует пары частями и сливает их, отпуская GIL между частями"""
+    chunks = [sorted(pairs[start:start + _SORT_CHUNK]) for start in range(0, len(pairs), _SORT_CHUNK)]
+    if len(chunks) <= 1:
+        return chunks[0] if chunks else []
+    return list(heapq.merge(*chunks))
+
+
+def _build_snapshot(products: List[Dict]) -> Tuple[Dict[int, Dict], Dict[int, List[int]],
+                                                   List[Tuple[str, int]], List[Tuple[str, int]]]:
+    """Индексы снимка каталога: товары по id, id по категориям, слова и названия"""
+    by_category: Dict[int, List[int]] = {}
+    for product in products:
+        by_category.setdefault(product["category_id"], []).append(product["id"])
+    words = _sorted_pairs([(word, product["id"]) for product in products
+                           for word in normalize_words(product["name"])])
+    names = _sorted_pairs([(normalize_name(product["name"]), product["id"]) for product in products])
+    return {product["id"]: product for product in products}, by_category, words, names
+
+
+class Catalog:
+    """
+    Снимок каталога в памяти: категории и товары без изображений.
+    Просмотр каталога обслуживается отсюда без запросов к SQLite.
+    Любое изменение товаров админом увеличивает version и точечно
+    обновляет снимок, по version инвалидируются производные кэши.
+    """
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+        self.version = 0
+        self._categories: List[Dict] = []
+        self._products: Dict[int, Dict] = {}
+        # category_id -> отсортированный список id товаров
+        self._by_category: Dict[int, List[int]] = {}
+        # Отсортированные пары (слово названия, id товара) для поиска по началу слова
+        self._words: List[Tuple[str, int]] = []
+        # Отсортированные пары (название, id товара) для поиска по началу названия
+        self._names: List[Tuple[str, int]] = []
+
+    async def load(self):
+        """
+        Полностью перечитывает каталог из базы данных. Индексы строятся
+        в пуле потоков и подменяются разом, на цикле событий остаётся
+        только замена ссылок и смена version
+        """
+        categories = await self.db.get_categories()
+        products = await self.db.get_catalog_products()
+        loop = asyncio.get_running_loop()
+        snapshot = await loop.run_in_executor(None, _build_snapshot, products)
+
+        self._categories = categories
+        self._products, self._by_category, self._words, self._names = snapshot
+        self.version += 1
+        logger.info(f"Каталог загружен: {len(products)} товаров, версия {self.version}")
+
+    # === ЧТЕНИЕ ===
+    def get_categories(self) -> List[Dict]:
+        return self._categories
+
+    def get_products_by_category(self, category_id: int) -> List[Dict]:
+        return [self._products[product_id] for product_id in self._by_category.get(category_id, [])]
+
+    def get_products(self) -> List[Dict]:
+        """Все товары по возрастанию id"""
+        return [self._products[product_id] for product_id in sorted(self._products)]
+
+    def get_product(self, product_id: int) -> Optional[Dict]:
+        return self._products.get(product_id)
+
+    def get_product_ids(self, limit: int) -> List[int]:
+        """Первые limit id товаров по возрастанию"""
+        return heapq.nsmallest(limit, self._products)
+
+    def find_by_name(self, name: str) -> Optional[int]:
+        """id товара с таким названием (без учёта регистра), при повторах - наименьший"""
+        name = normalize_name(name)
+        index = bisect.bisect_left(self._names, (name,))
+        if index < len(self._names) and self._names[index][0] == name:
+            return self._names[index][1]
+        return None
+
+    def count_products(self, category_id: int) -> int:
+        return len(self._by_category.get(category_id, []))
+
+    def get_products_page(self, category_id: int, after_id: int = 0, limit: int = 10) -> Dict:
+        """
+        Страница товаров категории по курсору: товары с id > after_id по возрастанию id.
+        Курсоры соседних страниц находятся бинарным поиском, так что стоимость
+        не зависит от размера категории. prev_after / next_after - None, если страницы нет
+        """
+        ids = self._by_category.get(category_id, [])
+        start = bisect.bisect_right(ids, after_id)
+        end = start + limit
+
+        prev_after = None
+        if start > 0:
+            prev_start = max(0, start - limit)
+            prev_after = ids[prev_start - 1] if prev_start > 0 else 0
+
+        return {
+            "products": [self._products[product_id] for product_id in ids[start:end]],
+            "prev_after": prev_after,
+            "next_after": ids[end - 1] if end < len(ids) else None,
+            "page": start // limit + 1,
+            "pages": (len(ids) + limit - 1) // limit,
+        }
+
+    def search(self, query: str, limit: int = 50) -> List[int]:
+        """
+        id товаров, в названии которых есть слова, начинающиеся с каждого слова запроса.
+        Сначала товары, название которых начинается с запроса, затем по id
+        """
+        words = normalize_words(query)
+        if not words:
+            return []
+
+        # Диапазоны пар (слово, id) для каждого префикса; начинаем с самого узкого
+        ranges = []
+        for word in words:
+            low, high = _prefix_range(self._words, word)
+            if low == high:
+                return []
+            ranges.append((high - low, word, low, high))
+        ranges.sort()
+
+        found = None
+        for size, word, low, high in ranges:
+            if found is not None and size > len(found) * 8:
+                # Кандидатов намного меньше, чем пар в диапазоне, - проверяем их названия
+                found = {product_id for product_id in found
+                         if any(name_word.startswith(word)
+                                for name_word in normalize_words(self._products[product_id]["name"]))}
+            else:
+                ids = {product_id for _, product_id in self._words[low:high]}
+                found = ids if found is None else found & ids
+            if not found:
+                return []
+
+        # Названия, начинающиеся с запроса, - тоже диапазон в отсортированном списке
+        prefix = normalize_name(query)
+        low, high = _prefix_range(self._names, prefix)
+        if high - low > len(found) * 8:
+            first = sorted(product_id for product_id in found
+                           if normalize_name(self._products[product_id]["name"]).startswith(prefix))
+        else:
+            first = sorted(product_id for _, product_id in self._names[low:high] if product_id in found)
+        if len(first) >= limit:
+            return first[:limit]
+        return first + heapq.nsmallest(limit - len(first), found.difference(first))
+
+    # === ОБНОВЛЕНИЕ ПОСЛЕ ЗАПИСИ ===
+    async def refresh_product(self, product_id: int):
+        """Перечитывает один товар после добавления или изменения"""
+        await self.refresh_products([product_id])
+
+    async def refresh_products(self, product_ids):
+        """
+        Перечитывает товары одним запросом. Если у товара изменился только остаток,
+        version не меняется и кэши клавиатур и поиска остаются в силе
+        """
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        found = {product["id"]: product for product in await self.db.get_catalog_products(product_ids)}
+        for product_id in product_ids:
+            product = found.get(product_id)
+            if product is None:
+                self.remove_product(product_id)
+                continue
+
+            old = self._products.get(product_id)
+            if old is not None and all(old[field] == product[field] for field in _VISIBLE_FIELDS):
+                self._products[product_id] = product
+                continue
+
+            self._unindex(product_id)
+            self._products[product_id] = product
+            bisect.insort(self._by_category.setdefault(product["category_id"], []), product_id)
+            for word in normalize_words(product["name"]):
+                bisect.insort(self._words, (word, product_id))
+            bisect.insort(self._names, (normalize_name(product["name"]), product_id))
+            self.version += 1
+
+    def remove_product(self, product_id: int):
+        if self._unindex(product_id):
+            del self._products[product_id]
+            self.version += 1
+
+    def _unindex(self, product_id: int) -> bool:
+        old = self._products.get(product_id)
+        if not old:
+            return False
+        ids = self._by_category.get(old["category_id"], [])
+        index = bisect.bisect_left(ids, product_id)
+        if index < len(ids) and ids[index] == product_id:
+            del ids[index]
+        for word in normalize_words(old["name"]):
+            index = bisect.bisect_left(self._words, (word, product_id))
+            if index < len(self._words) and self._words[index] == (word, product_id):
+                del self._words[index]
+        name = (normalize_name(old["name"]), product_id)
+        index = bisect.bisect_left(self._names, name)
+        if index < len(self._names) and self._names[index] == name:
+            del self._names[index]
+        return True
+
+
+catalog = Catalog(db)
@@ -1,18 +1,142 @@
+import re
+import csv
 import sqlite3
+import asyncio
 import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
 from typing import List, Dict, Optional
 
+from image_store import ImageStore
+
 logger = logging.getLogger(__name__)
 
+# Настройки каждого соединения: WAL позволяет читателям не ждать писателя,
+# synchronous=NORMAL в режиме WAL делает fsync только при checkpoint
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Размер кэша подготовленных выражений на соединение
+STATEMENT_CACHE_SIZE = 256
+
+# Колонки CSV-выгрузки товаров
+PRODUCT_CSV_COLUMNS = ("id", "name", "price", "quantity", "unit", "category")
+
+# Какой вариант изображения отправлять в карточке товара (по убыванию предпочтения)
+SEND_VARIANT_ORDER = ("card", "full", "thumb")
+
+# Сколько последних записей хранит журнал изменений товаров
+PRODUCT_CHANGES_KEEP = 10000
+
+
+def _fold_yo(column: str) -> str:
+    """SQL-выражение: текст столбца с ё, заменённой на е (lower в SQLite знает только ASCII)"""
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def make_fts_query(text: str) -> str:
+    """
+    Запрос пользователя -> выражение FTS5: все слова как префиксы, без операторов FTS.
+    ё заменяется на е, как и в проиндексированных названиях
+    """
+    words = re.findall(r"\w+", text.lower().replace("ё", "е"))
+    return " ".join(f'"{word}"*' for word in words[:8])
+
+
+class InsufficientStockError(Exception):
+    """Недостаточно товара для оформления заказа"""
+
+    def __init__(self, shortages: List[Dict]):
+        # [{"id", "name", "requested", "available"}, ...]
+        self.shortages = shortages
+        super().__init__(f"Недостаточно товара: {[item['id'] for item in shortages]}")
+
 
 class Database:
-    def __init__(self, db_name="shop_bot.db"):
+    def __init__(self, db_name="shop_bot.db", pool_size: int = 4, images_dir="images"):
+        """
+        pool_size - число долгоживущих соединений в пуле.
+        При pool_size=0 соединение открывается и закрывается на каждый вызов.
+        images_dir - каталог хранилища изображений товаров.
+        """
         self.db_name = db_name
+        self.images = ImageStore(images_dir)
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._pool_lock = threading.Lock()
         self.init_db()
 
     def init_db(self):
-        conn = sqlite3.connect(self.db_name)
+        conn = self.get_connection()
+        conn.execute("PRAGMA journal_mode = WAL")
+        # Транзакциями миграций управляем вручную
+        conn.isolation_level = None
+        try:
+            self._migrate(conn)
+        finally:
+            conn.close()
+        logger.info("База данных инициализирована")
+
+    # === МИГРАЦИИ СХЕМЫ ===
+    def _migrations(self):
+        """
+        Миграции по порядку. Версия схемы = номер последней применённой
+        миграции и хранится в PRAGMA user_version. Новые миграции
+        добавляются только в конец списка.
+        """
+        return [
+            self._migration_initial_schema,
+            self._migration_image_store,
+            self._migration_photo_file_ids,
+            self._migration_hot_path_indexes,
+            self._migration_fsm_storage,
+            self._migration_broadcasts,
+            self._migration_catalog_version,
+            self._migration_product_images,
+            self._migration_product_search,
+            self._migration_sales_rollups,
+            self._migration_product_changes,
+            self._migration_cart_changes,
+            self._migration_search_yo,
+            self._migration_image_ref_indexes,
+        ]
+
+    def _migrate(self, conn):
+        migrations = self._migrations()
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+
+        for version, migration in enumerate(migrations, start=1):
+            if version <= current:
+                continue
+
+            # Каждая миграция и новый номер версии фиксируются одной транзакцией
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Другой процесс мог применить миграцию, пока мы ждали блокировку
+                current = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version <= current:
+                    conn.execute('COMMIT')
+                    continue
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            current = version
+            logger.info(f"Применена миграция схемы {version}: {migration.__name__}")
+
+    def _migration_initial_schema(self, conn):
         cursor = conn.cursor()
 
         # Таблица пользователей
@@ -44,6 +168,7 @@ class Database:
                 unit TEXT NOT NULL,
                 category_id INTEGER,
                 image BLOB,
+                image_ref TEXT,
                 FOREIGN KEY (category_id) REFERENCES categories (id)
             )
         ''')
@@ -99,155 +224,1210 @@ class Database:
             INSERT OR IGNORE INTO categories (name, emoji) VALUES (?, ?)
         ''', default_categories)
 
-        conn.commit()
-        conn.close()
-        logger.info("База данных инициализирована")
+    def _migration_image_store(self, conn):
+        """Переносит BLOB-изображения из products.image в файловое хранилище"""
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(products)')]
+        if "image_ref" not in columns:
+            conn.execute('ALTER TABLE products ADD COLUMN image_ref TEXT')
+
+        migrated = 0
+        last_id = 0
+        # По одной строке, чтобы не держать в памяти все изображения сразу
+        while True:
+            row = conn.execute('''
+                SELECT id, image FROM products
+                WHERE id > ? AND image IS NOT NULL
+                ORDER BY id LIMIT 1
+            ''', (last_id,)).fetchone()
+            if not row:
+                break
+            last_id = row[0]
+            ref = self.images.put(row[1])
+            conn.execute('UPDATE products SET image_ref = ?, image = NULL WHERE id = ?', (ref, last_id))
+            migrated += 1
+
+        if migrated:
+            logger.info(f"Перенесено изображений в хранилище: {migrated}")
+
+    def _migration_photo_file_ids(self, conn):
+        # Кэш file_id Telegram для загруженных фото (ключ - ссылка на изображение)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS photo_file_ids (
+                image_ref TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        ''')
+
+    def _migration_hot_path_indexes(self, conn):
+        # carts WHERE user_id = ? уже обслуживается первичным ключом (user_id, product_id)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_products_category ON products (category_id, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_carts_product ON carts (product_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id, product_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)')
+        conn.execute('ANALYZE')
+
+    def _migration_fsm_storage(self, conn):
+        # Состояния FSM и данные диалогов (см. storage.SQLiteStorage)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+    def _migration_broadcasts(self, conn):
+        # Рассылки и их получатели; статус получателя сохраняется пачками,
+        # поэтому прерванная рассылка продолжается с места остановки
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT NOT NULL,
+                admin_chat_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'running',
+                total INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                finished_at TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (broadcast_id, user_id),
+                FOREIGN KEY (broadcast_id) REFERENCES broadcasts (id)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status
+            ON broadcast_recipients (broadcast_id, status, user_id)
+        ''')
+
+    def _migration_catalog_version(self, conn):
+        # Счётчик изменений каталога. Триггеры увеличивают его при любой записи
+        # в products и categories, так что процессы-воркеры замечают изменения,
+        # сделанные другими процессами, одним дешёвым запросом
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS catalog_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)')
+        for table in ("products", "categories"):
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+                    END
+                ''')
+
+    def _migration_product_images(self, conn):
+        # Варианты размеров изображения товара; products.image_ref указывает
+        # на вариант, который отправляется в карточке товара
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS product_images (
+                product_id INTEGER NOT NULL,
+                variant TEXT NOT NULL,
+                image_ref TEXT NOT NULL,
+                PRIMARY KEY (product_id, variant)
+            ) WITHOUT ROWID
+        ''')
+        # Загруженные раньше изображения - единственный (полный) вариант
+        conn.execute('''
+            INSERT OR IGNORE INTO product_images (product_id, variant, image_ref)
+            SELECT id, 'full', image_ref FROM products WHERE image_ref IS NOT NULL
+        ''')
+
+    def _migration_product_search(self, conn):
+        # Полнотекстовый индекс по названиям товаров (external content:
+        # текст хранится только в products, индекс синхронизируют триггеры).
+        # prefix ускоряет поиск по началу слова из 2 и 3 символов
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                name,
+                content='products',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_products_fts_insert AFTER INSERT ON products
+            BEGIN
+                INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_products_fts_delete AFTER DELETE ON products
+            BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_products_fts_update AFTER UPDATE OF name ON products
+            BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                INSERT INTO products_fts (rowid, name) VALUES (new.id, new.name);
+            END
+        ''')
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+    def _migration_sales_rollups(self, conn):
+        # Продажи, агрегированные по дням: отчёт за любой период читает
+        # по строке на день (и товар / категорию), а не всю историю заказов.
+        # Пополняются в create_order той же транзакцией, что и сам заказ
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sales_daily (
+                day TEXT PRIMARY KEY,
+                orders INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                revenue REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sales_daily_products (
+                day TEXT NOT NULL,
+                product_id INTEGER NOT NULL,
+                category_id INTEGER,
+                orders INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                revenue REAL NOT NULL,
+                PRIMARY KEY (day, product_id)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS sales_daily_categories (
+                day TEXT NOT NULL,
+                category_id INTEGER NOT NULL,
+                orders INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                revenue REAL NOT NULL,
+                PRIMARY KEY (day, category_id)
+            ) WITHOUT ROWID
+        ''')
+
+        # Заполняем по уже оформленным заказам; день - дата из created_at
+        conn.execute('''
+            INSERT OR IGNORE INTO sales_daily (day, orders, quantity, revenue)
+            SELECT substr(o.created_at, 1, 10), COUNT(DISTINCT o.id),
+                   COALESCE(SUM(oi.quantity), 0), COALESCE(SUM(oi.quantity * oi.price), 0)
+            FROM orders o
+            LEFT JOIN order_items oi ON oi.order_id = o.id
+            GROUP BY substr(o.created_at, 1, 10)
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO sales_daily_products (day, product_id, category_id, orders, quantity, revenue)
+            SELECT substr(o.created_at, 1, 10), oi.product_id, p.category_id, COUNT(DISTINCT o.id),
+                   SUM(oi.quantity), SUM(oi.quantity * oi.price)
+            FROM orders o
+            JOIN order_items oi ON oi.order_id = o.id
+            LEFT JOIN products p ON p.id = oi.product_id
+            GROUP BY substr(o.created_at, 1, 10), oi.product_id
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO sales_daily_categories (day, category_id, orders, quantity, revenue)
+            SELECT substr(o.created_at, 1, 10), p.category_id, COUNT(DISTINCT o.id),
+                   SUM(oi.quantity), SUM(oi.quantity * oi.price)
+            FROM orders o
+            JOIN order_items oi ON oi.order_id = o.id
+            JOIN products p ON p.id = oi.product_id
+            GROUP BY substr(o.created_at, 1, 10), p.category_id
+        ''')
+
+    def _migration_product_changes(self, conn):
+        # Списание остатков при каждом заказе не должно сбрасывать весь каталог
+        # в воркерах: версию каталога меняют только видимые покупателю поля,
+        # а изменения остатков пишутся в журнал, который воркеры читают по курсору
+        conn.execute('DROP TRIGGER IF EXISTS trg_products_update_version')
+        conn.execute('''
+            CREATE TRIGGER trg_products_update_version
+            AFTER UPDATE OF name, price, unit, category_id, image_ref ON products
+            BEGIN
+                UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+            END
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS product_changes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_products_quantity_change
+            AFTER UPDATE OF quantity ON products
+            WHEN new.quantity IS NOT old.quantity
+            BEGIN
+                INSERT INTO product_changes (product_id) VALUES (new.id);
+            END
+        ''')
+        # Журнал сам удаляет старые записи: раз в 1000 вставок оставляет последние PRODUCT_CHANGES_KEEP
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_product_changes_prune
+            AFTER INSERT ON product_changes
+            WHEN new.id % 1000 = 0
+            BEGIN
+                DELETE FROM product_changes WHERE id <= new.id - {PRODUCT_CHANGES_KEEP};
+            END
+        ''')
+
+    def _migration_cart_changes(self, conn):
+        # Резервы корзин общие для всех воркеров: запись в корзину любого
+        # процесса попадает в журнал изменений товаров, и воркеры перечитывают
+        # суммарный резерв только этого товара
+        for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_carts_{event.lower()}_change
+                AFTER {event} ON carts
+                BEGIN
+                    INSERT INTO product_changes (product_id) VALUES ({row}.product_id);
+                END
+            ''')
+
+    def _migration_search_yo(self, conn):
+        # unicode61 не приравнивает ё к е, поэтому индексируется название с ё,
+        # заменённой на е: источник external content - представление над products,
+        # триггеры пишут в индекс то же выражение (make_fts_query заменяет ё в запросе)
+        for trigger in ("insert", "delete", "update"):
+            conn.execute(f'DROP TRIGGER IF EXISTS trg_products_fts_{trigger}')
+        conn.execute('DROP TABLE IF EXISTS products_fts')
+        conn.execute(f'''
+            CREATE VIEW IF NOT EXISTS products_search AS
+            SELECT id, {_fold_yo("name")} AS name FROM products
+        ''')
+        conn.execute('''
+            CREATE VIRTUAL TABLE products_fts USING fts5(
+                name,
+                content='products_search',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER trg_products_fts_insert AFTER INSERT ON products
+            BEGIN
+                INSERT INTO products_fts (rowid, name) VALUES (new.id, {_fold_yo("new.name")});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER trg_products_fts_delete AFTER DELETE ON products
+            BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name)
+                VALUES ('delete', old.id, {_fold_yo("old.name")});
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER trg_products_fts_update AFTER UPDATE OF name ON products
+            BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name)
+                VALUES ('delete', old.id, {_fold_yo("old.name")});
+                INSERT INTO products_fts (rowid, name) VALUES (new.id, {_fold_yo("new.name")});
+            END
+        ''')
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+    def _migration_image_ref_indexes(self, conn):
+        # Подсчёт ссылок на файл хранилища при замене фото и удалении товара
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_product_images_ref ON product_images (image_ref)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_products_image_ref ON products (image_ref)')
 
     def get_connection(self):
-        return sqlite3.connect(self.db_name)
+        """Открывает новое настроенное соединение (закрывает вызывающий)"""
+        conn = sqlite3.connect(
+            self.db_name,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        if self.pool_size <= 0:
+            return self.get_connection()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._pool_lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                return self.get_connection()
+        return self._pool.get()
+
+    def _release(self, conn):
+        if self.pool_size <= 0:
+            conn.close()
+        else:
+            self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Выдаёт соединение из пула на время блока.
+        При успешном выходе фиксирует транзакцию, при ошибке - откатывает.
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def close(self):
+        """Закрывает все соединения пула"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._pool_lock:
+            self._created = 0
 
     # === USER METHODS ===
     def get_user(self, user_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, name, phone FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        conn.close()
-        if user:
-            return {"user_id": user[0], "name": user[1], "phone": user[2]}
-        return None
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, name, phone FROM users WHERE user_id = ?', (user_id,))
+            user = cursor.fetchone()
+            if user:
+                return {"user_id": user[0], "name": user[1], "phone": user[2]}
+            return None
 
     def add_user(self, user_id: int, name: str, phone: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, name, phone, registered_at) 
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, name, phone, datetime.now().isoformat()))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO users (user_id, name, phone, registered_at) 
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, name, phone, datetime.now().isoformat()))
 
     # === CATEGORY METHODS ===
     def get_categories(self) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, name, emoji FROM categories')
-        categories = cursor.fetchall()
-        conn.close()
-        return [{"id": cat[0], "name": f"{cat[1]} {cat[2]}", "raw_name": cat[1]} for cat in categories]
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, name, emoji FROM categories')
+            categories = cursor.fetchall()
+            return [{"id": cat[0], "name": f"{cat[1]} {cat[2]}", "raw_name": cat[1]} for cat in categories]
 
     # === PRODUCT METHODS ===
     def get_products_by_category(self, category_id: int) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, name, price, quantity, unit, image 
-            FROM products WHERE category_id = ?
-        ''', (category_id,))
-        products = cursor.fetchall()
-        conn.close()
-        return [{"id": p[0], "name": p[1], "price": p[2], "quantity": p[3], "unit": p[4], "image": p[5]} for p in
-                products]
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, name, price, quantity, unit, image_ref
+                FROM products WHERE category_id = ?
+            ''', (category_id,))
+            products = cursor.fetchall()
+            return [{"id": p[0], "name": p[1], "price": p[2], "quantity": p[3], "unit": p[4], "image_ref": p[5]}
+                    for p in products]
 
     def get_product(self, product_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, name, price, quantity, unit, image FROM products WHERE id = ?', (product_id,))
-        product = cursor.fetchone()
-        conn.close()
-        if product:
-            return {"id": product[0], "name": product[1], "price": product[2], "quantity": product[3],
-                    "unit": product[4], "image": product[5]}
-        return None
-
-    def add_product(self, name: str, price: float, quantity: int, category_id: int, image_data: bytes = None) -> int:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO products (name, price, quantity, unit, category_id, image)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (name, price, quantity, "кг", category_id, image_data))
-        product_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return product_id
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, name, price, quantity, unit, image_ref, category_id
+                FROM products WHERE id = ?
+            ''', (product_id,))
+            product = cursor.fetchone()
+            if product:
+                return {"id": product[0], "name": product[1], "price": product[2], "quantity": product[3],
+                        "unit": product[4], "image_ref": product[5], "category_id": product[6]}
+            return None
+
+    def get_catalog_products(self, product_ids: List[int] = None) -> List[Dict]:
+        """Товары без изображений для снимка каталога в памяти: все или только product_ids"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            if product_ids is None:
+                cursor.execute('''
+                    SELECT id, name, price, quantity, unit, image_ref, category_id
+                    FROM products ORDER BY id
+                ''')
+            else:
+                placeholders = ", ".join("?" * len(product_ids))
+                cursor.execute(f'''
+                    SELECT id, name, price, quantity, unit, image_ref, category_id
+                    FROM products WHERE id IN ({placeholders})
+                ''', list(product_ids))
+            products = cursor.fetchall()
+            return [{"id": p[0], "name": p[1], "price": p[2], "quantity": p[3], "unit": p[4],
+                     "image_ref": p[5], "category_id": p[6]} for p in products]
+
+    def add_product(self, name: str, price: float, quantity: int, category_id: int, image_data: bytes = None,
+                    image_variants: Dict[str, bytes] = None) -> int:
+        """image_variants - варианты размеров {имя: байты}; image_data - одно изображение без вариантов"""
+        refs = self._put_image_variants(image_variants or ({"full": image_data} if image_data else {}))
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO products (name, price, quantity, unit, category_id, image_ref)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (name, price, quantity, "кг", category_id, self._send_ref(refs)))
+            product_id = cursor.lastrowid
+            self._link_image_variants(cursor, product_id, refs)
+            return product_id
 
     def delete_product(self, product_id: int) -> bool:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
-        affected = cursor.rowcount
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            old_refs = self._product_image_refs(cursor, product_id)
+            cursor.execute('DELETE FROM products WHERE id = ?', (product_id,))
+            affected = cursor.rowcount
+            cursor.execute('DELETE FROM product_images WHERE product_id = ?', (product_id,))
+            unused = self._drop_unused_image_refs(cursor, old_refs)
+        self._delete_image_files(unused)
         return affected > 0
 
-    def get_all_products(self) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def update_product_field(self, product_id: int, field: str, value):
+        """Обновляет конкретное поле товара в базе данных"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+
+            if value is None:
+                cursor.execute(f'UPDATE products SET {field} = NULL WHERE id = ?', (product_id,))
+            else:
+                cursor.execute(f'UPDATE products SET {field} = ? WHERE id = ?', (value, product_id))
+
+    def set_product_image(self, product_id: int, image_data: Optional[bytes]) -> Optional[str]:
+        """Сохраняет одно изображение без вариантов. None - удалить фото"""
+        return self.set_product_images(product_id, {"full": image_data} if image_data else {})
+
+    def set_product_images(self, product_id: int, image_variants: Dict[str, bytes]) -> Optional[str]:
+        """
+        Заменяет изображения товара вариантами {имя: байты}, пустой словарь - удалить фото.
+        Возвращает ссылку на вариант, который отправляется в карточке товара
+        """
+        refs = self._put_image_variants(image_variants)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            old_refs = self._product_image_refs(cursor, product_id)
+            cursor.execute('DELETE FROM product_images WHERE product_id = ?', (product_id,))
+            self._link_image_variants(cursor, product_id, refs)
+            image_ref = self._send_ref(refs)
+            cursor.execute('UPDATE products SET image_ref = ? WHERE id = ?', (image_ref, product_id))
+            unused = self._drop_unused_image_refs(cursor, old_refs - set(refs.values()))
+        self._delete_image_files(unused)
+        return image_ref
+
+    def get_product_images(self, product_id: int) -> Dict[str, str]:
+        """Варианты изображения товара: {имя варианта: ссылка в хранилище}"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT variant, image_ref FROM product_images WHERE product_id = ?', (product_id,))
+            return dict(cursor.fetchall())
+
+    def _put_image_variants(self, image_variants: Dict[str, bytes]) -> Dict[str, str]:
+        # Файлы пишутся до транзакции, чтобы не держать блокировку записи на время диска
+        return {variant: self.images.put(data) for variant, data in image_variants.items()}
+
+    @staticmethod
+    def _send_ref(refs: Dict[str, str]) -> Optional[str]:
+        return next((refs[variant] for variant in SEND_VARIANT_ORDER if variant in refs), None)
+
+    @staticmethod
+    def _link_image_variants(cursor, product_id: int, refs: Dict[str, str]):
+        cursor.executemany('''
+            INSERT INTO product_images (product_id, variant, image_ref) VALUES (?, ?, ?)
+        ''', [(product_id, variant, image_ref) for variant, image_ref in refs.items()])
+
+    @staticmethod
+    def _product_image_refs(cursor, product_id: int) -> set:
+        """Все ссылки на файлы хранилища, которые использует товар"""
         cursor.execute('''
-            SELECT p.id, p.name, p.price, p.quantity, p.unit, c.name 
-            FROM products p 
-            JOIN categories c ON p.category_id = c.id
-        ''')
-        products = cursor.fetchall()
-        conn.close()
-        return [{"id": p[0], "name": p[1], "price": p[2], "quantity": p[3], "unit": p[4], "category": p[5]} for p in
-                products]
+            SELECT image_ref FROM product_images WHERE product_id = ?
+            UNION SELECT image_ref FROM products WHERE id = ? AND image_ref IS NOT NULL
+        ''', (product_id, product_id))
+        return {row[0] for row in cursor.fetchall()}
+
+    @staticmethod
+    def _drop_unused_image_refs(cursor, refs) -> List[str]:
+        """
+        Ссылки из refs, на которые больше не ссылается ни один товар.
+        Их file_id в Telegram удаляются той же транзакцией, файлы удаляет
+        вызывающий после фиксации (_delete_image_files)
+        """
+        unused = []
+        for ref in refs:
+            cursor.execute('''
+                SELECT EXISTS (SELECT 1 FROM product_images WHERE image_ref = ?)
+                    OR EXISTS (SELECT 1 FROM products WHERE image_ref = ?)
+            ''', (ref, ref))
+            if not cursor.fetchone()[0]:
+                unused.append(ref)
+        cursor.executemany('DELETE FROM photo_file_ids WHERE image_ref = ?', [(ref,) for ref in unused])
+        return unused
+
+    def _delete_image_files(self, refs: List[str]):
+        for ref in refs:
+            self.images.delete(ref)
+
+    def get_all_products(self, after_id: int = 0, limit: int = None, before_id: int = None) -> List[Dict]:
+        """
+        Товары с категориями по возрастанию id, страницами по курсору:
+        id > after_id, либо (если задан before_id) последние limit товаров с id < before_id
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            if before_id is not None:
+                cursor.execute('''
+                    SELECT p.id, p.name, p.price, p.quantity, p.unit, c.name
+                    FROM products p
+                    JOIN categories c ON p.category_id = c.id
+                    WHERE p.id < ?
+                    ORDER BY p.id DESC LIMIT ?
+                ''', (before_id, limit if limit is not None else -1))
+                products = cursor.fetchall()[::-1]
+            else:
+                cursor.execute('''
+                    SELECT p.id, p.name, p.price, p.quantity, p.unit, c.name
+                    FROM products p
+                    JOIN categories c ON p.category_id = c.id
+                    WHERE p.id > ?
+                    ORDER BY p.id LIMIT ?
+                ''', (after_id, limit if limit is not None else -1))
+                products = cursor.fetchall()
+            return [{"id": p[0], "name": p[1], "price": p[2], "quantity": p[3], "unit": p[4], "category": p[5]} for p in
+                    products]
+
+    def export_products_csv(self, path: str, batch_size: int = 1000) -> int:
+        """
+        Выгружает все товары в CSV-файл (разделитель ";", UTF-8 с BOM для Excel).
+        Строки читаются пачками по batch_size, так что память не зависит от размера каталога.
+        Возвращает количество выгруженных товаров
+        """
+        count = 0
+        with self.connection() as conn, open(path, "w", newline="", encoding="utf-8-sig") as file:
+            writer = csv.writer(file, delimiter=";")
+            writer.writerow(PRODUCT_CSV_COLUMNS)
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT p.id, p.name, p.price, p.quantity, p.unit, c.name
+                FROM products p
+                JOIN categories c ON p.category_id = c.id
+                ORDER BY p.id
+            ''')
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                count += len(rows)
+        return count
+
+    def upsert_products(self, updates: List[tuple], inserts: List[tuple]) -> List[int]:
+        """
+        Пакетная запись товаров одной транзакцией.
+        updates: (name, price, quantity, unit, category_id, id)
+        inserts: (name, price, quantity, unit, category_id)
+        Возвращает id добавленных товаров в порядке inserts
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            if updates:
+                cursor.executemany('''
+                    UPDATE products SET name = ?, price = ?, quantity = ?, unit = ?, category_id = ?
+                    WHERE id = ?
+                ''', updates)
+            if not inserts:
+                return []
+
+            # executemany не возвращает lastrowid, поэтому id выдаются заранее
+            # под блокировкой записи; AUTOINCREMENT не переиспользует id удалённых товаров
+            cursor.execute('''
+                SELECT MAX(COALESCE((SELECT MAX(id) FROM products), 0),
+                           COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'products'), 0))
+            ''')
+            first_id = cursor.fetchone()[0] + 1
+            product_ids = list(range(first_id, first_id + len(inserts)))
+            cursor.executemany('''
+                INSERT INTO products (id, name, price, quantity, unit, category_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [(product_id, *row) for product_id, row in zip(product_ids, inserts)])
+            return product_ids
+
+    def bulk_update_products(self, changes: List[tuple], adjustments: List[tuple] = ()) -> Dict[str, int]:
+        """
+        Массовое изменение цен и остатков одной транзакцией.
+        adjustments: (множитель цены, category_id) - применяются первыми
+        changes: (price или None, quantity или None, id) - None оставляет поле без изменений
+        Возвращает количество изменённых товаров {"adjusted": .., "changed": ..}
+        """
+        result = {"adjusted": 0, "changed": 0}
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            if adjustments:
+                cursor.executemany(
+                    'UPDATE products SET price = ROUND(price * ?, 2) WHERE category_id = ?', adjustments)
+                result["adjusted"] = cursor.rowcount
+            if changes:
+                cursor.executemany('''
+                    UPDATE products SET price = COALESCE(?, price), quantity = COALESCE(?, quantity)
+                    WHERE id = ?
+                ''', changes)
+                result["changed"] = cursor.rowcount
+        return result
+
+    def search_products(self, query: str, offset: int = 0, limit: int = 10) -> List[Dict]:
+        """
+        Поиск товаров по названию: каждое слово запроса ищется как начало слова,
+        результаты упорядочены по релевантности (bm25)
+        """
+        match = make_fts_query(query)
+        if not match:
+            return []
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # Ранжирует сам FTS5 (rank = bm25): страница выбирается уже после
+            # сортировки всех совпадений, поэтому лучшие не теряются и страницы
+            # не пересекаются
+            cursor.execute('''
+                SELECT p.id, p.name, p.price, p.unit
+                FROM (
+                    SELECT rowid, rank
+                    FROM products_fts WHERE products_fts MATCH ?
+                    ORDER BY rank, rowid
+                    LIMIT ? OFFSET ?
+                ) f
+                JOIN products p ON p.id = f.rowid
+                ORDER BY f.rank, p.id
+            ''', (match, limit, offset))
+            return [{"id": p[0], "name": p[1], "price": p[2], "unit": p[3]} for p in cursor.fetchall()]
+
+    def get_product_image_refs(self) -> List[str]:
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT DISTINCT image_ref FROM products WHERE image_ref IS NOT NULL')
+            return [row[0] for row in cursor.fetchall()]
+
+    def get_catalog_version(self) -> int:
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT version FROM catalog_version WHERE id = 1')
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+    def get_last_product_change(self) -> int:
+        """Курсор конца журнала изменений товаров"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM product_changes')
+            return cursor.fetchone()[0]
+
+    def get_product_changes(self, after_id: int, limit: int = 1000) -> List[tuple]:
+        """Записи журнала (id, product_id) после курсора after_id"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'SELECT id, product_id FROM product_changes WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit))
+            return cursor.fetchall()
+
+    # === PHOTO FILE_ID METHODS ===
+    def get_photo_file_ids(self) -> Dict[str, str]:
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT image_ref, file_id FROM photo_file_ids')
+            return dict(cursor.fetchall())
+
+    def set_photo_file_id(self, image_ref: str, file_id: str):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO photo_file_ids (image_ref, file_id, created_at)
+                VALUES (?, ?, ?)
+            ''', (image_ref, file_id, datetime.now().isoformat()))
+
+    def delete_photo_file_id(self, image_ref: str):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM photo_file_ids WHERE image_ref = ?', (image_ref,))
 
     # === CART METHODS ===
     def get_user_cart(self, user_id: int) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT p.id, p.name, p.price, p.unit, c.quantity 
-            FROM carts c 
-            JOIN products p ON c.product_id = p.id 
-            WHERE c.user_id = ?
-        ''', (user_id,))
-        cart_items = cursor.fetchall()
-        conn.close()
-        return [{"id": item[0], "name": item[1], "price": item[2], "unit": item[3], "quantity": item[4]} for item in
-                cart_items]
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT p.id, p.name, p.price, p.unit, c.quantity 
+                FROM carts c 
+                JOIN products p ON c.product_id = p.id 
+                WHERE c.user_id = ?
+            ''', (user_id,))
+            cart_items = cursor.fetchall()
+            return [{"id": item[0], "name": item[1], "price": item[2], "unit": item[3], "quantity": item[4]} for item in
+                    cart_items]
+
+    def get_cart_holds(self) -> List[Dict]:
+        """Все позиции всех корзин - для учёта отложенного товара"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user_id, product_id, quantity FROM carts')
+            return [{"user_id": row[0], "product_id": row[1], "quantity": row[2]} for row in cursor.fetchall()]
 
     def add_to_cart(self, user_id: int, product_id: int, quantity: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO carts (user_id, product_id, quantity) 
-            VALUES (?, ?, ?)
-        ''', (user_id, product_id, quantity))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO carts (user_id, product_id, quantity) 
+                VALUES (?, ?, ?)
+            ''', (user_id, product_id, quantity))
+
+    def get_cart_held(self, product_ids: List[int]) -> Dict[int, int]:
+        """Сколько товара отложено во всех корзинах: {product_id: количество}"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            placeholders = ", ".join("?" * len(product_ids))
+            cursor.execute(f'''
+                SELECT product_id, SUM(quantity) FROM carts
+                WHERE product_id IN ({placeholders}) GROUP BY product_id
+            ''', list(product_ids))
+            return dict(cursor.fetchall())
+
+    def reserve_cart_item(self, user_id: int, product_id: int, quantity: int) -> int:
+        """
+        Кладёт товар в корзину, только если его хватает с учётом корзин всех
+        пользователей (в том числе обслуживаемых другими процессами).
+        Возвращает доступное пользователю количество; если оно меньше quantity,
+        корзина не меняется.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT p.quantity - COALESCE((SELECT SUM(c.quantity) FROM carts c
+                                              WHERE c.product_id = p.id AND c.user_id != ?), 0)
+                FROM products p WHERE p.id = ?
+            ''', (user_id, product_id))
+            row = cursor.fetchone()
+            available = max(0, row[0]) if row else 0
+            if quantity <= available:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO carts (user_id, product_id, quantity)
+                    VALUES (?, ?, ?)
+                ''', (user_id, product_id, quantity))
+            return available
 
     def clear_cart(self, user_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM carts WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM carts WHERE user_id = ?', (user_id,))
 
     # === ORDER METHODS ===
     def create_order(self, user_id: int, total_amount: float, delivery_date: str,
                      delivery_time: str, delivery_address: str, cart_items: List[Dict]) -> int:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """
+        Оформляет заказ одной транзакцией: проверяет и списывает остатки,
+        сохраняет заказ и очищает корзину. При нехватке товара ничего
+        не меняет и выбрасывает InsufficientStockError.
+        """
+        requested: Dict[int, int] = {}
+        for item in cart_items:
+            requested[item["id"]] = requested.get(item["id"], 0) + item["quantity"]
 
-        cursor.execute('''
-            INSERT INTO orders (user_id, total_amount, delivery_date, delivery_time, delivery_address, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, total_amount, delivery_date, delivery_time, delivery_address, datetime.now().isoformat()))
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # Блокировку записи берём сразу, чтобы параллельные заказы
+            # не продали один и тот же остаток дважды
+            cursor.execute('BEGIN IMMEDIATE')
 
-        order_id = cursor.lastrowid
+            # product_id -> category_id для агрегатов продаж
+            categories: Dict[int, int] = {}
+            if requested:
+                placeholders = ", ".join("?" * len(requested))
+                cursor.execute(f'SELECT id, name, quantity, category_id FROM products WHERE id IN ({placeholders})',
+                               list(requested))
+                rows = cursor.fetchall()
+                stock = {row[0]: (row[1], row[2]) for row in rows}
+                categories.update((row[0], row[3]) for row in rows)
 
-        for item in cart_items:
+                shortages = []
+                for product_id, quantity in requested.items():
+                    name, available = stock.get(product_id, (None, 0))
+                    if available < quantity:
+                        shortages.append({"id": product_id, "name": name,
+                                          "requested": quantity, "available": available})
+                if shortages:
+                    raise InsufficientStockError(shortages)
+
+                cursor.executemany(
+                    'UPDATE products SET quantity = quantity - ? WHERE id = ? AND quantity >= ?',
+                    [(quantity, product_id, quantity) for product_id, quantity in requested.items()]
+                )
+
+            created_at = datetime.now().isoformat()
             cursor.execute('''
+                INSERT INTO orders (user_id, total_amount, delivery_date, delivery_time, delivery_address, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, total_amount, delivery_date, delivery_time, delivery_address, created_at))
+
+            order_id = cursor.lastrowid
+
+            cursor.executemany('''
                 INSERT INTO order_items (order_id, product_id, quantity, price)
                 VALUES (?, ?, ?, ?)
-            ''', (order_id, item["id"], item["quantity"], item["price"]))
+            ''', [(order_id, item["id"], item["quantity"], item["price"]) for item in cart_items])
+
+            self._add_sales(cursor, created_at[:10], cart_items, categories)
+
+            # Очищаем корзину
+            cursor.execute('DELETE FROM carts WHERE user_id = ?', (user_id,))
+
+            return order_id
+
+    def _add_sales(self, cursor, day: str, cart_items: List[Dict], categories: Dict[int, int]):
+        """Добавляет заказ в дневные агрегаты продаж (внутри транзакции заказа)"""
+        products: Dict[int, List] = {}
+        for item in cart_items:
+            sale = products.setdefault(item["id"], [0, 0.0])
+            sale[0] += item["quantity"]
+            sale[1] += item["quantity"] * item["price"]
+        by_category: Dict[int, List] = {}
+        for product_id, (quantity, revenue) in products.items():
+            category_id = categories.get(product_id)
+            if category_id is not None:
+                sale = by_category.setdefault(category_id, [0, 0.0])
+                sale[0] += quantity
+                sale[1] += revenue
+
+        cursor.execute('''
+            INSERT INTO sales_daily (day, orders, quantity, revenue) VALUES (?, 1, ?, ?)
+            ON CONFLICT (day) DO UPDATE SET
+                orders = orders + 1,
+                quantity = quantity + excluded.quantity,
+                revenue = revenue + excluded.revenue
+        ''', (day, sum(sale[0] for sale in products.values()), sum(sale[1] for sale in products.values())))
+        cursor.executemany('''
+            INSERT INTO sales_daily_products (day, product_id, category_id, orders, quantity, revenue)
+            VALUES (?, ?, ?, 1, ?, ?)
+            ON CONFLICT (day, product_id) DO UPDATE SET
+                orders = orders + 1,
+                quantity = quantity + excluded.quantity,
+                revenue = revenue + excluded.revenue
+        ''', [(day, product_id, categories.get(product_id), quantity, revenue)
+              for product_id, (quantity, revenue) in products.items()])
+        cursor.executemany('''
+            INSERT INTO sales_daily_categories (day, category_id, orders, quantity, revenue)
+            VALUES (?, ?, 1, ?, ?)
+            ON CONFLICT (day, category_id) DO UPDATE SET
+                orders = orders + 1,
+                quantity = quantity + excluded.quantity,
+                revenue = revenue + excluded.revenue
+        ''', [(day, category_id, quantity, revenue) for category_id, (quantity, revenue) in by_category.items()])
+
+    # === REPORT METHODS ===
+    def get_sales_report(self, date_from: str, date_to: str, top: int = 10) -> Dict:
+        """
+        Продажи за период [date_from, date_to] (даты YYYY-MM-DD) из дневных агрегатов.
+        Стоимость зависит от длины периода, а не от количества заказов
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT day, orders, quantity, revenue FROM sales_daily
+                WHERE day BETWEEN ? AND ? ORDER BY day
+            ''', (date_from, date_to))
+            days = [{"day": row[0], "orders": row[1], "quantity": row[2], "revenue": row[3]}
+                    for row in cursor.fetchall()]
+
+            cursor.execute('''
+                SELECT s.category_id, c.name, c.emoji, SUM(s.orders), SUM(s.quantity), SUM(s.revenue)
+                FROM sales_daily_categories s
+                LEFT JOIN categories c ON c.id = s.category_id
+                WHERE s.day BETWEEN ? AND ?
+                GROUP BY s.category_id
+                ORDER BY SUM(s.revenue) DESC
+            ''', (date_from, date_to))
+            categories = [{"id": row[0], "name": f"{row[1]} {row[2]}" if row[1] else f"#{row[0]}",
+                           "orders": row[3], "quantity": row[4], "revenue": row[5]}
+                          for row in cursor.fetchall()]
+
+            cursor.execute('''
+                SELECT s.product_id, p.name, SUM(s.orders), SUM(s.quantity), SUM(s.revenue)
+                FROM sales_daily_products s
+                LEFT JOIN products p ON p.id = s.product_id
+                WHERE s.day BETWEEN ? AND ?
+                GROUP BY s.product_id
+                ORDER BY SUM(s.revenue) DESC
+                LIMIT ?
+            ''', (date_from, date_to, top))
+            products = [{"id": row[0], "name": row[1] or f"Товар #{row[0]}",
+                         "orders": row[2], "quantity": row[3], "revenue": row[4]}
+                        for row in cursor.fetchall()]
+
+        return {
+            "orders": sum(day["orders"] for day in days),
+            "quantity": sum(day["quantity"] for day in days),
+            "revenue": sum(day["revenue"] for day in days),
+            "days": days,
+            "categories": categories,
+            "products": products,
+        }
+
+    def get_sales_history(self, date_from: str) -> List[tuple]:
+        """(номер дня от date_from, product_id, количество) из дневных агрегатов начиная с date_from"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT CAST(julianday(day) - julianday(?) AS INTEGER), product_id, quantity
+                FROM sales_daily_products WHERE day >= ?
+            ''', (date_from, date_from))
+            return cursor.fetchall()
+
+    # === BROADCAST METHODS ===
+    def create_broadcast(self, text: str, admin_chat_id: int) -> int:
+        """Создаёт рассылку и список получателей из всех зарегистрированных пользователей"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO broadcasts (text, admin_chat_id, created_at) VALUES (?, ?, ?)
+            ''', (text, admin_chat_id, datetime.now().isoformat()))
+            broadcast_id = cursor.lastrowid
+            cursor.execute('''
+                INSERT INTO broadcast_recipients (broadcast_id, user_id)
+                SELECT ?, user_id FROM users
+            ''', (broadcast_id,))
+            cursor.execute('UPDATE broadcasts SET total = ? WHERE id = ?', (cursor.rowcount, broadcast_id))
+            return broadcast_id
+
+    def get_running_broadcasts(self) -> List[Dict]:
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, text, admin_chat_id FROM broadcasts WHERE status = 'running' ORDER BY id")
+            return [{"id": row[0], "text": row[1], "admin_chat_id": row[2]} for row in cursor.fetchall()]
+
+    def get_broadcast_recipients(self, broadcast_id: int, after_user_id: int, limit: int) -> List[Dict]:
+        """Следующая пачка неотправленных получателей (keyset по user_id)"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user_id, attempts FROM broadcast_recipients
+                WHERE broadcast_id = ? AND status = 'pending' AND user_id > ?
+                ORDER BY user_id LIMIT ?
+            ''', (broadcast_id, after_user_id, limit))
+            return [{"user_id": row[0], "attempts": row[1]} for row in cursor.fetchall()]
+
+    def save_broadcast_results(self, broadcast_id: int, results: List[tuple]):
+        """results: (user_id, status, attempts)"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                UPDATE broadcast_recipients SET status = ?, attempts = ?
+                WHERE broadcast_id = ? AND user_id = ?
+            ''', [(status, attempts, broadcast_id, user_id) for user_id, status, attempts in results])
+
+    def finish_broadcast(self, broadcast_id: int) -> Dict[str, int]:
+        """Помечает рассылку завершённой и возвращает количество получателей по статусам"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ?
+            ''', (datetime.now().isoformat(), broadcast_id))
+            cursor.execute('''
+                SELECT status, COUNT(*) FROM broadcast_recipients
+                WHERE broadcast_id = ? GROUP BY status
+            ''', (broadcast_id,))
+            return dict(cursor.fetchall())
+
+    # === FSM STORAGE METHODS ===
+    def get_fsm_record(self, key: str) -> Optional[Dict]:
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT state, data FROM fsm_storage WHERE key = ?', (key,))
+            row = cursor.fetchone()
+            if row:
+                return {"state": row[0], "data": row[1]}
+            return None
+
+    def save_fsm_records(self, upserts: List[tuple], deletes: List[str]):
+        """Записывает пачку состояний одной транзакцией. upserts: (key, state, data, updated_at)"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            if upserts:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at)
+                    VALUES (?, ?, ?, ?)
+                ''', upserts)
+            if deletes:
+                cursor.executemany('DELETE FROM fsm_storage WHERE key = ?', [(key,) for key in deletes])
+
+
+class AsyncDatabase:
+    """
+    Асинхронная обёртка над Database для обработчиков.
+    Чтение выполняется в ограниченном пуле потоков, запись - в одном
+    выделенном потоке, поэтому медленный запрос не блокирует event loop,
+    а писатели не конкурируют друг с другом за блокировку SQLite.
+    Имена методов и формат результатов совпадают с Database.
+    Все модули используют один общий экземпляр db, иначе у каждого
+    был бы свой поток-писатель и свой пул соединений.
+    """
+
+    def __init__(self, db_name="shop_bot.db", max_readers: int = 4, images_dir="images"):
+        # Каждому потоку-читателю и писателю - своё соединение из пула
+        self.sync = Database(db_name, pool_size=max_readers + 1, images_dir=images_dir)
+        self.images = self.sync.images
+        self._readers = ThreadPoolExecutor(max_workers=max_readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+    async def _read(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, partial(func, *args, **kwargs))
+
+    async def _write(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, partial(func, *args, **kwargs))
+
+    def close(self):
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        self.sync.close()
+
+    # === USER METHODS ===
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        return await self._read(self.sync.get_user, user_id)
+
+    async def add_user(self, user_id: int, name: str, phone: str):
+        return await self._write(self.sync.add_user, user_id, name, phone)
+
+    # === CATEGORY METHODS ===
+    async def get_categories(self) -> List[Dict]:
+        return await self._read(self.sync.get_categories)
+
+    # === PRODUCT METHODS ===
+    async def get_products_by_category(self, category_id: int) -> List[Dict]:
+        return await self._read(self.sync.get_products_by_category, category_id)
+
+    async def get_product(self, product_id: int) -> Optional[Dict]:
+        return await self._read(self.sync.get_product, product_id)
+
+    async def get_catalog_products(self, product_ids: List[int] = None) -> List[Dict]:
+        return await self._read(self.sync.get_catalog_products, product_ids)
+
+    async def add_product(self, name: str, price: float, quantity: int, category_id: int,
+                          image_data: bytes = None, image_variants: Dict[str, bytes] = None) -> int:
+        return await self._write(self.sync.add_product, name, price, quantity, category_id, image_data,
+                                 image_variants)
+
+    async def delete_product(self, product_id: int) -> bool:
+        return await self._write(self.sync.delete_product, product_id)
+
+    async def update_product_field(self, product_id: int, field: str, value):
+        return await self._write(self.sync.update_product_field, product_id, field, value)
+
+    async def set_product_image(self, product_id: int, image_data: Optional[bytes]) -> Optional[str]:
+        return await self._write(self.sync.set_product_image, product_id, image_data)
+
+    async def set_product_images(self, product_id: int, image_variants: Dict[str, bytes]) -> Optional[str]:
+        return await self._write(self.sync.set_product_images, product_id, image_variants)
+
+    async def get_product_images(self, product_id: int) -> Dict[str, str]:
+        return await self._read(self.sync.get_product_images, product_id)
+
+    async def get_all_products(self, after_id: int = 0, limit: int = None, before_id: int = None) -> List[Dict]:
+        return await self._read(self.sync.get_all_products, after_id, limit, before_id)
+
+    async def export_products_csv(self, path: str, batch_size: int = 1000) -> int:
+        return await self._read(self.sync.export_products_csv, path, batch_size)
+
+    async def upsert_products(self, updates: List[tuple], inserts: List[tuple]) -> List[int]:
+        return await self._write(self.sync.upsert_products, updates, inserts)
+
+    async def bulk_update_products(self, changes: List[tuple], adjustments: List[tuple] = ()) -> Dict[str, int]:
+        return await self._write(self.sync.bulk_update_products, changes, adjustments)
+
+    async def search_products(self, query: str, offset: int = 0, limit: int = 10) -> List[Dict]:
+        return await self._read(self.sync.search_products, query, offset, limit)
+
+    async def get_product_image_refs(self) -> List[str]:
+        return await self._read(self.sync.get_product_image_refs)
+
+    async def get_catalog_version(self) -> int:
+        return await self._read(self.sync.get_catalog_version)
+
+    async def get_last_product_change(self) -> int:
+        return await self._read(self.sync.get_last_product_change)
+
+    async def get_product_changes(self, after_id: int, limit: int = 1000) -> List[tuple]:
+        return await self._read(self.sync.get_product_changes, after_id, limit)
+
+    # === PHOTO FILE_ID METHODS ===
+    async def get_photo_file_ids(self) -> Dict[str, str]:
+        return await self._read(self.sync.get_photo_file_ids)
+
+    async def set_photo_file_id(self, image_ref: str, file_id: str):
+        return await self._write(self.sync.set_photo_file_id, image_ref, file_id)
+
+    async def delete_photo_file_id(self, image_ref: str):
+        return await self._write(self.sync.delete_photo_file_id, image_ref)
+
+    # === CART METHODS ===
+    async def get_user_cart(self, user_id: int) -> List[Dict]:
+        return await self._read(self.sync.get_user_cart, user_id)
+
+    async def get_cart_holds(self) -> List[Dict]:
+        return await self._read(self.sync.get_cart_holds)
+
+    async def add_to_cart(self, user_id: int, product_id: int, quantity: int):
+        return await self._write(self.sync.add_to_cart, user_id, product_id, quantity)
+
+    async def get_cart_held(self, product_ids: List[int]) -> Dict[int, int]:
+        return await self._read(self.sync.get_cart_held, product_ids)
+
+    async def reserve_cart_item(self, user_id: int, product_id: int, quantity: int) -> int:
+        return await self._write(self.sync.reserve_cart_item, user_id, product_id, quantity)
+
+    async def clear_cart(self, user_id: int):
+        return await self._write(self.sync.clear_cart, user_id)
+
+    # === ORDER METHODS ===
+    async def create_order(self, user_id: int, total_amount: float, delivery_date: str,
+                           delivery_time: str, delivery_address: str, cart_items: List[Dict]) -> int:
+        return await self._write(self.sync.create_order, user_id, total_amount, delivery_date,
+                                 delivery_time, delivery_address, cart_items)
+
+    # === REPORT METHODS ===
+    async def get_sales_report(self, date_from: str, date_to: str, top: int = 10) -> Dict:
+        return await self._read(self.sync.get_sales_report, date_from, date_to, top)
+
+    async def get_sales_history(self, date_from: str) -> List[tuple]:
+        return await self._read(self.sync.get_sales_history, date_from)
+
+    # === BROADCAST METHODS ===
+    async def create_broadcast(self, text: str, admin_chat_id: int) -> int:
+        return await self._write(self.sync.create_broadcast, text, admin_chat_id)
+
+    async def get_running_broadcasts(self) -> List[Dict]:
+        return await self._read(self.sync.get_running_broadcasts)
+
+    async def get_broadcast_recipients(self, broadcast_id: int, after_user_id: int, limit: int) -> List[Dict]:
+        return await self._read(self.sync.get_broadcast_recipients, broadcast_id, after_user_id, limit)
+
+    async def save_broadcast_results(self, broadcast_id: int, results: List[tuple]):
+        return await self._write(self.sync.save_broadcast_results, broadcast_id, results)
+
+    async def finish_broadcast(self, broadcast_id: int) -> Dict[str, int]:
+        return await self._write(self.sync.finish_broadcast, broadcast_id)
+
+    # === FSM STORAGE METHODS ===
+    async def get_fsm_record(self, key: str) -> Optional[Dict]:
+        return await self._read(self.sync.get_fsm_record, key)
+
+    async def save_fsm_records(self, upserts: List[tuple], deletes: List[str]):
+        return await self._write(self.sync.save_fsm_records, upserts, deletes)
 
-        # Очищаем корзину
-        cursor.execute('DELETE FROM carts WHERE user_id = ?', (user_id,))
 
-        conn.commit()
-        conn.close()
-        return order_id
\ No newline at end of file
+# Общий экземпляр для всех модулей процесса
+db = AsyncDatabase()
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class EditCoalescer:
+    """
+    Объединяет частые правки одного сообщения.
+    Первая правка отправляется сразу, следующие - не чаще одного раза
+    за window секунд и только с последним значением: нажатия, пришедшие
+    во время отправки или внутри окна, объединяются. Промежуточные значения
+    и правки, совпадающие с уже показанным, не отправляются.
+    """
+
+    # Сколько последних отправленных значений помнить
+    MAX_TRACKED_MESSAGES = 10000
+
+    def __init__(self, window: float = 0.4, log_every: int = 100):
+        self.window = window
+        self.log_every = log_every
+        self._pending: Dict[Hashable, Tuple[Any, Callable[[Any], Awaitable]]] = {}
+        self._tasks: Dict[Hashable, asyncio.Task] = {}
+        self._shown: "OrderedDict[Hashable, Any]" = OrderedDict()
+        # Метрики
+        self.requested = 0
+        self.sent = 0
+
+    @property
+    def saved(self) -> int:
+        return self.requested - self.sent
+
+    def stats(self) -> Dict[str, int]:
+        """Счётчики этого процесса: запрошено, отправлено и сэкономлено правок"""
+        return {"requested": self.requested, "sent": self.sent, "saved": self.saved}
+
+    def submit(self, key: Hashable, value: Any, send: Callable[[Any], Awaitable]):
+        """Запланировать правку сообщения key значением value через send(value)"""
+        self.requested += 1
+        self._pending[key] = (value, send)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._run(key))
+
+        if self.log_every and self.requested % self.log_every == 0:
+            logger.info(f"Правки клавиатур: запрошено {self.requested}, "
+                        f"отправлено {self.sent}, сэкономлено {self.saved}")
+
+    def mark_shown(self, key: Hashable, value: Any):
+        """Запоминает значение, с которым сообщение было отправлено"""
+        self._shown[key] = value
+        self._shown.move_to_end(key)
+        if len(self._shown) > self.MAX_TRACKED_MESSAGES:
+            self._shown.popitem(last=False)
+
+    def cancel(self, key: Hashable):
+        """Отменяет неотправленную правку (сообщение уже заменено другим содержимым)"""
+        self._pending.pop(key, None)
+        self._shown.pop(key, None)
+
+    async def _run(self, key: Hashable):
+        try:
+            while True:
+                item = self._pending.pop(key, None)
+                if item is None:
+                    break
+
+                value, send = item
+                if key in self._shown and self._shown[key] == value:
+                    continue
+
+                try:
+                    await send(value)
+                    self.sent += 1
+                    self.mark_shown(key, value)
+                except Exception as e:
+                    logger.warning(f"Не удалось обновить сообщение {key}: {e}")
+
+                # Следующая правка - не раньше чем через window, с последним значением за это время
+                await asyncio.sleep(self.window)
+        finally:
+            self._tasks.pop(key, None)
+
+
+# Правки клавиатуры выбора количества
+quantity_edits = EditCoalescer()
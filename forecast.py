@@ -0,0 +1,117 @@
+import math
+import time
+import asyncio
+import logging
+from datetime import date, timedelta
+from typing import Dict, List
+
+import numpy as np
+
+from catalog import catalog
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# История для коэффициентов дня недели - целое число недель до вчерашнего дня
+FORECAST_HISTORY_WEEKS = 12
+# Окно скользящего среднего дневных продаж
+MOVING_AVERAGE_DAYS = 28
+# На сколько дней вперёд считается потребность по умолчанию
+FORECAST_HORIZON_DAYS = 7
+MAX_HORIZON_DAYS = 60
+# Страховой запас: z-квантиль для уровня обслуживания ~95%
+SAFETY_Z = 1.65
+# Коэффициенты дня недели товаров с редкими продажами сглаживаются к 1
+SEASONALITY_PRIOR_WEEKS = 2
+
+
+def build_sales_matrix(history: np.ndarray, product_ids: np.ndarray, days: int) -> np.ndarray:
+    """
+    Матрица продаж [товар, день] из строк (день, product_id, количество).
+    product_ids - отсортированные id товаров каталога; проданные и удалённые
+    товары, а также дни вне окна отбрасываются
+    """
+    matrix = np.zeros(len(product_ids) * days)
+    if len(history) and len(product_ids):
+        day, product_id, quantity = history[:, 0], history[:, 1], history[:, 2]
+        row = np.searchsorted(product_ids, product_id)
+        row = np.minimum(row, len(product_ids) - 1)
+        valid = (product_ids[row] == product_id) & (day >= 0) & (day < days)
+        matrix = np.bincount(row[valid] * days + day[valid], weights=quantity[valid], minlength=matrix.size)
+    return matrix.reshape(len(product_ids), days)
+
+
+def forecast_demand(sales: np.ndarray, quantities: np.ndarray, horizon: int) -> Dict[str, np.ndarray]:
+    """
+    Прогноз сразу для всех товаров.
+    sales - матрица продаж [товар, день] за целое число недель; первый день прогноза
+    приходится на тот же день недели, что и первый столбец.
+    Потребность = скользящее среднее × коэффициенты дней недели горизонта,
+    к заказу - потребность плюс страховой запас (по отклонениям от недельного
+    профиля) минус остаток
+    """
+    weeks = sales.shape[1] // 7
+    recent = sales[:, -MOVING_AVERAGE_DAYS:]
+    daily = recent.mean(axis=1)
+
+    # Коэффициент дня недели: продажи в этот день недели относительно среднего дня недели,
+    # сглаженные к 1 добавлением SEASONALITY_PRIOR_WEEKS «средних» дней
+    by_weekday = sales.reshape(len(sales), weeks, 7).sum(axis=1)
+    mean_weekday = by_weekday.mean(axis=1, keepdims=True)
+    prior = SEASONALITY_PRIOR_WEEKS * mean_weekday / weeks
+    denominator = mean_weekday + prior
+    seasonality = np.divide(by_weekday + prior, denominator, out=np.ones_like(by_weekday),
+                            where=denominator > 0)
+
+    forecast = daily * seasonality[:, np.arange(horizon) % 7].sum(axis=1)
+    # Разброс считается по остаткам после учёта дней недели: регулярный всплеск
+    # в один день недели уже есть в прогнозе и страховым запасом не покрывается.
+    # MOVING_AVERAGE_DAYS кратно 7, так что столбец j окна приходится на день недели j % 7
+    expected = daily[:, None] * seasonality[:, np.arange(recent.shape[1]) % 7]
+    safety = SAFETY_Z * (recent - expected).std(axis=1) * math.sqrt(horizon)
+    restock = np.ceil(np.maximum(forecast + safety - quantities, 0))
+    days_left = np.divide(quantities, daily, out=np.full_like(daily, np.inf), where=daily > 0)
+    return {"daily": daily, "forecast": forecast, "restock": restock, "days_left": days_left}
+
+
+def build_restock_plan(history: List[tuple], products: List[Dict], horizon: int) -> List[Dict]:
+    """Товары, которые нужно докупить, по убыванию количества к заказу"""
+    days = FORECAST_HISTORY_WEEKS * 7
+    product_ids = np.fromiter((product["id"] for product in products), dtype=np.int64, count=len(products))
+    quantities = np.fromiter((product["quantity"] for product in products), dtype=np.float64, count=len(products))
+    rows = np.array(history, dtype=np.int64).reshape(-1, 3)
+
+    result = forecast_demand(build_sales_matrix(rows, product_ids, days), quantities, horizon)
+
+    needed = np.flatnonzero(result["restock"])
+    plan = []
+    for index in needed[np.argsort(-result["restock"][needed], kind="stable")]:
+        product = products[index]
+        plan.append({
+            "id": product["id"],
+            "name": product["name"],
+            "unit": product["unit"],
+            "quantity": product["quantity"],
+            "daily": float(result["daily"][index]),
+            "forecast": float(result["forecast"][index]),
+            "restock": int(result["restock"][index]),
+            "days_left": float(result["days_left"][index]),
+        })
+    return plan
+
+
+async def get_restock_plan(horizon: int = FORECAST_HORIZON_DAYS) -> List[Dict]:
+    """
+    План закупки на horizon дней. История читается одним запросом из дневных
+    агрегатов продаж за FORECAST_HISTORY_WEEKS недель, расчёт идёт в потоке,
+    чтобы не задерживать ответы покупателям
+    """
+    started = time.monotonic()
+    date_from = date.today() - timedelta(weeks=FORECAST_HISTORY_WEEKS)
+    history = await db.get_sales_history(date_from.isoformat())
+
+    loop = asyncio.get_running_loop()
+    plan = await loop.run_in_executor(None, build_restock_plan, history, catalog.get_products(), horizon)
+    logger.info(f"Прогноз закупки: строк истории {len(history)}, к заказу {len(plan)} товаров, "
+                f"за {time.monotonic() - started:.2f} с")
+    return plan
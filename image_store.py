@@ -0,0 +1,81 @@
+import os
+import hashlib
+import tempfile
+from typing import Optional
+
+# Сигнатуры начала файла -> расширение (формат варианта зависит от
+# IMAGE_FORMAT на момент загрузки, поэтому определяется по содержимому)
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF8", "gif"),
+)
+
+class ImageStore:
+    """
+    Контентно-адресуемое хранилище изображений на диске.
+    Файл называется sha256 от содержимого, поэтому одинаковые
+    изображения хранятся один раз, а ссылка (ref) не меняется,
+    пока не меняются байты.
+    """
+
+    def __init__(self, root: str = "images"):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def make_ref(image_data: bytes) -> str:
+        return hashlib.sha256(image_data).hexdigest()
+
+    def path(self, ref: str) -> str:
+        """Путь к файлу изображения на диске"""
+        return os.path.join(self.root, ref[:2], ref)
+
+    def extension(self, ref: str) -> str:
+        """Расширение файла по его содержимому (jpg, если формат не распознан)"""
+        with open(self.path(ref), "rb") as f:
+            header = f.read(12)
+        if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+            return "webp"
+        return next((extension for signature, extension in _SIGNATURES if header.startswith(signature)), "jpg")
+
+    def exists(self, ref: str) -> bool:
+        return os.path.exists(self.path(ref))
+
+    def put(self, image_data: bytes) -> str:
+        """Сохраняет изображение и возвращает его ссылку"""
+        ref = self.make_ref(image_data)
+        path = self.path(ref)
+        if os.path.exists(path):
+            return ref
+
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Пишем во временный файл и атомарно переименовываем,
+        # чтобы читатель никогда не увидел недописанное изображение
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(image_data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return ref
+
+    def read(self, ref: str) -> Optional[bytes]:
+        """Читает изображение целиком (копия байтов)"""
+        try:
+            with open(self.path(ref), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, ref: str) -> bool:
+        try:
+            os.remove(self.path(ref))
+            return True
+        except FileNotFoundError:
+            return False
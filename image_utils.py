@@ -1,8 +1,13 @@
 import sqlite3
 import io
-from typing import Optional, Tuple, Union
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple, Union
 from PIL import Image, ImageOps, UnidentifiedImageError
 
+from image_store import ImageStore
+
 # Поддерживаемые форматы изображений
 SUPPORTED_IMAGE_TYPES = {
     'image/jpeg': 'JPEG',
@@ -11,13 +16,39 @@ SUPPORTED_IMAGE_TYPES = {
     'image/gif': 'GIF'
 }
 
+# Варианты изображения товара (имя -> максимальный размер), получаемые
+# из одного декодирования: thumb - превью, card - карточка товара, full - полный размер
+IMAGE_VARIANTS = {
+    "full": (1200, 1200),
+    "card": (800, 800),
+    "thumb": (320, 320),
+}
+# Формат вариантов: "JPEG" или "WEBP" (WebP заметно меньше, но дольше кодируется)
+IMAGE_FORMAT = "JPEG"
+
+# Обработка изображений выполняется в отдельных процессах, чтобы
+# декодирование и сжатие не останавливали event loop бота
+IMAGE_WORKERS = 2
+# Сколько изображений может обрабатываться и ждать очереди одновременно
+IMAGE_QUEUE_SIZE = 8
+# Сколько секунд ждать обработки одного изображения
+IMAGE_TIMEOUT = 30.0
+
+_image_pool: Optional[ProcessPoolExecutor] = None
+_image_slots: Optional[asyncio.Semaphore] = None
+
+
+class ImageQueueFullError(Exception):
+    """Очередь обработки изображений заполнена"""
+
 
-def save_product_image(db_path: str, product_id: int, image_data: bytes) -> bool:
-    """Сохраняет изображение товара в базу данных"""
+def save_product_image(db_path: str, product_id: int, image_data: bytes, images_dir: str = "images") -> bool:
+    """Сохраняет изображение товара в хранилище и ссылку на него в базу данных"""
     try:
+        image_ref = ImageStore(images_dir).put(image_data)
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        cursor.execute('UPDATE products SET image = ? WHERE id = ?', (image_data, product_id))
+        cursor.execute('UPDATE products SET image_ref = ? WHERE id = ?', (image_ref, product_id))
         conn.commit()
         conn.close()
         return True
@@ -26,20 +57,52 @@ def save_product_image(db_path: str, product_id: int, image_data: bytes) -> bool
         return False
 
 
-def get_product_image(db_path: str, product_id: int) -> Optional[bytes]:
-    """Получает изображение товара из базы данных"""
+def get_product_image(db_path: str, product_id: int, images_dir: str = "images") -> Optional[bytes]:
+    """Получает изображение товара из хранилища по ссылке из базы данных"""
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
-        cursor.execute('SELECT image FROM products WHERE id = ?', (product_id,))
+        cursor.execute('SELECT image_ref FROM products WHERE id = ?', (product_id,))
         result = cursor.fetchone()
         conn.close()
-        return result[0] if result and result[0] else None
+        if not result or not result[0]:
+            return None
+        return ImageStore(images_dir).read(result[0])
     except Exception as e:
         print(f"Ошибка при получении изображения: {e}")
         return None
 
 
+def _open_rgb(image_data: bytes, target_size: Tuple[int, int] = None) -> Image.Image:
+    """
+    Декодирует изображение и приводит к RGB.
+    JPEG с target_size декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8),
+    но не меньше target_size - это в разы быстрее и экономнее полного декодирования.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    if target_size and image.format == 'JPEG':
+        image.draft('RGB', target_size)
+
+    # Конвертируем в RGB, если это необходимо (для PNG с прозрачностью)
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def _encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    output = io.BytesIO()
+    if image_format == 'WEBP':
+        image.save(output, format='WEBP', quality=quality, method=4)
+    else:
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
 def process_image(
         image_data: bytes,
         max_size: Tuple[int, int] = (1200, 1200),
@@ -50,25 +113,43 @@ def process_image(
     Возвращает обработанные байты изображения в формате JPEG
     """
     try:
-        # Открываем изображение
-        image = Image.open(io.BytesIO(image_data))
-
-        # Конвертируем в RGB, если это необходимо (для PNG с прозрачностью)
-        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
+        image = _open_rgb(image_data, max_size)
 
         # Изменяем размер с сохранением пропорций
         image.thumbnail(max_size, Image.Resampling.LANCZOS)
 
-        # Сохраняем в буфер
-        output = io.BytesIO()
-        image.save(output, format='JPEG', quality=quality, optimize=True)
+        return _encode(image, 'JPEG', quality)
+
+    except UnidentifiedImageError:
+        print("Ошибка: Невозможно определить формат изображения")
+        raise
+    except Exception as e:
+        print(f"Ошибка при обработке изображения: {e}")
+        raise
 
-        return output.getvalue()
+
+def process_image_variants(
+        image_data: bytes,
+        variants: Dict[str, Tuple[int, int]] = None,
+        quality: int = 85,
+        image_format: str = None
+) -> Dict[str, bytes]:
+    """
+    Декодирует изображение один раз и кодирует все варианты размеров.
+    Каждый следующий вариант уменьшается из предыдущего, а не из оригинала.
+    Возвращает {имя варианта: байты изображения}
+    """
+    variants = variants or IMAGE_VARIANTS
+    image_format = image_format or IMAGE_FORMAT
+    try:
+        largest = max(variants.values(), key=lambda size: size[0] * size[1])
+        image = _open_rgb(image_data, largest)
+
+        result = {}
+        for name, max_size in sorted(variants.items(), key=lambda item: item[1][0] * item[1][1], reverse=True):
+            image.thumbnail(max_size, Image.Resampling.LANCZOS)
+            result[name] = _encode(image, image_format, quality)
+        return result
 
     except UnidentifiedImageError:
         print("Ошибка: Невозможно определить формат изображения")
@@ -76,3 +157,67 @@ def process_image(
     except Exception as e:
         print(f"Ошибка при обработке изображения: {e}")
         raise
+
+
+def _get_image_pool() -> ProcessPoolExecutor:
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _image_pool
+
+
+async def _run_in_image_pool(func, *args, timeout: float = IMAGE_TIMEOUT):
+    """
+    Выполняет func в пуле процессов.
+    Если очередь заполнена, сразу выбрасывает ImageQueueFullError,
+    если обработка не уложилась в timeout - asyncio.TimeoutError.
+    """
+    global _image_slots
+    if _image_slots is None:
+        _image_slots = asyncio.Semaphore(IMAGE_QUEUE_SIZE)
+    if _image_slots.locked():
+        raise ImageQueueFullError()
+
+    await _image_slots.acquire()
+    loop = asyncio.get_running_loop()
+    try:
+        future = loop.run_in_executor(_get_image_pool(), func, *args)
+    except BaseException:
+        _image_slots.release()
+        raise
+    # Место в очереди освобождается, когда процесс действительно закончил работу,
+    # даже если вызывающий перестал ждать по таймауту
+    future.add_done_callback(lambda _: _image_slots.release())
+    return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+
+async def process_image_async(
+        image_data: bytes,
+        max_size: Tuple[int, int] = (1200, 1200),
+        quality: int = 85,
+        timeout: float = IMAGE_TIMEOUT
+) -> bytes:
+    """process_image в пуле процессов"""
+    return await _run_in_image_pool(process_image, image_data, max_size, quality, timeout=timeout)
+
+
+async def process_image_variants_async(
+        image_data: bytes,
+        variants: Dict[str, Tuple[int, int]] = None,
+        quality: int = 85,
+        image_format: str = None,
+        timeout: float = IMAGE_TIMEOUT
+) -> Dict[str, bytes]:
+    """process_image_variants в пуле процессов"""
+    return await _run_in_image_pool(process_image_variants, image_data, variants, quality, image_format,
+                                    timeout=timeout)
+
+
+def shutdown_image_pool():
+    global _image_pool
+    if _image_pool is not None:
+        _image_pool.shutdown(wait=True, cancel_futures=True)
+        _image_pool = None
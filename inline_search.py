@@ -0,0 +1,98 @@
+import logging
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from aiogram import types
+
+from catalog import Catalog, catalog, normalize_name
+from photo_cache import PhotoCache, photo_cache
+
+logger = logging.getLogger(__name__)
+
+# Результатов на одну страницу inline-ответа (Telegram разрешает до 50)
+INLINE_PAGE_SIZE = 20
+# Сколько результатов одного запроса можно пролистать
+INLINE_MAX_RESULTS = 500
+# Сколько секунд Telegram может отдавать ответ из своего кэша
+INLINE_CACHE_TIME = 60
+
+
+class InlineSearch:
+    """
+    Ответы на inline-запросы (@бот яблоко) из снимка каталога в памяти.
+    Запросы приходят на каждое нажатие клавиши, поэтому список найденных
+    товаров кэшируется по тексту запроса до смены catalog.version,
+    а страницы отдаются по offset из этого списка.
+    """
+
+    MAX_CACHED_QUERIES = 2048
+
+    def __init__(self, catalog: Catalog, photo_cache: PhotoCache):
+        self.catalog = catalog
+        self.photo_cache = photo_cache
+        self._results: "OrderedDict[str, List[int]]" = OrderedDict()
+        self._version = None
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, query: str) -> List[int]:
+        if self._version != self.catalog.version:
+            self._results.clear()
+            self._version = self.catalog.version
+
+        key = normalize_name(query)
+        product_ids = self._results.get(key)
+        if product_ids is not None:
+            self.hits += 1
+            self._results.move_to_end(key)
+            return product_ids
+
+        self.misses += 1
+        if key:
+            product_ids = self.catalog.search(key, INLINE_MAX_RESULTS)
+        else:
+            product_ids = self.catalog.get_product_ids(INLINE_MAX_RESULTS)
+        self._results[key] = product_ids
+        if len(self._results) > self.MAX_CACHED_QUERIES:
+            self._results.popitem(last=False)
+        return product_ids
+
+    def page(self, query: str, offset: str) -> Tuple[List[types.InlineQueryResult], str]:
+        """Результаты страницы и offset следующей ("" - страниц больше нет)"""
+        start = int(offset) if offset.isdigit() else 0
+        product_ids = self.find(query)
+        end = start + INLINE_PAGE_SIZE
+
+        results = []
+        for product_id in product_ids[start:end]:
+            result = self._build_result(product_id)
+            if result is not None:
+                results.append(result)
+        return results, str(end) if end < len(product_ids) else ""
+
+    def _build_result(self, product_id: int) -> Optional[types.InlineQueryResult]:
+        product = self.catalog.get_product(product_id)
+        if not product:
+            return None
+
+        text = f"📦 {product['name']}\n💰 Цена: {product['price']}сум/{product['unit']}"
+        # Фото отдаётся только по готовому file_id - загружать файлы здесь некогда
+        file_id = self.photo_cache.get(product["image_ref"]) if product["image_ref"] else None
+        if file_id:
+            return types.InlineQueryResultCachedPhoto(
+                id=f"product_{product_id}",
+                photo_file_id=file_id,
+                title=product["name"],
+                description=f"{product['price']}сум/{product['unit']}",
+                caption=text
+            )
+        return types.InlineQueryResultArticle(
+            id=f"product_{product_id}",
+            title=product["name"],
+            description=f"{product['price']}сум/{product['unit']}",
+            input_message_content=types.InputTextMessageContent(message_text=text)
+        )
+
+
+inline_search = InlineSearch(catalog, photo_cache)
@@ -1,37 +1,102 @@
+from functools import lru_cache
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from database import Database
+from catalog import catalog
+
+# Клавиатуры, зависящие от каталога, кэшируются до смены catalog.version
+_catalog_keyboards = {}
+_catalog_keyboards_version = None
+
+# Клавиатуры выбора количества строятся заранее для этого диапазона
+PRECOMPUTED_QUANTITIES = 100
+
+# Товаров на одной странице категории и результатов поиска
+PRODUCTS_PAGE_SIZE = 10
+SEARCH_PAGE_SIZE = 10
+# Товаров на одной странице списка в админке
+ADMIN_PRODUCTS_PAGE_SIZE = 20
+
+
+def _cached_by_catalog_version(key, build):
+    global _catalog_keyboards_version
+    if _catalog_keyboards_version != catalog.version:
+        _catalog_keyboards.clear()
+        _catalog_keyboards_version = catalog.version
 
-db = Database()
+    markup = _catalog_keyboards.get(key)
+    if markup is None:
+        markup = _catalog_keyboards[key] = build()
+    return markup
+
+
+_MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🛒 Каталог"), KeyboardButton(text="🛍️ Корзина")],
+        [KeyboardButton(text="🔍 Поиск")]
+    ],
+    resize_keyboard=True
+)
 
 
 def get_main_menu_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🛒 Каталог"), KeyboardButton(text="🛍️ Корзина")]
-        ],
-        resize_keyboard=True
-    )
+    return _MAIN_MENU_KEYBOARD
+
+
+_PHONE_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="📱 Поделиться номером", request_contact=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
 
 
 def get_phone_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="📱 Поделиться номером", request_contact=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return _PHONE_KEYBOARD
 
 
-def get_categories_keyboard():
-    categories = db.get_categories()
+def _build_categories_keyboard():
     keyboard = []
-    for category in categories:
+    for category in catalog.get_categories():
         keyboard.append([InlineKeyboardButton(text=category["name"], callback_data=f"category_{category['id']}")])
     keyboard.append([InlineKeyboardButton(text="🛍️ Перейти в корзину", callback_data="view_cart")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def get_products_keyboard(category_id: int):
-    products = db.get_products_by_category(category_id)
+def get_categories_keyboard():
+    return _cached_by_catalog_version("categories", _build_categories_keyboard)
+
+
+def _build_products_keyboard(category_id: int, after_id: int):
+    page = catalog.get_products_page(category_id, after_id, PRODUCTS_PAGE_SIZE)
+    keyboard = []
+    for product in page["products"]:
+        keyboard.append([
+            InlineKeyboardButton(
+                text=f"{product['name']} - {product['price']}сум/{product['unit']}",
+                callback_data=f"product_{product['id']}"
+            )
+        ])
+
+    navigation = []
+    if page["prev_after"] is not None:
+        navigation.append(InlineKeyboardButton(text="⬅️", callback_data=f"page_{category_id}_{page['prev_after']}"))
+    if page["pages"] > 1:
+        navigation.append(InlineKeyboardButton(text=f"{page['page']}/{page['pages']}", callback_data="page_current"))
+    if page["next_after"] is not None:
+        navigation.append(InlineKeyboardButton(text="➡️", callback_data=f"page_{category_id}_{page['next_after']}"))
+    if navigation:
+        keyboard.append(navigation)
+
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад к категориям", callback_data="back_to_categories")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def get_products_keyboard(category_id: int, after_id: int = 0):
+    """Страница товаров категории; after_id - курсор (id последнего товара предыдущей страницы)"""
+    return _cached_by_catalog_version(("products", category_id, after_id),
+                                      lambda: _build_products_keyboard(category_id, after_id))
+
+
+def get_search_results_keyboard(products, offset: int, has_more: bool):
     keyboard = []
     for product in products:
         keyboard.append([
@@ -40,10 +105,21 @@ def get_products_keyboard(category_id: int):
                 callback_data=f"product_{product['id']}"
             )
         ])
+
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton(
+            text="⬅️", callback_data=f"search_page_{max(0, offset - SEARCH_PAGE_SIZE)}"))
+    if has_more:
+        navigation.append(InlineKeyboardButton(text="➡️", callback_data=f"search_page_{offset + SEARCH_PAGE_SIZE}"))
+    if navigation:
+        keyboard.append(navigation)
+
     keyboard.append([InlineKeyboardButton(text="🔙 Назад к категориям", callback_data="back_to_categories")])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+@lru_cache(maxsize=1024)
 def get_quantity_keyboard(current_quantity: int = 0):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -60,41 +136,67 @@ def get_quantity_keyboard(current_quantity: int = 0):
     )
 
 
+for _quantity in range(PRECOMPUTED_QUANTITIES + 1):
+    get_quantity_keyboard(_quantity)
+
+
+_CART_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🛒 В каталог"), KeyboardButton(text="💳 К оформлению")]
+    ],
+    resize_keyboard=True
+)
+
+
 def get_cart_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🛒 В каталог"), KeyboardButton(text="💳 К оформлению")]
+    return _CART_KEYBOARD
+
+
+_CART_INLINE_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="🛒 Продолжить покупки", callback_data="continue_shopping"),
+            InlineKeyboardButton(text="💳 Оформить заказ", callback_data="start_checkout_inline")
         ],
-        resize_keyboard=True
-    )
+        [InlineKeyboardButton(text="🗑 Очистить корзину", callback_data="clear_cart")]
+    ]
+)
 
 
 def get_cart_inline_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🛒 Продолжить покупки", callback_data="continue_shopping"),
-                InlineKeyboardButton(text="💳 Оформить заказ", callback_data="start_checkout_inline")
-            ],
-            [InlineKeyboardButton(text="🗑 Очистить корзину", callback_data="clear_cart")]
-        ]
-    )
+    return _CART_INLINE_KEYBOARD
+
+
+_ADMIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="✏️ Изменить товар")],
+        [KeyboardButton(text="🗑 Удалить товар"), KeyboardButton(text="📋 Список товаров")],
+        [KeyboardButton(text="📤 Экспорт CSV"), KeyboardButton(text="📥 Импорт товаров")],
+        [KeyboardButton(text="💲 Цены и остатки"), KeyboardButton(text="📢 Рассылка")],
+        [KeyboardButton(text="🔙 Выйти из админки")]
+    ],
+    resize_keyboard=True
+)
 
 
 def get_admin_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="✏️ Изменить товар")],
-            [KeyboardButton(text="🗑 Удалить товар"), KeyboardButton(text="📋 Список товаров")],
-            [KeyboardButton(text="🔙 Выйти из админки")]
-        ],
-        resize_keyboard=True
-    )
+    return _ADMIN_KEYBOARD
 
 
-def get_categories_admin_keyboard():
-    categories = db.get_categories()
-    keyboard = [[KeyboardButton(text=cat["name"])] for cat in categories]
+def get_admin_products_keyboard(prev_before_id=None, next_after_id=None):
+    """Листание списка товаров в админке; None - кнопки нет"""
+    navigation = []
+    if prev_before_id is not None:
+        navigation.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"admin_products_prev_{prev_before_id}"))
+    if next_after_id is not None:
+        navigation.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"admin_products_next_{next_after_id}"))
+    if not navigation:
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[navigation])
+
+
+def _build_categories_admin_keyboard():
+    keyboard = [[KeyboardButton(text=cat["name"])] for cat in catalog.get_categories()]
     return ReplyKeyboardMarkup(
         keyboard=keyboard,
         resize_keyboard=True,
@@ -102,40 +204,78 @@ def get_categories_admin_keyboard():
     )
 
 
-# keyboards.py - обновите функцию get_edit_product_keyboard()
+def get_categories_admin_keyboard():
+    return _cached_by_catalog_version("categories_admin", _build_categories_admin_keyboard)
+
+
+_EDIT_PRODUCT_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Название"), KeyboardButton(text="Цена")],
+        [KeyboardButton(text="Количество"), KeyboardButton(text="Категория")],
+        [KeyboardButton(text="Фото"), KeyboardButton(text="🔙 Назад")]
+    ],
+    resize_keyboard=True
+)
+
 
 def get_edit_product_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Название"), KeyboardButton(text="Цена")],
-            [KeyboardButton(text="Количество"), KeyboardButton(text="Категория")],
-            [KeyboardButton(text="Фото"), KeyboardButton(text="🔙 Назад")]
-        ],
-        resize_keyboard=True
-    )
+    return _EDIT_PRODUCT_KEYBOARD
+
+
+_BACK_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="🔙 Назад")]],
+    resize_keyboard=True
+)
+
+
+def get_back_keyboard():
+    return _BACK_KEYBOARD
+
+
+_SKIP_PHOTO_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="пропустить")]],
+    resize_keyboard=True
+)
 
 
 def get_skip_photo_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="пропустить")]],
-        resize_keyboard=True
-    )
+    return _SKIP_PHOTO_KEYBOARD
+
+
+_LOCATION_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="📍 Отправить геолокацию", request_location=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
 
 
 def get_location_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text="📍 Отправить геолокацию", request_location=True)]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
+    return _LOCATION_KEYBOARD
+
+
+_CONFIRM_ORDER_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_order"),
+            InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_order")
+        ]
+    ]
+)
 
 
 def get_confirm_order_keyboard():
-    return InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_order"),
-                InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_order")
-            ]
+    return _CONFIRM_ORDER_KEYBOARD
+
+
+_BROADCAST_CONFIRM_KEYBOARD = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Отправить", callback_data="broadcast_confirm"),
+            InlineKeyboardButton(text="❌ Отменить", callback_data="broadcast_cancel")
         ]
-    )
+    ]
+)
+
+
+def get_broadcast_confirm_keyboard():
+    return _BROADCAST_CONFIRM_KEYBOARD
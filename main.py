@@ -3,12 +3,17 @@ import asyncio
 import logging
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
 
-from database import Database
+from storage import SQLiteStorage
 from states import AdminStates, ShoppingStates, OrderStates, RegistrationStates
 from user_handlers import UserHandlers
 from admins import AdminHandlers
+from photo_cache import photo_cache
+from catalog import catalog
+from stock import stock
+from broadcast import broadcaster
+from webhook import run_webhook
+from sharding import run_sharded_polling, run_sharded_webhook
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -17,17 +22,28 @@ logger = logging.getLogger(__name__)
 # Токены и настройки
 BOT_TOKEN = ""
 ADMIN_PASSWORD = ""
-
-
-async def main():
-    # Инициализация бота и диспетчера
-    bot = Bot(token=BOT_TOKEN)
-    storage = MemoryStorage()
+# ID приватного чата для предзагрузки фото товаров (None - без прогрева)
+PHOTO_CACHE_CHAT_ID = None
+
+# Режим получения обновлений: "polling" или "webhook"
+RUN_MODE = "polling"
+# Настройки webhook (используются при RUN_MODE = "webhook")
+WEBHOOK_URL = ""  # публичный адрес, например https://shop.example.com/webhook
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # секретный токен, проверяется в каждом запросе Telegram
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_MAX_CONCURRENCY = 100  # сколько обновлений обрабатывается одновременно
+# Число процессов-обработчиков. Больше 1 - обновления получает супервизор
+# и раздаёт воркерам по from_user.id (используйте по числу ядер)
+WORKERS = 1
+
+
+def create_dispatcher(bot: Bot) -> Dispatcher:
+    # Состояния FSM переживают перезапуск бота
+    storage = SQLiteStorage()
     dp = Dispatcher(storage=storage)
 
-    # Инициализация базы данных
-    db = Database()
-
     # Инициализация обработчиков
     user_handlers = UserHandlers(bot)
     admin_handlers = AdminHandlers(bot)
@@ -35,6 +51,7 @@ async def main():
     # ===== РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ ПОЛЬЗОВАТЕЛЕЙ =====
     # Команды
     dp.message.register(user_handlers.cmd_start, Command("start"))
+    dp.message.register(user_handlers.start_search, Command("search"))
 
     # Регистрация
     dp.message.register(user_handlers.process_phone, RegistrationStates.waiting_for_phone, F.contact)
@@ -43,9 +60,15 @@ async def main():
     # Главное меню
     dp.message.register(user_handlers.show_catalog, F.text == "🛒 Каталог")
     dp.message.register(user_handlers.show_cart, F.text == "🛍️ Корзина")
+    dp.message.register(user_handlers.start_search, F.text == "🔍 Поиск")
+
+    # Поиск
+    dp.message.register(user_handlers.process_search_query, ShoppingStates.searching, F.text)
+    dp.callback_query.register(user_handlers.search_page, F.data.startswith("search_page_"))
 
     # Каталог и товары
     dp.callback_query.register(user_handlers.process_category, F.data.startswith("category_"))
+    dp.callback_query.register(user_handlers.process_products_page, F.data.startswith("page_"))
     dp.callback_query.register(user_handlers.process_product, F.data.startswith("product_"))
 
     # Количество товара
@@ -71,6 +94,9 @@ async def main():
     dp.callback_query.register(user_handlers.start_checkout_inline, F.data == "start_checkout_inline")
     dp.callback_query.register(user_handlers.clear_cart, F.data == "clear_cart")
 
+    # Inline-запросы (@бот название товара)
+    dp.inline_query.register(user_handlers.process_inline_query)
+
     # ===== РЕГИСТРАЦИЯ ОБРАБОТЧИКОВ АДМИНА =====
     # Команда админа - ВАЖНО: регистрируем ДО общего обработчика сообщений
     dp.message.register(admin_handlers.cmd_admin, Command("admin"))
@@ -79,9 +105,17 @@ async def main():
     dp.message.register(admin_handlers.check_admin_password, AdminStates.waiting_for_password)
     dp.message.register(admin_handlers.start_add_product, AdminStates.admin_menu, F.text == "➕ Добавить товар")
     dp.message.register(admin_handlers.show_all_products, AdminStates.admin_menu, F.text == "📋 Список товаров")
+    dp.callback_query.register(admin_handlers.products_page, AdminStates.admin_menu,
+                               F.data.startswith("admin_products_"))
+    dp.message.register(admin_handlers.export_products, AdminStates.admin_menu, F.text == "📤 Экспорт CSV")
+    dp.message.register(admin_handlers.start_import, AdminStates.admin_menu, F.text == "📥 Импорт товаров")
+    dp.message.register(admin_handlers.show_report, AdminStates.admin_menu, Command("report"))
+    dp.message.register(admin_handlers.show_forecast, AdminStates.admin_menu, Command("forecast"))
+    dp.message.register(admin_handlers.start_bulk_update, AdminStates.admin_menu, F.text == "💲 Цены и остатки")
     dp.message.register(admin_handlers.exit_admin, AdminStates.admin_menu, F.text == "🔙 Выйти из админки")
     dp.message.register(admin_handlers.start_edit_product, AdminStates.admin_menu, F.text == "✏️ Изменить товар")
     dp.message.register(admin_handlers.start_delete_product, AdminStates.admin_menu, F.text == "🗑 Удалить товар")
+    dp.message.register(admin_handlers.start_broadcast, AdminStates.admin_menu, F.text == "📢 Рассылка")
     dp.message.register(admin_handlers.process_product_name, AdminStates.adding_product_name)
     dp.message.register(admin_handlers.process_product_price, AdminStates.adding_product_price)
     dp.message.register(admin_handlers.process_product_quantity, AdminStates.adding_product_quantity)
@@ -101,13 +135,96 @@ async def main():
                         F.text == "пропустить")
     dp.message.register(admin_handlers.process_edit_product_photo, AdminStates.editing_product_photo, F.photo)
 
+    # Рассылка
+    dp.message.register(admin_handlers.process_broadcast_text, AdminStates.broadcast_text)
+    dp.callback_query.register(admin_handlers.confirm_broadcast, AdminStates.broadcast_confirm,
+                               F.data == "broadcast_confirm")
+    dp.callback_query.register(admin_handlers.cancel_broadcast, AdminStates.broadcast_confirm,
+                               F.data == "broadcast_cancel")
+
+    # Импорт товаров из файла
+    dp.message.register(admin_handlers.process_import_file, AdminStates.importing_products, F.document)
+    dp.message.register(admin_handlers.cancel_import, AdminStates.importing_products)
+
+    # Массовое изменение цен и остатков
+    dp.message.register(admin_handlers.cancel_bulk_update, AdminStates.bulk_updating, F.text == "🔙 Назад")
+    dp.message.register(admin_handlers.process_bulk_update, AdminStates.bulk_updating, F.text | F.document)
+
     # Неизвестные сообщения (регистрируется ПОСЛЕДНИМ)
     dp.message.register(user_handlers.unknown_message)
 
+    return dp
+
+
+async def prepare(bot: Bot, background_jobs: bool = True):
+    """
+    Загружает кэши в память и запускает фоновые задачи.
+    В режиме воркеров фоновые задачи запускает только один процесс.
+    """
+    # Снимок каталога в памяти
+    await catalog.load()
+    await stock.load()
+
+    # Кэш file_id фото товаров
+    await photo_cache.load()
+    if not background_jobs:
+        return
+    if PHOTO_CACHE_CHAT_ID:
+        asyncio.create_task(photo_cache.warm_up(bot, PHOTO_CACHE_CHAT_ID))
+
+    # Незавершённые рассылки продолжаются после перезапуска
+    await broadcaster.resume(bot)
+
+
+async def run_workers():
+    # Диспетчер в супервизоре нужен только для списка типов обновлений,
+    # обрабатывают обновления воркеры
+    bot = Bot(token=BOT_TOKEN)
+    allowed_updates = create_dispatcher(bot).resolve_used_update_types()
+    await bot.session.close()
+
+    logger.info(f"Бот запущен с {WORKERS} воркерами в режиме {RUN_MODE}!")
+    if RUN_MODE == "webhook":
+        await run_sharded_webhook(
+            BOT_TOKEN, WORKERS,
+            url=WEBHOOK_URL,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            max_concurrency=WEBHOOK_MAX_CONCURRENCY,
+            allowed_updates=allowed_updates
+        )
+    else:
+        await run_sharded_polling(BOT_TOKEN, WORKERS, WEBHOOK_MAX_CONCURRENCY, allowed_updates=allowed_updates)
+
+
+async def main():
+    if WORKERS > 1:
+        await run_workers()
+        return
+
+    # Инициализация бота и диспетчера
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher(bot)
+    await prepare(bot)
+
     # Запуск бота
-    await bot.delete_webhook(drop_pending_updates=True)
-    logger.info("Бот запущен!")
-    await dp.start_polling(bot)
+    if RUN_MODE == "webhook":
+        logger.info("Бот запущен в режиме webhook!")
+        await run_webhook(
+            bot, dp,
+            url=WEBHOOK_URL,
+            path=WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            max_concurrency=WEBHOOK_MAX_CONCURRENCY
+        )
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        logger.info("Бот запущен!")
+        await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from aiogram import Bot, types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from database import AsyncDatabase, db
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз прогрев ждёт флуд-контроль ради одного фото, прежде чем пропустить его
+WARM_UP_MAX_RETRIES = 5
+
+
+class PhotoCache:
+    """
+    Кэш file_id Telegram для фото товаров.
+    Ключ - image_ref (хэш содержимого), поэтому новая версия фото
+    автоматически получает новую запись, а старая удаляется через invalidate.
+    """
+
+    def __init__(self, db: AsyncDatabase):
+        self.db = db
+        self._file_ids: Dict[str, str] = {}
+
+    async def load(self):
+        self._file_ids = await self.db.get_photo_file_ids()
+        logger.info(f"Загружено file_id фото из кэша: {len(self._file_ids)}")
+
+    def get(self, image_ref: str) -> Optional[str]:
+        return self._file_ids.get(image_ref)
+
+    async def remember(self, image_ref: str, file_id: str):
+        self._file_ids[image_ref] = file_id
+        await self.db.set_photo_file_id(image_ref, file_id)
+
+    async def invalidate(self, image_ref: Optional[str]):
+        if not image_ref:
+            return
+        self._file_ids.pop(image_ref, None)
+        await self.db.delete_photo_file_id(image_ref)
+
+    def _input_file(self, image_ref: str) -> types.FSInputFile:
+        images = self.db.images
+        return types.FSInputFile(images.path(image_ref), filename=f"{image_ref[:16]}.{images.extension(image_ref)}")
+
+    async def send_product_photo(self, message: types.Message, image_ref: str, **kwargs) -> types.Message:
+        """Отправляет фото по file_id из кэша, а при промахе загружает файл и запоминает file_id"""
+        file_id = self._file_ids.get(image_ref)
+        if file_id:
+            try:
+                return await message.answer_photo(photo=file_id, **kwargs)
+            except TelegramBadRequest as e:
+                logger.warning(f"file_id для {image_ref} недействителен, загружаем заново: {e}")
+                await self.invalidate(image_ref)
+
+        sent = await message.answer_photo(photo=self._input_file(image_ref), **kwargs)
+        await self.remember(image_ref, sent.photo[-1].file_id)
+        return sent
+
+    async def _upload(self, bot: Bot, chat_id: int, image_ref: str) -> types.Message:
+        """Загружает фото, пережидая флуд-контроль не больше WARM_UP_MAX_RETRIES раз"""
+        retries = 0
+        while True:
+            try:
+                return await bot.send_photo(chat_id, photo=self._input_file(image_ref), disable_notification=True)
+            except TelegramRetryAfter as e:
+                retries += 1
+                if retries > WARM_UP_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(e.retry_after)
+
+    async def warm_up(self, bot: Bot, chat_id: int, delay: float = 1.0):
+        """
+        Заранее загружает все фото товаров в приватный чат,
+        чтобы даже первый просмотр товара шёл по готовому file_id
+        """
+        image_refs = [ref for ref in await self.db.get_product_image_refs() if ref not in self._file_ids]
+        uploaded = 0
+
+        for image_ref in image_refs:
+            if not self.db.images.exists(image_ref):
+                continue
+            try:
+                sent = await self._upload(bot, chat_id, image_ref)
+            except Exception as e:
+                logger.error(f"Ошибка прогрева фото {image_ref}: {e}")
+                continue
+
+            await self.remember(image_ref, sent.photo[-1].file_id)
+            uploaded += 1
+
+            try:
+                await bot.delete_message(chat_id, sent.message_id)
+            except TelegramBadRequest:
+                pass
+
+            await asyncio.sleep(delay)
+
+        logger.info(f"Прогрев кэша фото завершён, загружено: {uploaded}")
+
+
+photo_cache = PhotoCache(db)
@@ -0,0 +1,108 @@
+import logging
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.types import PhotoSize
+
+from image_utils import IMAGE_VARIANTS, process_image_variants_async
+
+logger = logging.getLogger(__name__)
+
+# Максимальный размер загружаемого фото
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+
+# Сигнатуры поддерживаемых форматов: (смещение, байты, формат)
+_SIGNATURES = (
+    (0, b"\xff\xd8\xff", "JPEG"),
+    (0, b"\x89PNG\r\n\x1a\n", "PNG"),
+    (0, b"GIF87a", "GIF"),
+    (0, b"GIF89a", "GIF"),
+    (8, b"WEBP", "WEBP"),
+)
+# Сколько байт заголовка нужно для определения формата
+SNIFF_BYTES = 12
+
+UNSUPPORTED_FORMAT_TEXT = "Поддерживаются только изображения в формате JPG, PNG, WEBP или GIF"
+
+
+class PhotoIngestError(Exception):
+    """Фото нельзя принять; текст ошибки можно показать админу"""
+
+
+def _too_large(max_bytes: int) -> PhotoIngestError:
+    return PhotoIngestError(f"Файл слишком большой (максимум {max_bytes // (1024 * 1024)} МБ)")
+
+
+def sniff_image_format(header: bytes) -> Optional[str]:
+    """Формат изображения по первым байтам файла, None - неподдерживаемый"""
+    for offset, signature, image_format in _SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            if image_format == "WEBP" and not header.startswith(b"RIFF"):
+                continue
+            return image_format
+    return None
+
+
+def choose_photo_size(photos: List[PhotoSize]) -> PhotoSize:
+    """
+    Наименьший из размеров, присланных Telegram, которого хватает
+    для самого большого варианта изображения - меньше данных на скачивание
+    """
+    needed = max(max(size) for size in IMAGE_VARIANTS.values())
+    for photo in sorted(photos, key=lambda item: item.width * item.height):
+        if max(photo.width, photo.height) >= needed:
+            return photo
+    return max(photos, key=lambda item: item.width * item.height)
+
+
+async def download_photo(bot: Bot, file_id: str, max_bytes: int = MAX_PHOTO_BYTES) -> bytes:
+    """
+    Скачивает файл частями с жёстким ограничением размера.
+    Формат проверяется по первым байтам, до скачивания остального файла.
+    """
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > max_bytes:
+        raise _too_large(max_bytes)
+
+    if bot.session.api.is_local:
+        # Локальный Bot API сервер отдаёт файл с диска
+        stream = await bot.download_file(file.file_path, timeout=DOWNLOAD_TIMEOUT)
+        data = stream.read(max_bytes + 1)
+        if len(data) > max_bytes:
+            raise _too_large(max_bytes)
+        if sniff_image_format(data[:SNIFF_BYTES]) is None:
+            raise PhotoIngestError(UNSUPPORTED_FORMAT_TEXT)
+        return data
+
+    buffer = bytearray()
+    checked = False
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    stream = bot.session.stream_content(url=url, timeout=DOWNLOAD_TIMEOUT, chunk_size=DOWNLOAD_CHUNK_SIZE)
+    try:
+        async for chunk in stream:
+            buffer += chunk
+            if len(buffer) > max_bytes:
+                raise _too_large(max_bytes)
+            if not checked and len(buffer) >= SNIFF_BYTES:
+                if sniff_image_format(bytes(buffer[:SNIFF_BYTES])) is None:
+                    raise PhotoIngestError(UNSUPPORTED_FORMAT_TEXT)
+                checked = True
+    finally:
+        await stream.aclose()
+
+    if not checked:
+        raise PhotoIngestError(UNSUPPORTED_FORMAT_TEXT)
+    return bytes(buffer)
+
+
+async def ingest_photo(bot: Bot, photos: List[PhotoSize]) -> Dict[str, bytes]:
+    """
+    Единый путь загрузки фото товара: выбор размера, потоковое скачивание,
+    проверка формата и подготовка вариантов в пуле процессов.
+    Возвращает {имя варианта: байты} для db.add_product / db.set_product_images
+    """
+    photo = choose_photo_size(photos)
+    data = await download_photo(bot, photo.file_id)
+    return await process_image_variants_async(data)
@@ -0,0 +1,526 @@
+import os
+import io
+import re
+import csv
+import time
+import asyncio
+import logging
+import zipfile
+import tempfile
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout
+from aiogram import Bot
+from aiogram.types import Document
+
+from catalog import catalog, normalize_name
+from database import db
+from image_utils import ImageQueueFullError, process_image_variants_async
+from photo_ingest import (DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT, MAX_PHOTO_BYTES, SNIFF_BYTES,
+                          UNSUPPORTED_FORMAT_TEXT, sniff_image_format)
+
+logger = logging.getLogger(__name__)
+
+# Bot API отдаёт ботам файлы не больше 20 МБ
+MAX_IMPORT_FILE_BYTES = 20 * 1024 * 1024
+IMPORT_FORMATS = (".csv", ".xlsx", ".zip")
+# Строк в одной транзакции записи
+IMPORT_BATCH_SIZE = 500
+# Сколько фото скачивается и обрабатывается одновременно
+IMPORT_IMAGE_CONCURRENCY = 4
+# Сколько ошибок по строкам показывать в отчёте
+MAX_REPORTED_ERRORS = 30
+MAX_NAME_LENGTH = 200
+
+# Заголовки колонок (как в выгрузке PRODUCT_CSV_COLUMNS, плюс русские названия и фото)
+COLUMN_ALIASES = {
+    "id": "id",
+    "name": "name", "название": "name",
+    "price": "price", "цена": "price",
+    "quantity": "quantity", "количество": "quantity",
+    "unit": "unit", "ед": "unit",
+    "category": "category", "категория": "category",
+    "image": "image", "фото": "image",
+}
+REQUIRED_COLUMNS = ("name", "price", "quantity", "category")
+DEFAULT_UNIT = "кг"
+
+# Список изменений цен и остатков присылается текстом или небольшим файлом
+BULK_UPDATE_FORMATS = (".csv", ".txt")
+MAX_BULK_UPDATE_BYTES = 1024 * 1024
+# "Фрукты +10%", "Овощи -5,5%"
+_ADJUSTMENT_RE = re.compile(r"^(.+?)\s+([+-]?\d+(?:[.,]\d+)?)\s*%$")
+
+
+class ProductImportError(Exception):
+    """Файл нельзя импортировать целиком; текст ошибки можно показать админу"""
+
+
+class ImportReport:
+    """Итог импорта для админа"""
+
+    def __init__(self):
+        self.rows = 0
+        self.added = 0
+        self.updated = 0
+        self.images = 0
+        # (номер строки, текст ошибки)
+        self.errors: List[Tuple[int, str]] = []
+        self.image_errors: List[Tuple[int, str]] = []
+        self.elapsed = 0.0
+
+    def format(self) -> str:
+        lines = [
+            f"📥 Импорт завершён за {self.elapsed:.1f} с",
+            "",
+            f"Строк в файле: {self.rows}",
+            f"➕ Добавлено: {self.added}",
+            f"✏️ Обновлено: {self.updated}",
+        ]
+        if self.images or self.image_errors:
+            lines.append(f"🖼 Фото: {self.images} (с ошибками: {len(self.image_errors)})")
+        lines.append(f"❌ Строк с ошибками: {len(self.errors)}")
+
+        errors = sorted(self.errors + self.image_errors)
+        if errors:
+            lines.append("")
+            lines.extend(f"Строка {row}: {text}" for row, text in errors[:MAX_REPORTED_ERRORS])
+            if len(errors) > MAX_REPORTED_ERRORS:
+                lines.append(f"... и ещё {len(errors) - MAX_REPORTED_ERRORS}")
+        return "\n".join(lines)
+
+
+# ===== ЧТЕНИЕ ФАЙЛА =====
+class _ImportSource:
+    """
+    Построчное чтение CSV/XLSX без загрузки файла в память целиком.
+    ZIP-архив содержит таблицу и фото, на которые ссылается колонка image
+    """
+
+    def __init__(self, path: str, suffix: str):
+        self._archive = None
+        self._file = None
+        try:
+            if suffix == ".zip":
+                self._archive = zipfile.ZipFile(path)
+                tables = [name for name in self._archive.namelist()
+                          if os.path.splitext(name)[1].lower() in (".csv", ".xlsx")
+                          and not name.startswith("__MACOSX/")]
+                if not tables:
+                    raise ProductImportError("В архиве нет таблицы CSV или XLSX")
+                table = min(tables, key=lambda name: (name.count("/"), name))
+                self._suffix = os.path.splitext(table)[1].lower()
+                self._file = self._archive.open(table)
+            else:
+                self._suffix = suffix
+                self._file = open(path, "rb")
+        except (zipfile.BadZipFile, OSError) as e:
+            self.close()
+            raise ProductImportError(f"Не удалось открыть файл: {e}")
+
+    def rows(self) -> Iterator[Tuple[int, List]]:
+        """(номер строки, значения) начиная с заголовка"""
+        if self._suffix == ".xlsx":
+            return self._xlsx_rows()
+        return self._csv_rows()
+
+    def _csv_rows(self) -> Iterator[Tuple[int, List]]:
+        text = io.TextIOWrapper(self._file, encoding="utf-8-sig", newline="")
+        try:
+            header = text.readline()
+            # Выгрузка и Excel в русской локали пишут ";", остальные - ","
+            delimiter = ";" if header.count(";") >= header.count(",") else ","
+            lines = (line for source in ([header], text) for line in source)
+            yield from enumerate(csv.reader(lines, delimiter=delimiter), 1)
+        except UnicodeDecodeError:
+            raise ProductImportError("CSV-файл должен быть в кодировке UTF-8")
+        except csv.Error as e:
+            raise ProductImportError(f"Не удалось прочитать CSV: {e}")
+
+    def _xlsx_rows(self) -> Iterator[Tuple[int, List]]:
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ProductImportError("Импорт XLSX недоступен: не установлен openpyxl. Сохраните таблицу в CSV")
+        try:
+            workbook = load_workbook(self._file, read_only=True, data_only=True)
+        except Exception as e:
+            raise ProductImportError(f"Не удалось прочитать XLSX: {e}")
+        try:
+            for number, values in enumerate(workbook.active.iter_rows(values_only=True), 1):
+                yield number, ["" if value is None else value for value in values]
+        finally:
+            workbook.close()
+
+    def read_image(self, name: str, max_bytes: int = MAX_PHOTO_BYTES) -> bytes:
+        """Фото из архива по имени файла"""
+        if self._archive is None:
+            raise ValueError("фото по имени файла можно передать только в ZIP-архиве")
+        try:
+            info = self._archive.getinfo(name.lstrip("/"))
+        except KeyError:
+            raise ValueError(f"файла {name} нет в архиве")
+        if info.file_size > max_bytes:
+            raise ValueError(f"фото больше {max_bytes // (1024 * 1024)} МБ")
+        return self._archive.read(info)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._archive is not None:
+            self._archive.close()
+
+
+# ===== ПРОВЕРКА СТРОК =====
+def _parse_number(value, kind):
+    if isinstance(value, (int, float)):
+        return kind(value)
+    # "1 200,50" из Excel -> 1200.50
+    text = str(value).replace("\u00a0", "").replace(" ", "").replace(",", ".")
+    number = float(text)
+    if kind is int:
+        if not number.is_integer():
+            raise ValueError
+        return int(number)
+    return number
+
+
+class _RowValidator:
+    """Превращает значения строки в товар; ошибки - ValueError с текстом для отчёта"""
+
+    def __init__(self, header: List):
+        self.columns: Dict[str, int] = {}
+        for index, title in enumerate(header):
+            key = COLUMN_ALIASES.get(str(title).strip().lower())
+            if key and key not in self.columns:
+                self.columns[key] = index
+        missing = [column for column in REQUIRED_COLUMNS if column not in self.columns]
+        if missing:
+            raise ProductImportError(
+                f"В таблице нет колонок: {', '.join(missing)}\n"
+                f"Нужен заголовок как в выгрузке: id;name;price;quantity;unit;category (и image для фото)"
+            )
+
+        # Категории и товары ищутся в каталоге в памяти, без запросов к базе на каждую строку
+        self.categories = {normalize_name(category["raw_name"]): category["id"]
+                           for category in catalog.get_categories()}
+        self._seen_ids = set()
+        self._seen_names = set()
+
+    def _value(self, values: List, column: str):
+        index = self.columns.get(column)
+        if index is None or index >= len(values):
+            return ""
+        value = values[index]
+        return value.strip() if isinstance(value, str) else value
+
+    def validate(self, values: List) -> Dict:
+        name = str(self._value(values, "name"))
+        if not name:
+            raise ValueError("не указано название")
+        if len(name) > MAX_NAME_LENGTH:
+            raise ValueError(f"название длиннее {MAX_NAME_LENGTH} символов")
+
+        try:
+            price = _parse_number(self._value(values, "price"), float)
+        except (TypeError, ValueError):
+            raise ValueError("цена должна быть числом")
+        if price < 0:
+            raise ValueError("цена не может быть отрицательной")
+
+        try:
+            quantity = _parse_number(self._value(values, "quantity"), int)
+        except (TypeError, ValueError):
+            raise ValueError("количество должно быть целым числом")
+        if quantity < 0:
+            raise ValueError("количество не может быть отрицательным")
+
+        category = str(self._value(values, "category"))
+        category_id = self.categories.get(normalize_name(category))
+        if category_id is None:
+            raise ValueError(f"категория «{category}» не найдена")
+
+        # Товар ищется по id, а без id - по названию; иначе добавляется новый
+        raw_id = self._value(values, "id")
+        if raw_id != "":
+            try:
+                product_id = _parse_number(raw_id, int)
+            except (TypeError, ValueError):
+                raise ValueError("id должен быть целым числом")
+            if catalog.get_product(product_id) is None:
+                raise ValueError(f"товар с id {product_id} не найден")
+        else:
+            product_id = catalog.find_by_name(name)
+
+        key = product_id if product_id is not None else normalize_name(name)
+        seen = self._seen_ids if product_id is not None else self._seen_names
+        if key in seen:
+            raise ValueError("товар уже встречался выше в файле")
+        seen.add(key)
+
+        return {
+            "id": product_id,
+            "name": name,
+            "price": price,
+            "quantity": quantity,
+            "unit": str(self._value(values, "unit")) or DEFAULT_UNIT,
+            "category_id": category_id,
+            "image": str(self._value(values, "image")),
+        }
+
+
+def _read_batch(rows: Iterator[Tuple[int, List]], validator: _RowValidator, report: ImportReport,
+                size: int) -> List[Tuple[int, Dict]]:
+    """Следующие size корректных строк; выполняется в потоке, чтобы не блокировать бота"""
+    batch = []
+    for number, values in rows:
+        if not any(value != "" for value in values):
+            continue
+        report.rows += 1
+        try:
+            batch.append((number, validator.validate(values)))
+        except ValueError as e:
+            report.errors.append((number, str(e)))
+        if len(batch) >= size:
+            break
+    return batch
+
+
+# ===== ФОТО =====
+async def _download_image(session: ClientSession, url: str) -> bytes:
+    buffer = bytearray()
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise ValueError(f"фото недоступно (HTTP {response.status})")
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > MAX_PHOTO_BYTES:
+                raise ValueError(f"фото больше {MAX_PHOTO_BYTES // (1024 * 1024)} МБ")
+    return bytes(buffer)
+
+
+async def _import_images(source: _ImportSource, images: List[Tuple[int, int, str]], report: ImportReport):
+    """images - (номер строки, id товара, URL или имя файла в архиве)"""
+    loop = asyncio.get_running_loop()
+    pending = iter(images)
+
+    async def worker(session: ClientSession):
+        for number, product_id, image in pending:
+            try:
+                if image.lower().startswith(("http://", "https://")):
+                    data = await _download_image(session, image)
+                else:
+                    data = await loop.run_in_executor(None, source.read_image, image)
+                if sniff_image_format(data[:SNIFF_BYTES]) is None:
+                    raise ValueError(UNSUPPORTED_FORMAT_TEXT)
+
+                while True:
+                    try:
+                        variants = await process_image_variants_async(data)
+                        break
+                    except ImageQueueFullError:
+                        # Пул занят фото, которые прямо сейчас загружают админы
+                        await asyncio.sleep(1)
+                await db.set_product_images(product_id, variants)
+                report.images += 1
+            except Exception as e:
+                report.image_errors.append((number, f"фото не загружено: {e}"))
+
+    async with ClientSession(timeout=ClientTimeout(total=DOWNLOAD_TIMEOUT)) as session:
+        await asyncio.gather(*(worker(session) for _ in range(IMPORT_IMAGE_CONCURRENCY)))
+
+
+# ===== ИМПОРТ =====
+async def import_products_file(path: str, suffix: str) -> ImportReport:
+    """
+    Импорт товаров из файла: строки читаются и проверяются в потоке пачками,
+    каждая пачка записывается одной транзакцией, фото обрабатываются в пуле процессов.
+    Каталог в памяти перечитывается один раз в конце
+    """
+    report = ImportReport()
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+
+    source = await loop.run_in_executor(None, _ImportSource, path, suffix)
+    try:
+        rows = source.rows()
+        first = await loop.run_in_executor(None, next, rows, None)
+        if first is None or not any(value != "" for value in first[1]):
+            raise ProductImportError("Файл пустой")
+        validator = _RowValidator(first[1])
+
+        images = []
+        try:
+            while True:
+                batch = await loop.run_in_executor(None, _read_batch, rows, validator, report,
+                                                   IMPORT_BATCH_SIZE)
+                if not batch:
+                    break
+
+                updates = [(product["name"], product["price"], product["quantity"], product["unit"],
+                            product["category_id"], product["id"])
+                           for _, product in batch if product["id"] is not None]
+                inserted = [(number, product) for number, product in batch if product["id"] is None]
+                new_ids = await db.upsert_products(updates, [
+                    (product["name"], product["price"], product["quantity"], product["unit"],
+                     product["category_id"])
+                    for _, product in inserted
+                ])
+                for (_, product), product_id in zip(inserted, new_ids):
+                    product["id"] = product_id
+                report.updated += len(updates)
+                report.added += len(new_ids)
+
+                images.extend((number, product["id"], product["image"])
+                              for number, product in batch if product["image"])
+        finally:
+            if report.added or report.updated:
+                await catalog.load()
+
+        if images:
+            await _import_images(source, images, report)
+            await catalog.load()
+    finally:
+        await loop.run_in_executor(None, source.close)
+
+    report.elapsed = time.monotonic() - started
+    logger.info(f"Импорт товаров: строк {report.rows}, добавлено {report.added}, обновлено {report.updated}, "
+                f"ошибок {len(report.errors)}, за {report.elapsed:.1f} с")
+    return report
+
+
+async def import_products(bot: Bot, document: Document) -> ImportReport:
+    """Скачивает присланный документ во временный файл и импортирует товары"""
+    suffix = os.path.splitext(document.file_name or "")[1].lower()
+    if suffix not in IMPORT_FORMATS:
+        raise ProductImportError("Поддерживаются файлы CSV, XLSX или ZIP (таблица с фото)")
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_BYTES:
+        raise ProductImportError(f"Файл слишком большой (максимум {MAX_IMPORT_FILE_BYTES // (1024 * 1024)} МБ)")
+
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        # Файл пишется на диск частями, в памяти не держится
+        await bot.download(document, destination=path, timeout=DOWNLOAD_TIMEOUT)
+        return await import_products_file(path, suffix)
+    finally:
+        os.remove(path)
+
+
+# ===== МАССОВОЕ ИЗМЕНЕНИЕ ЦЕН И ОСТАТКОВ =====
+def _bulk_value(values: List[str], index: Optional[int]) -> str:
+    return values[index] if index is not None and index < len(values) else ""
+
+
+def parse_bulk_update(text: str) -> Dict:
+    """
+    Разбирает строки "id;price;quantity" (пустое поле - без изменений)
+    и "Категория +10%". Заголовок, как в выгрузке, задаёт порядок колонок.
+    Возвращает {"changes": [(price, quantity, id)], "adjustments": [(множитель, category_id)],
+    "errors": [(номер строки, текст)]}
+    """
+    categories = {normalize_name(category["raw_name"]): category["id"] for category in catalog.get_categories()}
+    changes, adjustments, errors = [], [], []
+    seen_ids, seen_categories = set(), set()
+    # Позиции колонок id, price, quantity
+    columns = (0, 1, 2)
+    first = True
+
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip().lstrip("\ufeff")
+        if not line:
+            continue
+        values = [value.strip() for value in line.split(";" if ";" in line else "\t")]
+
+        if first:
+            first = False
+            header = [COLUMN_ALIASES.get(value.lower()) for value in values]
+            if "id" in header:
+                columns = tuple(header.index(column) if column in header else None
+                                for column in ("id", "price", "quantity"))
+                continue
+
+        match = _ADJUSTMENT_RE.match(line)
+        if match:
+            category_id = categories.get(normalize_name(match.group(1)))
+            percent = float(match.group(2).replace(",", "."))
+            if category_id is None:
+                errors.append((number, f"категория «{match.group(1)}» не найдена"))
+            elif percent <= -100:
+                errors.append((number, "цену нельзя снизить на 100% и больше"))
+            elif category_id in seen_categories:
+                errors.append((number, "категория уже встречалась выше"))
+            else:
+                seen_categories.add(category_id)
+                adjustments.append((1 + percent / 100, category_id))
+            continue
+
+        try:
+            product_id = _parse_number(_bulk_value(values, columns[0]), int)
+        except (TypeError, ValueError):
+            errors.append((number, "ожидается id;цена;количество или «Категория +10%»"))
+            continue
+        if catalog.get_product(product_id) is None:
+            errors.append((number, f"товар с id {product_id} не найден"))
+            continue
+        if product_id in seen_ids:
+            errors.append((number, "товар уже встречался выше"))
+            continue
+
+        price, quantity = _bulk_value(values, columns[1]), _bulk_value(values, columns[2])
+        try:
+            price = _parse_number(price, float) if price != "" else None
+            if price is not None and price < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            errors.append((number, "цена должна быть неотрицательным числом"))
+            continue
+        try:
+            quantity = _parse_number(quantity, int) if quantity != "" else None
+            if quantity is not None and quantity < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            errors.append((number, "количество должно быть неотрицательным целым числом"))
+            continue
+        if price is None and quantity is None:
+            errors.append((number, "не указаны ни цена, ни количество"))
+            continue
+
+        seen_ids.add(product_id)
+        changes.append((price, quantity, product_id))
+
+    return {"changes": changes, "adjustments": adjustments, "errors": errors}
+
+
+async def apply_bulk_update(text: str) -> Dict:
+    """
+    Применяет список изменений одной транзакцией и перечитывает каталог один раз,
+    так что кэши клавиатур и поиска сбрасываются однократно.
+    Возвращает {"adjusted": .., "changed": .., "categories": .., "errors": [..]}
+    """
+    loop = asyncio.get_running_loop()
+    parsed = await loop.run_in_executor(None, parse_bulk_update, text)
+
+    result = {"adjusted": 0, "changed": 0}
+    if parsed["changes"] or parsed["adjustments"]:
+        result = await db.bulk_update_products(parsed["changes"], parsed["adjustments"])
+        await catalog.load()
+
+    result["categories"] = len(parsed["adjustments"])
+    result["errors"] = parsed["errors"]
+    return result
+
+
+async def read_bulk_update_document(bot: Bot, document: Document) -> str:
+    """Текст присланного файла со списком изменений"""
+    suffix = os.path.splitext(document.file_name or "")[1].lower()
+    if suffix not in BULK_UPDATE_FORMATS:
+        raise ProductImportError("Поддерживаются файлы CSV или TXT")
+    if document.file_size and document.file_size > MAX_BULK_UPDATE_BYTES:
+        raise ProductImportError(f"Файл слишком большой (максимум {MAX_BULK_UPDATE_BYTES // 1024} КБ)")
+
+    data = await bot.download(document, timeout=DOWNLOAD_TIMEOUT)
+    try:
+        return data.read(MAX_BULK_UPDATE_BYTES + 1).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ProductImportError("Файл должен быть в кодировке UTF-8")
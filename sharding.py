@@ -0,0 +1,267 @@
+import asyncio
+import signal
+import logging
+import multiprocessing
+import queue
+from typing import List, Optional
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.types import Update
+
+from catalog import catalog
+from stock import stock
+from webhook import SECRET_HEADER, UpdateRunner, get_update_user_id
+
+logger = logging.getLogger(__name__)
+
+# Сколько обновлений может ждать в очереди одного воркера
+WORKER_QUEUE_SIZE = 10000
+# Сколько секунд поток воркера ждёт обновление, прежде чем вернуть управление
+# циклу событий и проверить, жив ли супервизор
+WORKER_QUEUE_TIMEOUT = 1.0
+# Как часто воркер проверяет, не изменился ли каталог в другом процессе
+CATALOG_POLL_INTERVAL = 1.0
+# Сколько записей журнала изменений товаров читать за один запрос
+PRODUCT_CHANGES_BATCH = 1000
+
+
+def get_shard(data: dict, workers: int) -> int:
+    """
+    Номер воркера для обновления. Все обновления одного пользователя
+    попадают в один процесс, поэтому порядок переходов FSM сохраняется.
+    """
+    user_id = get_update_user_id(data)
+    key = user_id if user_id is not None else data.get("update_id", 0)
+    return key % workers
+
+
+# ===== ВОРКЕР =====
+def _worker_main(index: int, token: str, updates: multiprocessing.Queue, max_concurrency: int,
+                 background_jobs: bool):
+    # Останавливает воркеры супервизор (через None в очереди), а не Ctrl+C в терминале
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s",
+                        force=True)
+    asyncio.run(_run_worker(token, updates, max_concurrency, background_jobs))
+
+
+async def _watch_catalog(version: int, change_id: int):
+    """
+    Следит за изменениями, сделанными другими процессами (админка, заказы).
+    Смена версии каталога (триггеры SQLite на видимые поля товаров и категории)
+    - полная перезагрузка; изменения остатков и корзин читаются из журнала
+    по курсору и применяются к отдельным товарам.
+    """
+    while True:
+        await asyncio.sleep(CATALOG_POLL_INTERVAL)
+        try:
+            current = await catalog.db.get_catalog_version()
+            if current != version:
+                # Курсор берём до загрузки: изменения после него применятся повторно, а не потеряются
+                change_id = await catalog.db.get_last_product_change()
+                version = current
+                await catalog.load()
+                await stock.load()
+                continue
+
+            while True:
+                changes = await catalog.db.get_product_changes(change_id, PRODUCT_CHANGES_BATCH)
+                if not changes:
+                    break
+                if changes[0][0] > change_id + 1:
+                    # Журнал обрезан дальше нашего курсора - пропущенное не восстановить
+                    logger.warning("Журнал изменений товаров обрезан, перечитываем каталог")
+                    change_id = await catalog.db.get_last_product_change()
+                    await catalog.load()
+                    await stock.load()
+                    break
+                change_id = changes[-1][0]
+                product_ids = {product_id for _, product_id in changes}
+                await catalog.refresh_products(product_ids)
+                await stock.refresh(product_ids)
+                if len(changes) < PRODUCT_CHANGES_BATCH:
+                    break
+        except Exception as e:
+            logger.error(f"Ошибка обновления каталога: {e}")
+
+
+async def _run_worker(token: str, updates: multiprocessing.Queue, max_concurrency: int, background_jobs: bool):
+    # main импортируется здесь: модуль загружается заново в каждом процессе
+    from main import create_dispatcher, prepare
+
+    bot = Bot(token=token)
+    dp = create_dispatcher(bot)
+    version = await catalog.db.get_catalog_version()
+    change_id = await catalog.db.get_last_product_change()
+    await prepare(bot, background_jobs=background_jobs)
+    watcher = asyncio.create_task(_watch_catalog(version, change_id))
+
+    runner = UpdateRunner(bot, dp, max_concurrency)
+    loop = asyncio.get_running_loop()
+    supervisor = multiprocessing.parent_process()
+    await dp.emit_startup(bot=bot)
+    try:
+        while True:
+            # Ожидание с таймаутом: поток пула не занят навсегда, и при остановке
+            # цикла событий его не приходится ждать дольше WORKER_QUEUE_TIMEOUT
+            try:
+                data = await loop.run_in_executor(None, updates.get, True, WORKER_QUEUE_TIMEOUT)
+            except queue.Empty:
+                if supervisor is not None and not supervisor.is_alive():
+                    logger.warning("Супервизор завершился без сигнала остановки, останавливаем воркер")
+                    break
+                continue
+            if data is None:
+                break
+            try:
+                update = Update.model_validate(data, context={"bot": bot})
+            except Exception as e:
+                logger.warning(f"Некорректное обновление: {e}")
+                continue
+            runner.submit(update, get_update_user_id(data))
+    finally:
+        watcher.cancel()
+        await runner.shutdown()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+# ===== СУПЕРВИЗОР =====
+class Supervisor:
+    """
+    Получает обновления один раз и раздаёт их N процессам-воркерам.
+    У каждого воркера свой event loop, диспетчер и кэши; общее состояние
+    (каталог, корзины, FSM) живёт в SQLite.
+    """
+
+    def __init__(self, token: str, workers: int, max_concurrency: int = 100):
+        self.token = token
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self._context = multiprocessing.get_context("spawn")
+        self._queues: List[multiprocessing.Queue] = []
+        self._processes: List[multiprocessing.Process] = []
+
+    def start(self):
+        for index in range(self.workers):
+            updates = self._context.Queue(maxsize=WORKER_QUEUE_SIZE)
+            # Фото-прогрев и рассылки запускаются только в одном воркере
+            process = self._context.Process(
+                target=_worker_main,
+                args=(index, self.token, updates, self.max_concurrency, index == 0),
+                name=f"bot-worker-{index}",
+                daemon=True
+            )
+            process.start()
+            self._queues.append(updates)
+            self._processes.append(process)
+        logger.info(f"Запущено воркеров: {self.workers}")
+
+    async def dispatch(self, data: dict):
+        updates = self._queues[get_shard(data, self.workers)]
+        try:
+            updates.put_nowait(data)
+        except queue.Full:
+            # Воркер не успевает - ждём, не блокируя event loop
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, updates.put, data)
+
+    async def stop(self, timeout: float = 30):
+        """Просит воркеры доработать принятые обновления и дожидается их"""
+        for updates in self._queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"{process.name} не завершился за {timeout} с")
+                process.terminate()
+
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+async def run_sharded_polling(token: str, workers: int, max_concurrency: int = 100,
+                              allowed_updates: Optional[List[str]] = None):
+    supervisor = Supervisor(token, workers, max_concurrency)
+    supervisor.start()
+
+    bot = Bot(token=token)
+    await bot.delete_webhook(drop_pending_updates=True)
+    stop = _stop_event()
+    offset = None
+
+    async def poll():
+        nonlocal offset
+        while True:
+            try:
+                batch = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.error(f"Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in batch:
+                await supervisor.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+
+    poller = asyncio.create_task(poll())
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Остановка супервизора...")
+        poller.cancel()
+        # Подтверждаем уже розданные обновления, чтобы Telegram не прислал их снова
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0)
+            except Exception as e:
+                logger.warning(f"Не удалось подтвердить обновления: {e}")
+        await supervisor.stop()
+        await bot.session.close()
+
+
+async def run_sharded_webhook(token: str, workers: int, url: str, path: str = "/webhook", secret_token: str = "",
+                              host: str = "0.0.0.0", port: int = 8080, max_concurrency: int = 100,
+                              allowed_updates: Optional[List[str]] = None, set_webhook: bool = True):
+    supervisor = Supervisor(token, workers, max_concurrency)
+    supervisor.start()
+
+    async def handle(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get(SECRET_HEADER) != secret_token:
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+        except Exception as e:
+            logger.warning(f"Некорректное обновление: {e}")
+            return web.Response(status=400)
+        await supervisor.dispatch(data)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Webhook-сервер слушает {host}:{port}{path}")
+
+    bot = Bot(token=token)
+    if set_webhook:
+        await bot.set_webhook(url, secret_token=secret_token or None, allowed_updates=allowed_updates)
+
+    stop = _stop_event()
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Остановка супервизора...")
+        await runner.cleanup()
+        await supervisor.stop()
+        await bot.session.close()
@@ -10,6 +10,7 @@ class ShoppingStates(StatesGroup):
     selecting_product = State()
     selecting_quantity = State()
     viewing_cart = State()
+    searching = State()
 
 class OrderStates(StatesGroup):
     waiting_for_date = State()
@@ -34,3 +35,7 @@ class AdminStates(StatesGroup):
     editing_product_quantity = State()
     editing_product_category = State()
     editing_product_photo = State()
+    broadcast_text = State()
+    broadcast_confirm = State()
+    importing_products = State()
+    bulk_updating = State()
@@ -0,0 +1,73 @@
+import logging
+from typing import Dict
+
+from catalog import Catalog, catalog
+
+logger = logging.getLogger(__name__)
+
+
+class StockLedger:
+    """
+    Доступный остаток товаров в памяти: количество на складе из снимка
+    каталога минус количество, отложенное в корзинах покупателей.
+    Проверка выполняется за O(1) без обращения к SQLite.
+    """
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        # product_id -> сколько отложено во всех корзинах
+        self._held: Dict[int, int] = {}
+        # user_id -> {product_id: количество}
+        self._carts: Dict[int, Dict[int, int]] = {}
+
+    async def load(self):
+        holds = await self.catalog.db.get_cart_holds()
+        self._held = {}
+        self._carts = {}
+        for hold in holds:
+            self._carts.setdefault(hold["user_id"], {})[hold["product_id"]] = hold["quantity"]
+            self._held[hold["product_id"]] = self._held.get(hold["product_id"], 0) + hold["quantity"]
+        logger.info(f"Загружено позиций корзин: {len(holds)}")
+
+    async def refresh(self, product_ids):
+        """
+        Перечитывает суммарный резерв товаров из базы - в режиме воркеров
+        так видны корзины пользователей, которых обслуживают другие процессы
+        """
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        held = await self.catalog.db.get_cart_held(product_ids)
+        for product_id in product_ids:
+            if held.get(product_id):
+                self._held[product_id] = held[product_id]
+            else:
+                self._held.pop(product_id, None)
+
+    def available(self, product_id: int, user_id: int = None) -> int:
+        """
+        Сколько товара можно положить в корзину.
+        Если указан user_id, его собственная позиция не вычитается,
+        так как add_to_cart заменяет её новым количеством.
+        """
+        product = self.catalog.get_product(product_id)
+        if not product:
+            return 0
+        held = self._held.get(product_id, 0)
+        if user_id is not None:
+            held -= self._carts.get(user_id, {}).get(product_id, 0)
+        return max(0, product["quantity"] - held)
+
+    def set_cart_item(self, user_id: int, product_id: int, quantity: int):
+        cart = self._carts.setdefault(user_id, {})
+        previous = cart.get(product_id, 0)
+        cart[product_id] = quantity
+        self._held[product_id] = self._held.get(product_id, 0) - previous + quantity
+
+    def clear_cart(self, user_id: int):
+        """Снимает резерв корзины (очистка или оформленный заказ)"""
+        for product_id, quantity in self._carts.pop(user_id, {}).items():
+            self._held[product_id] = self._held.get(product_id, 0) - quantity
+
+
+stock = StockLedger(catalog)
@@ -0,0 +1,128 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database import AsyncDatabase, db as shared_db
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or {}
+        self.touched = time.monotonic()
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite, переживающее перезапуск бота.
+    Чтение и запись идут в память, изменённые ключи сбрасываются в базу
+    фоновой задачей пачками (одна транзакция на пачку). Записи, к которым
+    не обращались дольше ttl секунд, выгружаются из памяти и при следующем
+    обращении читаются из базы.
+    """
+
+    def __init__(self, db: AsyncDatabase = None, flush_interval: float = 0.5, ttl: float = 3600):
+        self.db = db or shared_db
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._records: Dict[str, _Record] = {}
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return (f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+                f"{key.business_connection_id or ''}:{key.destiny}")
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        storage_key = self._key(key)
+        record = self._records.get(storage_key)
+        if record is None:
+            row = await self.db.get_fsm_record(storage_key)
+            # Пока шло чтение, запись могла появиться из параллельного апдейта
+            record = self._records.get(storage_key)
+            if record is None:
+                record = _Record(row["state"], json.loads(row["data"])) if row else _Record()
+                self._records[storage_key] = record
+        record.touched = time.monotonic()
+        return record
+
+    def _mark_dirty(self, key: StorageKey):
+        self._dirty.add(self._key(key))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    # === ИНТЕРФЕЙС BaseStorage ===
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        return record.data.copy()
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        # Общее соединение с базой принадлежит не хранилищу - не закрываем
+        await self.flush()
+
+    # === ФОНОВАЯ ЗАПИСЬ ===
+    async def flush(self):
+        """Сбрасывает все изменённые записи в базу одной транзакцией"""
+        if not self._dirty:
+            return
+
+        keys, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts = []
+        deletes = []
+        for storage_key in keys:
+            record = self._records.get(storage_key)
+            if record is None or (record.state is None and not record.data):
+                deletes.append(storage_key)
+            else:
+                upserts.append((storage_key, record.state, json.dumps(record.data, ensure_ascii=False), now))
+
+        try:
+            await self.db.save_fsm_records(upserts, deletes)
+        except Exception as e:
+            logger.error(f"Ошибка записи состояний FSM: {e}")
+            # Повторим при следующем сбросе
+            self._dirty |= keys
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.ttl
+        idle = [storage_key for storage_key, record in self._records.items()
+                if record.touched < deadline and storage_key not in self._dirty]
+        for storage_key in idle:
+            del self._records[storage_key]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._evict_idle()
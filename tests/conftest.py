@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# database при импорте открывает общую базу shop_bot.db и каталог images/
+# в текущем каталоге - тесты работают во временном, чтобы не трогать рабочие файлы
+os.chdir(tempfile.mkdtemp(prefix="shop-bot-tests-"))
+
+from database import AsyncDatabase, Database  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / "test.db"), images_dir=str(tmp_path / "images"))
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def async_db(tmp_path):
+    database = AsyncDatabase(str(tmp_path / "test.db"), images_dir=str(tmp_path / "images"))
+    yield database
+    database.close()
+
+
+def add_product(database: Database, name: str = "Клубника", quantity: int = 100, price: float = 500) -> int:
+    """Товар в первой стандартной категории"""
+    category_id = database.get_categories()[0]["id"]
+    return database.add_product(name, price, quantity, category_id)
@@ -0,0 +1,117 @@
+import sqlite3
+
+from database import Database
+
+# Схема из init_db до появления миграций (без image_ref, индексов и служебных таблиц)
+BASELINE_SCHEMA = '''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        registered_at TEXT NOT NULL
+    );
+    CREATE TABLE categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE,
+        emoji TEXT
+    );
+    CREATE TABLE products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        price REAL NOT NULL,
+        quantity INTEGER NOT NULL,
+        unit TEXT NOT NULL,
+        category_id INTEGER,
+        image BLOB,
+        FOREIGN KEY (category_id) REFERENCES categories (id)
+    );
+    CREATE TABLE carts (
+        user_id INTEGER,
+        product_id INTEGER,
+        quantity INTEGER NOT NULL,
+        PRIMARY KEY (user_id, product_id),
+        FOREIGN KEY (user_id) REFERENCES users (user_id),
+        FOREIGN KEY (product_id) REFERENCES products (id)
+    );
+    CREATE TABLE orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        total_amount REAL NOT NULL,
+        delivery_date TEXT NOT NULL,
+        delivery_time TEXT NOT NULL,
+        delivery_address TEXT NOT NULL,
+        status TEXT DEFAULT 'pending',
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    );
+    CREATE TABLE order_items (
+        order_id INTEGER,
+        product_id INTEGER,
+        quantity INTEGER NOT NULL,
+        price REAL NOT NULL,
+        FOREIGN KEY (order_id) REFERENCES orders (id),
+        FOREIGN KEY (product_id) REFERENCES products (id)
+    );
+    INSERT INTO categories (name, emoji) VALUES ('Фрукты', '🍎'), ('Овощи', '🥕'), ('Ягоды', '🍓'), ('Молочка', '🥛');
+'''
+
+HOT_PATH_INDEXES = {"idx_products_category", "idx_carts_product", "idx_order_items_order",
+                    "idx_orders_user", "idx_orders_status", "idx_orders_created"}
+
+
+def _baseline_db(path: str):
+    conn = sqlite3.connect(path)
+    conn.executescript(BASELINE_SCHEMA)
+    conn.execute("INSERT INTO users VALUES (1, 'Покупатель', '+70000000000', '2025-01-01T10:00:00')")
+    conn.execute("INSERT INTO products (name, price, quantity, unit, category_id, image) "
+                 "VALUES ('Ёжевика лесная', 900, 12, 'кг', 3, ?)", (b"old-photo",))
+    conn.execute("INSERT INTO products (name, price, quantity, unit, category_id) VALUES ('Морковь', 100, 40, 'кг', 2)")
+    conn.execute("INSERT INTO carts VALUES (1, 2, 3)")
+    conn.execute("INSERT INTO orders (user_id, total_amount, delivery_date, delivery_time, delivery_address, "
+                 "created_at) VALUES (1, 1800, '02.01', '10:00-12:00', 'Адрес', '2025-01-01T12:00:00')")
+    conn.execute("INSERT INTO order_items VALUES (1, 1, 2, 900)")
+    conn.commit()
+    conn.close()
+
+
+def test_baseline_database_is_migrated(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    _baseline_db(path)
+
+    database = Database(path, images_dir=str(tmp_path / "images"))
+    try:
+        with database.connection() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            image = conn.execute("SELECT image FROM products WHERE id = 1").fetchone()[0]
+            sales = conn.execute("SELECT day, orders, quantity, revenue FROM sales_daily").fetchall()
+        assert version == len(database._migrations())
+        assert HOT_PATH_INDEXES <= indexes
+
+        # Данные сохранились, фото переехало из BLOB в файловое хранилище
+        product = database.get_product(1)
+        assert (product["name"], product["quantity"]) == ("Ёжевика лесная", 12)
+        assert image is None
+        assert database.images.read(product["image_ref"]) == b"old-photo"
+        assert database.get_user_cart(1)[0]["id"] == 2
+
+        # Производные таблицы заполнены по старым данным
+        assert sales == [("2025-01-01", 1, 2, 1800)]
+        assert [item["id"] for item in database.search_products("ежевика")] == [1]
+    finally:
+        database.close()
+
+
+def test_migrations_are_applied_once(tmp_path):
+    path = str(tmp_path / "baseline.db")
+    _baseline_db(path)
+    Database(path, images_dir=str(tmp_path / "images")).close()
+
+    database = Database(path, images_dir=str(tmp_path / "images"))
+    try:
+        with database.connection() as conn:
+            assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database._migrations())
+            assert conn.execute("SELECT COUNT(*) FROM products").fetchone()[0] == 2
+            assert conn.execute("SELECT COUNT(*) FROM categories").fetchone()[0] == 4
+    finally:
+        database.close()
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from conftest import add_product
+from database import InsufficientStockError
+
+
+def _checkout(database, user_id: int):
+    cart = database.get_user_cart(user_id)
+    total = sum(item["price"] * item["quantity"] for item in cart)
+    return database.create_order(user_id, total, "01.01", "10:00-12:00", "Адрес", cart)
+
+
+def test_concurrent_checkouts_do_not_oversell(async_db):
+    product_id = add_product(async_db.sync, quantity=50)
+    customers = 200
+    for user_id in range(1, customers + 1):
+        async_db.sync.add_to_cart(user_id, product_id, 1)
+
+    async def confirm_order(user_id: int) -> bool:
+        cart = await async_db.get_user_cart(user_id)
+        total = sum(item["price"] * item["quantity"] for item in cart)
+        try:
+            await async_db.create_order(user_id, total, "01.01", "10:00-12:00", "Адрес", cart)
+            return True
+        except InsufficientStockError:
+            return False
+
+    async def checkout_all():
+        return await asyncio.gather(*(confirm_order(user_id) for user_id in range(1, customers + 1)))
+
+    results = asyncio.run(checkout_all())
+
+    assert sum(results) == 50
+    assert async_db.sync.get_product(product_id)["quantity"] == 0
+    with async_db.sync.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 50
+        assert conn.execute("SELECT SUM(quantity) FROM order_items").fetchone()[0] == 50
+
+
+def test_shortage_changes_nothing(database):
+    plenty = add_product(database, "Яблоко", quantity=10)
+    scarce = add_product(database, "Груша", quantity=2)
+    database.add_to_cart(1, plenty, 5)
+    database.add_to_cart(1, scarce, 3)
+
+    with pytest.raises(InsufficientStockError) as error:
+        _checkout(database, 1)
+
+    assert error.value.shortages == [{"id": scarce, "name": "Груша", "requested": 3, "available": 2}]
+    assert database.get_product(plenty)["quantity"] == 10
+    assert database.get_product(scarce)["quantity"] == 2
+    assert len(database.get_user_cart(1)) == 2
+
+
+def test_order_decrements_stock_and_clears_cart(database):
+    product_id = add_product(database, quantity=10)
+    database.add_to_cart(1, product_id, 4)
+
+    _checkout(database, 1)
+
+    assert database.get_product(product_id)["quantity"] == 6
+    assert database.get_user_cart(1) == []
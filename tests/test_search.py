@@ -0,0 +1,45 @@
+import pytest
+
+from conftest import add_product
+from database import make_fts_query
+
+
+@pytest.fixture
+def products(database):
+    return {name: add_product(database, name) for name in ("Ёжевика лесная", "Ежевика садовая", "Мёд липовый", "Дыня")}
+
+
+def _names(database, query: str, offset: int = 0, limit: int = 10):
+    return {item["name"] for item in database.search_products(query, offset, limit)}
+
+
+@pytest.mark.parametrize("query", ["ежевика", "ёжевика", "ЕЖЕВ", "Ёж"])
+def test_yo_and_ye_match_each_other(database, products, query):
+    assert _names(database, query) == {"Ёжевика лесная", "Ежевика садовая"}
+
+
+def test_yo_folding_survives_rename_and_delete(database, products):
+    database.update_product_field(products["Мёд липовый"], "name", "Мёдовик")
+    database.delete_product(products["Ёжевика лесная"])
+
+    assert _names(database, "медов") == {"Мёдовик"}
+    assert _names(database, "мед лип") == set()
+    assert _names(database, "ежевика") == {"Ежевика садовая"}
+    with database.connection() as conn:
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('integrity-check')")
+
+
+def test_fts_query_folds_yo():
+    assert make_fts_query("Мёд, ЁЖИК!") == '"мед"* "ежик"*'
+
+
+def test_best_match_ranks_first_across_many_matches(database):
+    for index in range(1500):
+        add_product(database, f"Яблоко красное сладкое крупное {index}")
+    best = add_product(database, "Яблоко")
+
+    first_page = database.search_products("ябл", 0, 10)
+    second_page = database.search_products("ябл", 10, 10)
+
+    assert first_page[0]["id"] == best
+    assert not {item["id"] for item in first_page} & {item["id"] for item in second_page}
@@ -0,0 +1,82 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from storage import SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+
+def test_changes_are_flushed_in_background(async_db):
+    async def scenario():
+        storage = SQLiteStorage(async_db, flush_interval=0.05)
+        await storage.set_state(KEY, "OrderStates:waiting_address")
+        await storage.set_data(KEY, {"quantity": 3})
+        before = await async_db.get_fsm_record(storage._key(KEY))
+        await asyncio.sleep(0.2)
+        after = await async_db.get_fsm_record(storage._key(KEY))
+        await storage.close()
+        return before, after
+
+    before, after = asyncio.run(scenario())
+
+    assert before is None
+    assert after["state"] == "OrderStates:waiting_address"
+    assert after["data"] == '{"quantity": 3}'
+
+
+def test_close_flushes_pending_changes(async_db):
+    async def scenario():
+        storage = SQLiteStorage(async_db, flush_interval=60)
+        await storage.set_state(KEY, "ShoppingStates:selecting_quantity")
+        await storage.set_data(KEY, {"product_id": 7})
+        await storage.close()
+
+        # Новый экземпляр - как после перезапуска бота
+        restarted = SQLiteStorage(async_db, flush_interval=60)
+        result = await restarted.get_state(KEY), await restarted.get_data(KEY)
+        await restarted.close()
+        return result
+
+    state, data = asyncio.run(scenario())
+
+    assert state == "ShoppingStates:selecting_quantity"
+    assert data == {"product_id": 7}
+
+
+def test_cleared_record_is_deleted(async_db):
+    async def scenario():
+        storage = SQLiteStorage(async_db, flush_interval=60)
+        await storage.set_state(KEY, "OrderStates:waiting_address")
+        await storage.flush()
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        await storage.close()
+        return await async_db.get_fsm_record(storage._key(KEY))
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_failed_flush_is_retried(async_db, monkeypatch):
+    save = async_db.save_fsm_records
+    calls = []
+
+    async def flaky_save(upserts, deletes):
+        calls.append(len(upserts))
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        await save(upserts, deletes)
+
+    monkeypatch.setattr(async_db, "save_fsm_records", flaky_save)
+
+    async def scenario():
+        storage = SQLiteStorage(async_db, flush_interval=60)
+        await storage.set_state(KEY, "OrderStates:waiting_address")
+        await storage.flush()
+        await storage.close()
+        return await async_db.get_fsm_record(storage._key(KEY))
+
+    record = asyncio.run(scenario())
+
+    assert calls == [1, 1]
+    assert record["state"] == "OrderStates:waiting_address"
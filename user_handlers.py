@@ -1,17 +1,19 @@
-import os
 import logging
 from aiogram import Bot, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 
-from database import Database
+from database import InsufficientStockError, db
 from keyboards import *
+from catalog import catalog
+from stock import stock
+from edit_coalescer import quantity_edits
+from photo_cache import photo_cache
+from inline_search import inline_search, INLINE_CACHE_TIME
 from states import RegistrationStates, ShoppingStates, OrderStates
 
 logger = logging.getLogger(__name__)
 
-db = Database()
-
 ADMIN_GROUP_ID = -1003161488318
 
 
@@ -22,7 +24,7 @@ class UserHandlers:
     # ===== ОБРАБОТЧИКИ КОМАНД =====
     async def cmd_start(self, message: types.Message, state: FSMContext):
         user_id = message.from_user.id
-        user = db.get_user(user_id)
+        user = await db.get_user(user_id)
 
         if user:
             await message.answer(
@@ -54,7 +56,7 @@ class UserHandlers:
         user_data = await state.get_data()
         user_id = message.from_user.id
 
-        db.add_user(user_id, name, user_data["phone"])
+        await db.add_user(user_id, name, user_data["phone"])
 
         await message.answer(
             f"✅ Регистрация успешно завершена!\n\n"
@@ -76,7 +78,7 @@ class UserHandlers:
 
     async def show_cart(self, message: types.Message, state: FSMContext):
         user_id = message.from_user.id
-        cart_items = db.get_user_cart(user_id)
+        cart_items = await db.get_user_cart(user_id)
 
         if not cart_items:
             await message.answer(
@@ -98,12 +100,68 @@ class UserHandlers:
             await message.answer(cart_text, reply_markup=get_cart_keyboard())
             await state.set_state(ShoppingStates.viewing_cart)
 
+    # ===== ПОИСК =====
+    async def start_search(self, message: types.Message, state: FSMContext, command: CommandObject = None):
+        # /search яблоко - искать сразу
+        if command and command.args:
+            await self._show_search_results(message, state, command.args)
+            return
+
+        await message.answer("🔍 Введите название товара (можно начало слова):")
+        await state.set_state(ShoppingStates.searching)
+
+    async def process_search_query(self, message: types.Message, state: FSMContext):
+        await self._show_search_results(message, state, message.text)
+
+    async def search_page(self, callback: types.CallbackQuery, state: FSMContext):
+        offset = int(callback.data.replace("search_page_", ""))
+        data = await state.get_data()
+        query = data.get("search_query")
+        if not query:
+            await callback.answer("Поиск устарел, начните новый", show_alert=True)
+            return
+
+        products, has_more = await self._search(query, offset)
+        await callback.message.edit_reply_markup(
+            reply_markup=get_search_results_keyboard(products, offset, has_more)
+        )
+        await callback.answer()
+
+    async def _search(self, query: str, offset: int):
+        # На один результат больше, чтобы знать, есть ли следующая страница
+        products = await db.search_products(query, offset, SEARCH_PAGE_SIZE + 1)
+        return products[:SEARCH_PAGE_SIZE], len(products) > SEARCH_PAGE_SIZE
+
+    async def _show_search_results(self, message: types.Message, state: FSMContext, query: str):
+        products, has_more = await self._search(query, 0)
+        if not products:
+            await message.answer(f"😔 По запросу «{query}» ничего не найдено. Попробуйте другое название:")
+            await state.set_state(ShoppingStates.searching)
+            return
+
+        await state.update_data(search_query=query)
+        await message.answer(
+            f"🔍 Результаты по запросу «{query}»:",
+            reply_markup=get_search_results_keyboard(products, 0, has_more)
+        )
+        await state.set_state(ShoppingStates.selecting_product)
+
+    # ===== INLINE-РЕЖИМ =====
+    async def process_inline_query(self, inline_query: types.InlineQuery):
+        # Inline-режим включается у @BotFather командой /setinline
+        results, next_offset = inline_search.page(inline_query.query, inline_query.offset)
+        await inline_query.answer(
+            results,
+            cache_time=INLINE_CACHE_TIME,
+            is_personal=False,
+            next_offset=next_offset
+        )
+
     # ===== ОБРАБОТЧИКИ КАТАЛОГА =====
     async def process_category(self, callback: types.CallbackQuery, state: FSMContext):
         category_id = int(callback.data.replace("category_", ""))
-        products = db.get_products_by_category(category_id)
 
-        if products:
+        if catalog.count_products(category_id):
             await callback.message.edit_text(
                 f"Товары в выбранной категории:",
                 reply_markup=get_products_keyboard(category_id)
@@ -113,43 +171,47 @@ class UserHandlers:
 
         await state.set_state(ShoppingStates.selecting_product)
 
+    async def process_products_page(self, callback: types.CallbackQuery, state: FSMContext):
+        # Кнопка с номером страницы ничего не делает
+        if callback.data == "page_current":
+            await callback.answer()
+            return
+
+        _, category_id, after_id = callback.data.split("_")
+        await callback.message.edit_reply_markup(
+            reply_markup=get_products_keyboard(int(category_id), int(after_id))
+        )
+        await callback.answer()
+
     async def process_product(self, callback: types.CallbackQuery, state: FSMContext):
         product_id = int(callback.data.replace("product_", ""))
-        product = db.get_product(product_id)
+        product = catalog.get_product(product_id)
 
         if product:
             await state.update_data(selected_product=product_id, quantity=0)
-
-            if product["image"]:
-                # Создаем временный файл для изображения
-                temp_filename = f"temp_{product_id}.jpg"
-                with open(temp_filename, "wb") as f:
-                    f.write(product["image"])
-
-                with open(temp_filename, "rb") as photo_file:
-                    photo = types.BufferedInputFile(
-                        file=photo_file.read(),
-                        filename=temp_filename
-                    )
-                    await callback.message.answer_photo(
-                        photo=photo,
-                        caption=f"📦 {product['name']}\n"
-                                f"💰 Цена: {product['price']}сум/{product['unit']}\n"
-                                f"📊 Доступно: {product['quantity']} {product['unit']}\n\n"
-                                f"Выберите количество:",
-                        reply_markup=get_quantity_keyboard(0)
-                    )
-
-                # Удаляем временный файл
-                os.remove(temp_filename)
+            available = stock.available(product_id, callback.from_user.id)
+
+            if product["image_ref"]:
+                # Повторные просмотры идут по file_id без загрузки файла
+                sent = await photo_cache.send_product_photo(
+                    callback.message,
+                    product["image_ref"],
+                    caption=f"📦 {product['name']}\n"
+                            f"💰 Цена: {product['price']}сум/{product['unit']}\n"
+                            f"📊 Доступно: {available} {product['unit']}\n\n"
+                            f"Выберите количество:",
+                    reply_markup=get_quantity_keyboard(0)
+                )
+                quantity_edits.mark_shown((sent.chat.id, sent.message_id), 0)
             else:
                 await callback.message.edit_text(
                     f"📦 {product['name']}\n"
                     f"💰 Цена: {product['price']}сум/{product['unit']}\n"
-                    f"📊 Доступно: {product['quantity']} {product['unit']}\n\n"
+                    f"📊 Доступно: {available} {product['unit']}\n\n"
                     f"Выберите количество:",
                     reply_markup=get_quantity_keyboard(0)
                 )
+                quantity_edits.mark_shown((callback.message.chat.id, callback.message.message_id), 0)
 
             await state.set_state(ShoppingStates.selecting_quantity)
 
@@ -159,22 +221,28 @@ class UserHandlers:
         quantity = max(0, data.get("quantity", 0) - 1)
         await state.update_data(quantity=quantity)
 
-        await callback.message.edit_reply_markup(
-            reply_markup=get_quantity_keyboard(quantity)
-        )
+        self._edit_quantity_keyboard(callback.message, quantity)
 
     async def quantity_plus(self, callback: types.CallbackQuery, state: FSMContext):
         data = await state.get_data()
         product_id = data.get("selected_product")
-        product = db.get_product(product_id)
+        product = catalog.get_product(product_id)
 
         if product:
-            quantity = min(product["quantity"], data.get("quantity", 0) + 1)
+            # Верхняя граница - остаток за вычетом чужих корзин, без запроса к базе
+            available = stock.available(product_id, callback.from_user.id)
+            quantity = min(available, data.get("quantity", 0) + 1)
             await state.update_data(quantity=quantity)
 
-            await callback.message.edit_reply_markup(
-                reply_markup=get_quantity_keyboard(quantity)
-            )
+            self._edit_quantity_keyboard(callback.message, quantity)
+
+    def _edit_quantity_keyboard(self, message: types.Message, quantity: int):
+        # Серия быстрых нажатий превращается в одну правку с последним значением
+        quantity_edits.submit(
+            (message.chat.id, message.message_id),
+            quantity,
+            lambda value: message.edit_reply_markup(reply_markup=get_quantity_keyboard(value))
+        )
 
     async def add_to_cart(self, callback: types.CallbackQuery, state: FSMContext):
         data = await state.get_data()
@@ -187,9 +255,20 @@ class UserHandlers:
         user_id = callback.from_user.id
         product_id = data.get("selected_product")
 
-        db.add_to_cart(user_id, product_id, quantity)
+        available = stock.available(product_id, user_id)
+        if quantity > available:
+            await callback.answer(f"❌ Доступно только {available} кг", show_alert=True)
+            return
+
+        # Окончательная проверка в базе: корзины других процессов в памяти видны с задержкой
+        available = await db.reserve_cart_item(user_id, product_id, quantity)
+        if quantity > available:
+            await callback.answer(f"❌ Доступно только {available} кг", show_alert=True)
+            return
+        stock.set_cart_item(user_id, product_id, quantity)
 
         await callback.answer(f"✅ Товар добавлен в корзину ({quantity} кг)", show_alert=True)
+        quantity_edits.cancel((callback.message.chat.id, callback.message.message_id))
 
         # Возврат к категориям
         try:
@@ -205,6 +284,7 @@ class UserHandlers:
         await state.set_state(ShoppingStates.selecting_category)
 
     async def continue_shopping(self, callback: types.CallbackQuery, state: FSMContext):
+        quantity_edits.cancel((callback.message.chat.id, callback.message.message_id))
         try:
             await callback.message.edit_text(
                 "Выберите категорию товаров:",
@@ -257,8 +337,8 @@ class UserHandlers:
 
         # Подготовка итогового заказа
         user_id = message.from_user.id
-        user_info = db.get_user(user_id)
-        cart_items = db.get_user_cart(user_id)
+        user_info = await db.get_user(user_id)
+        cart_items = await db.get_user_cart(user_id)
         data = await state.get_data()
 
         order_text = "📋 Ваш заказ:\n\n"
@@ -280,8 +360,8 @@ class UserHandlers:
 
     async def confirm_order(self, callback: types.CallbackQuery, state: FSMContext):
         user_id = callback.from_user.id
-        user_info = db.get_user(user_id)
-        cart_items = db.get_user_cart(user_id)
+        user_info = await db.get_user(user_id)
+        cart_items = await db.get_user_cart(user_id)
         data = await state.get_data()
 
         if not user_info:
@@ -291,11 +371,29 @@ class UserHandlers:
         # Рассчитываем общую сумму
         total = sum(item["price"] * item["quantity"] for item in cart_items)
 
-        # Сохраняем заказ в базу данных
-        order_id = db.create_order(
-            user_id, total, data['delivery_date'],
-            data['delivery_time'], data['delivery_address'], cart_items
-        )
+        # Сохраняем заказ в базу данных, остатки списываются в той же транзакции
+        try:
+            order_id = await db.create_order(
+                user_id, total, data['delivery_date'],
+                data['delivery_time'], data['delivery_address'], cart_items
+            )
+        except InsufficientStockError as e:
+            shortage_text = "❌ Недостаточно товара на складе:\n\n"
+            for item in e.shortages:
+                shortage_text += (f"• {item['name'] or 'Товар удалён'}: в корзине {item['requested']} кг, "
+                                  f"доступно {item['available']} кг\n")
+            shortage_text += "\nИзмените количество в корзине и оформите заказ снова."
+            await callback.message.edit_text(shortage_text)
+            await callback.message.answer(
+                "Вы вернулись в главное меню.",
+                reply_markup=get_main_menu_keyboard()
+            )
+            await state.clear()
+            return
+
+        # Остатки изменились - обновляем снимок каталога и снимаем резерв корзины
+        await catalog.refresh_products({item["id"] for item in cart_items})
+        stock.clear_cart(user_id)
 
         # Формирование сообщения для админской группы
         admin_message = "🆕 <b>НОВЫЙ ЗАКАЗ!</b>\n\n"
@@ -367,7 +465,7 @@ class UserHandlers:
 
     async def view_cart_inline(self, callback: types.CallbackQuery, state: FSMContext):
         user_id = callback.from_user.id
-        cart_items = db.get_user_cart(user_id)
+        cart_items = await db.get_user_cart(user_id)
 
         if not cart_items:
             await callback.answer("Ваша корзина пуста", show_alert=True)
@@ -394,7 +492,8 @@ class UserHandlers:
 
     async def clear_cart(self, callback: types.CallbackQuery):
         user_id = callback.from_user.id
-        db.clear_cart(user_id)
+        await db.clear_cart(user_id)
+        stock.clear_cart(user_id)
 
         await callback.answer("🗑 Корзина очищена", show_alert=True)
         await callback.message.edit_text(
@@ -405,7 +504,7 @@ class UserHandlers:
     # ===== UNKNOWN MESSAGES =====
     async def unknown_message(self, message: types.Message):
         user_id = message.from_user.id
-        user = db.get_user(user_id)
+        user = await db.get_user(user_id)
 
         if not user:
             await message.answer(
@@ -0,0 +1,191 @@
+import asyncio
+import signal
+import logging
+from typing import Dict, Optional, Set
+
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def get_update_user_id(data: dict) -> Optional[int]:
+    """ID пользователя-отправителя из сырого обновления Telegram"""
+    for key, value in data.items():
+        if key != "update_id" and isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if isinstance(sender, dict) and "id" in sender:
+                return sender["id"]
+    return None
+
+
+class UpdateRunner:
+    """
+    Фоновая обработка обновлений диспетчером: одновременно не больше
+    max_concurrency обновлений, а обновления одного пользователя
+    обрабатываются строго по очереди, чтобы переходы FSM не перемешались.
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, max_concurrency: int = 100):
+        self.bot = bot
+        self.dp = dp
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tasks: Set[asyncio.Task] = set()
+        # user_id -> последняя задача пользователя
+        self._user_tails: Dict[int, asyncio.Task] = {}
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, update: Update, user_id: Optional[int]):
+        previous = self._user_tails.get(user_id) if user_id is not None else None
+        task = asyncio.create_task(self._process(update, previous))
+        self._tasks.add(task)
+        if user_id is not None:
+            self._user_tails[user_id] = task
+        task.add_done_callback(lambda done: self._forget(done, user_id))
+
+    def _forget(self, task: asyncio.Task, user_id: Optional[int]):
+        self._tasks.discard(task)
+        if user_id is not None and self._user_tails.get(user_id) is task:
+            del self._user_tails[user_id]
+
+    async def _process(self, update: Update, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait({previous})
+        async with self._semaphore:
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.exception(f"Ошибка обработки обновления {update.update_id}: {e}")
+
+    async def shutdown(self, timeout: float = 30):
+        """Дожидается обработки уже принятых обновлений"""
+        if self._tasks:
+            logger.info(f"Ожидаем завершения обработки {len(self._tasks)} обновлений")
+            await asyncio.wait(set(self._tasks), timeout=timeout)
+
+
+class WebhookServer:
+    """
+    Приём обновлений по webhook. Telegram получает ответ сразу,
+    обработка идёт в фоне через UpdateRunner.
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, secret_token: str = "", max_concurrency: int = 100,
+                 max_pending: int = None):
+        self.bot = bot
+        self.secret_token = secret_token
+        self.max_pending = max_pending or max_concurrency * 10
+        self.runner = UpdateRunner(bot, dp, max_concurrency)
+        self._closing = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token and request.headers.get(SECRET_HEADER) != self.secret_token:
+            return web.Response(status=401)
+        # Telegram повторит доставку, если мы перегружены или останавливаемся
+        if self._closing or self.runner.pending >= self.max_pending:
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+            update = Update.model_validate(data, context={"bot": self.bot})
+        except Exception as e:
+            logger.warning(f"Некорректное обновление: {e}")
+            return web.Response(status=400)
+
+        self.runner.submit(update, get_update_user_id(data))
+        return web.Response()
+
+    async def shutdown(self, timeout: float = 30):
+        """Перестаёт принимать обновления и дожидается обработки принятых"""
+        self._closing = True
+        await self.runner.shutdown(timeout)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, url: str, path: str = "/webhook", secret_token: str = "",
+                      host: str = "0.0.0.0", port: int = 8080, max_concurrency: int = 100,
+                      set_webhook: bool = True):
+    server = WebhookServer(bot, dp, secret_token=secret_token, max_concurrency=max_concurrency)
+    app = web.Application()
+    app.router.add_post(path, server.handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"Webhook-сервер слушает {host}:{port}{path}")
+
+    await dp.emit_startup(bot=bot)
+    if set_webhook:
+        await bot.set_webhook(
+            url,
+            secret_token=secret_token or None,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        # webhook не удаляем: за балансировщиком могут работать другие процессы
+        logger.info("Остановка webhook-сервера...")
+        await server.shutdown()
+        await runner.cleanup()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+# ===== ЛОКАЛЬНАЯ ПРОВЕРКА =====
+async def send_synthetic_updates(url: str, count: int = 100, users: int = 10, secret_token: str = "",
+                                 text: str = "/start") -> Dict[int, int]:
+    """
+    Заменяет Telegram при локальной проверке: отправляет count синтетических
+    сообщений от users пользователей и возвращает количество ответов по HTTP-статусам
+    """
+    headers = {SECRET_HEADER: secret_token} if secret_token else {}
+    statuses: Dict[int, int] = {}
+
+    async def post(session: ClientSession, update_id: int):
+        user_id = 100000 + update_id % users
+        update = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": 0,
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+                "text": text
+            }
+        }
+        async with session.post(url, json=update, headers=headers) as response:
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, update_id) for update_id in range(1, count + 1)))
+    return statuses
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Отправка синтетических обновлений на локальный webhook")
+    parser.add_argument("url", help="например http://127.0.0.1:8080/webhook")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--text", default="/start")
+    args = parser.parse_args()
+
+    print(asyncio.run(send_synthetic_updates(args.url, args.count, args.users, args.secret, args.text)))